@@ -68,3 +68,8 @@ class ModelVersionAdmin(admin.ModelAdmin):
 @admin.register(RiverChannel)
 class RiverChannelAdmin(LeafletGeoAdmin):
     display_raw = True
+
+    def delete_queryset(self, request, queryset):
+        # Bulk deletes skip RiverChannel.delete, so update the parameters here
+        queryset.delete()
+        RiverChannel.update_parameters()
@@ -1,75 +1,231 @@
+from collections import defaultdict
+from datetime import timedelta
+import bisect
+
 from django.conf import settings
 from django.contrib.gis.db.models import Max, Min, Union
-from django.db import connection
+from django.db import connection, transaction
 from django.utils import timezone
 
-from webapp.alerts import TwilioAlerts
-from webapp.models import UserAlert, UserPhoneNumber, AlertType
+from webapp.alerts import AlertDispatcher
+from webapp.models import (
+    AlertState,
+    AlertType,
+    DeliveryStatus,
+    UserAlert,
+    UserPhoneNumber,
+)
 
-from .models import DepthPrediction, RiverChannel
+from .models import DepthPrediction, FloodModelParameters, ModelVersion
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def get_alert_period():
+    """Get the start and end dates of the predictions alerts are sent for"""
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today, today + timezone.timedelta(days=5)
+
+
 def send_phone_alerts_for_user(user_id, phone_number_id, alert_type=AlertType.SMS):
     """Send alerts to a user's phone number, i.e. via WhatsApp or SMS"""
-    user_sms_alerts = (
-        UserAlert.objects.filter(
-            user_id=user_id, phone_number_id=phone_number_id, alert_type=alert_type
-        )
-        .values("user", "phone_number")
-        .annotate(all_locations=Union("location"))
+    alert = UserAlert.objects.filter(
+        user_id=user_id, phone_number_id=phone_number_id, alert_type=alert_type
+    ).aggregate(all_locations=Union("location"))
+    if alert["all_locations"] is None:
+        return
+    start_date, end_date = get_alert_period()
+    message = get_message(start_date, end_date, alert["all_locations"])
+    if message:
+        send_alert_messages([(user_id, phone_number_id, message)], alert_type)
+
+
+def send_alert_messages(messages, alert_type=AlertType.SMS, on_delivery=None):
+    """
+    Send messages to users' phone numbers through the alert dispatcher.
+
+    :param messages: list of (user_id, phone_number_id, message), as built by
+        send_changed_alerts from get_alert_summaries
+    :param on_delivery: function called with each AlertDelivery as it is saved
+    :return: list of AlertDelivery records
+    """
+    phone_numbers = UserPhoneNumber.objects.in_bulk(
+        [phone_number_id for user_id, phone_number_id, message in messages]
     )
+    alerts = []
+    for user_id, phone_number_id, message in messages:
+        if phone_number_id not in phone_numbers:
+            logger.error(f"Unable to find phone number id {phone_number_id}")
+            continue
+        phone_number = str(phone_numbers[phone_number_id].phone_number)
+        if alert_type != AlertType.SMS:
+            phone_number = f"{alert_type}:{phone_number}"
+        alerts.append((phone_number_id, phone_number, message))
 
-    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    five_days_ahead = today + timezone.timedelta(days=5)
-    twilio_alerts = TwilioAlerts()
-    for alert in user_sms_alerts:
-        try:
-            message = get_message(today, five_days_ahead, alert["all_locations"])
-            if message:
-                phone_number = str(
-                    UserPhoneNumber.objects.get(id=alert["phone_number"]).phone_number
-                )
-                if alert_type == AlertType.SMS:
-                    twilio_alerts.send_alert_sms(phone_number, message)
-                else:
-                    twilio_alerts.send_alert_whatsapp(phone_number, message)
-        except Exception as e:
-            logger.error(
-                f"Unable to send message for phone number id {alert['phone_number']}: {e}"
-            )
+    return AlertDispatcher().send(alerts, on_delivery)
 
 
 def get_message(start_date, end_date, location):
-    # Get river channel data to exclude
-    with connection.cursor() as cursor:
-        cursor.execute(
-            "SELECT ST_Union(ST_Buffer(channel_location, 0)) FROM calculations_riverchannel"
-        )
-        channel_data = cursor.fetchone()[0]
-
-    # Find values in DepthPrediction in future which match the current location
-    predictions = DepthPrediction.objects.filter(
+    # Find the flooding in future in the cells crossing the current location, as the
+    # flood extents cover deeper cells nearby and are simplified
+    flooding = DepthPrediction.objects.filter(
         date__gte=start_date,
         date__lte=end_date,
+        model_version_id=ModelVersion.get_current_id(),
         parameters__bounding_box__intersects=location,
+        parameters__in_channel=False,
         mid_lower_centile__gte=settings.ALERT_DEPTH_THRESHOLD,
+    ).aggregate(Min("date"), Max("date"), Max("median_depth"))
+    return format_message(
+        flooding["date__min"], flooding["date__max"], flooding["median_depth__max"]
     )
-    if channel_data:
-        predictions = predictions.exclude(
-            parameters__bounding_box__coveredby=channel_data
-        )
 
-    predictions = predictions.aggregate(Min("date"), Max("date"), Max("median_depth"))
-    if predictions["median_depth__max"]:
+
+def format_message(start_date, end_date, max_depth):
+    if max_depth:
         return settings.ALERT_TEXT.format(
-            max_depth=f"{predictions['median_depth__max']:.1f}",
-            start_date=predictions["date__min"].strftime(settings.ALERT_DATE_FORMAT),
-            end_date=predictions["date__max"].strftime(settings.ALERT_DATE_FORMAT),
+            max_depth=f"{max_depth:.1f}",
+            start_date=start_date.strftime(settings.ALERT_DATE_FORMAT),
+            end_date=end_date.strftime(settings.ALERT_DATE_FORMAT),
             site_url=settings.SITE_URL,
         )
     else:
         return None
+
+
+def get_alert_summaries(start_date, end_date, alert_type=AlertType.SMS):
+    """
+    Summarise the flooding at every verified alert location, in one query, from the
+    cells crossing it outside the river channel with a 30th centile depth of at least
+    ALERT_DEPTH_THRESHOLD (as the flood extents are outlined from).
+
+    :return: dict of (user_id, phone_number_id) to a list of their alerts'
+        (alert_id, start_date, end_date, max_depth)
+    """
+    sql = f"""
+        SELECT alert.id, alert.user_id, alert.phone_number_id,
+            MIN(prediction.date), MAX(prediction.date), MAX(prediction.median_depth)
+        FROM {UserAlert._meta.db_table} AS alert
+        JOIN {FloodModelParameters._meta.db_table} AS params
+            ON ST_Intersects(params.bounding_box, alert.location)
+        JOIN {DepthPrediction._meta.db_table} AS prediction
+            ON prediction.parameters_id = params.id
+        WHERE alert.verified
+            AND alert.alert_type = %s
+            AND prediction.date >= %s
+            AND prediction.date <= %s
+            AND prediction.model_version_id = %s
+            AND prediction.mid_lower_centile >= %s
+            AND NOT params.in_channel
+        GROUP BY alert.id, alert.user_id, alert.phone_number_id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql,
+            [
+                alert_type,
+                start_date,
+                end_date,
+                ModelVersion.get_current_id(),
+                settings.ALERT_DEPTH_THRESHOLD,
+            ],
+        )
+        rows = cursor.fetchall()
+
+    summaries = defaultdict(list)
+    for alert_id, user_id, phone_number_id, *summary in rows:
+        summaries[(user_id, phone_number_id)].append((alert_id, *summary))
+    return summaries
+
+
+def get_depth_band(max_depth):
+    return bisect.bisect_right(sorted(settings.ALERT_CHANGE_DEPTHS), max_depth)
+
+
+def is_material_change(state, start_date, end_date, max_depth, now):
+    """Whether the flooding at a location has changed enough to alert about again"""
+    change = timedelta(days=settings.ALERT_CHANGE_DAYS)
+    if get_depth_band(max_depth) != state.depth_band:
+        return True
+    if abs(end_date - state.end_date) > change:
+        return True
+    # The start of flooding already under way moves with the alert period each day,
+    # so only compare starts of flooding yet to begin
+    if state.start_date > now and abs(start_date - state.start_date) > change:
+        return True
+    if settings.ALERT_REPEAT_DAYS and now - state.sent_at >= timedelta(
+        days=settings.ALERT_REPEAT_DAYS
+    ):
+        return True
+    return False
+
+
+def send_changed_alerts(start_date, end_date, alert_type=AlertType.SMS):
+    """
+    Send alerts to each user and phone number with a location where the forecast
+    flooding is new or has changed materially since they were last alerted about it,
+    and record what was sent for each location as it is sent.
+
+    :return: list of AlertDelivery records
+    """
+    now = timezone.now()
+    summaries = get_alert_summaries(start_date, end_date, alert_type)
+    states = {
+        state.alert_id: state
+        for state in AlertState.objects.filter(alert__alert_type=alert_type)
+    }
+
+    # Forget locations no longer forecast to flood, so they are alerted about again if
+    # flooding returns
+    AlertState.objects.filter(alert__alert_type=alert_type).exclude(
+        alert_id__in=[alert[0] for alerts in summaries.values() for alert in alerts]
+    ).delete()
+
+    messages = []
+    for (user_id, phone_number_id), alerts in summaries.items():
+        if all(
+            alert_id in states
+            and not is_material_change(states[alert_id], *summary, now)
+            for alert_id, *summary in alerts
+        ):
+            continue
+        message = format_message(
+            min(alert[1] for alert in alerts),
+            max(alert[2] for alert in alerts),
+            max(alert[3] for alert in alerts),
+        )
+        if message:
+            messages.append((user_id, phone_number_id, message))
+
+    # Record the flooding alerted about at each location as each alert is sent, so
+    # alerts already sent aren't repeated if the rest fail
+    phone_number_alerts = {
+        phone_number_id: alerts
+        for (user_id, phone_number_id), alerts in summaries.items()
+    }
+
+    def record_delivery(delivery):
+        if delivery.status != DeliveryStatus.SENT:
+            return
+        alerts = phone_number_alerts[delivery.phone_number_id]
+        with transaction.atomic():
+            AlertState.objects.filter(
+                alert_id__in=[alert[0] for alert in alerts]
+            ).delete()
+            AlertState.objects.bulk_create(
+                [
+                    AlertState(
+                        alert_id=alert_id,
+                        start_date=alert_start_date,
+                        end_date=alert_end_date,
+                        max_depth=max_depth,
+                        depth_band=get_depth_band(max_depth),
+                        sent_at=now,
+                    )
+                    for alert_id, alert_start_date, alert_end_date, max_depth in alerts
+                ]
+            )
+
+    return send_alert_messages(messages, alert_type, record_delivery)
@@ -1,26 +1,54 @@
 from datetime import timedelta
+import hashlib
 import logging
 
-from celery import Celery, shared_task
+from celery import Celery, chain, shared_task
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.gis.db.models import Extent
 from django.contrib.gis.geos import Polygon
-from django.db.models import Avg, Count, Max
+from django.db import connection, transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Floor
 from django.utils import timezone
 import numpy as np
 
-from .bulk_create_manager import BulkCreateUpdateManager
+from .bulk_create_manager import BulkCreateManager, BulkCreateUpdateManager
+from .grid import CentroidX, CentroidY
 from .models import (
     AggregatedDepthPrediction,
     DepthPrediction,
+    FloodExtent,
     FloodModelParameters,
+    FlowFingerprint,
     ModelVersion,
     PercentageFloodRisk,
+    PublishedRun,
     RiverFlowCalculationOutput,
 )
+from .rasters import export_depth_raster
+from .tiles import render_depth_tiles
 
 logger = logging.getLogger(__name__)
 
+# Depth fields averaged over the blocks of each aggregation level
+AGGREGATED_FIELDS = (
+    "median_depth",
+    "lower_centile",
+    "mid_lower_centile",
+    "upper_centile",
+)
+
+# Cache key for the risks shown on the home page, cleared when the risks are updated
+DAILY_RISKS_CACHE_KEY = "daily_risks"
+
+# Cache key for the most recently published run
+PUBLISHED_RUN_CACHE_KEY = "published_run"
+
+# Centiles of the river flow ensemble used to decide whether a forecast time has changed
+# since the last run. The min and max are included as predict_depth thresholds on them.
+FLOW_FINGERPRINT_CENTILES = (0, 10, 30, 50, 90, 100)
+
 
 def run_all_flood_models():
     # Run flood model over latest outputs from river flow
@@ -62,16 +90,37 @@ def run_flood_model_for_time(prediction_date, forecast_time):
     logger.info(f"Got river flow values: {flow_values}")
 
     latest_model_id = ModelVersion.get_current_id()
-    params = FloodModelParameters.objects.filter(model_version_id=latest_model_id).all()
 
-    if not len(params):
+    # Skip the whole forecast time if its flows haven't materially changed since the
+    # depths were last calculated: the stored predictions are keyed by forecast time and
+    # model version, so they carry forward to this run as they are
+    fingerprint = flow_fingerprint(flow_values)
+    previous = FlowFingerprint.objects.filter(
+        date=forecast_time, model_version_id=latest_model_id
+    ).first()
+    if previous and previous.fingerprint == fingerprint:
+        logger.info(
+            f"River flows for {forecast_time} unchanged since run of "
+            f"{previous.prediction_date}: keeping stored depth predictions"
+        )
+        return
+
+    if not FloodModelParameters.objects.filter(
+        model_version_id=latest_model_id
+    ).exists():
         raise Exception(
             "There are no catchment model parameters populated in the database"
         )
 
     # FIXME: this is slow (both with celery in batches of 1000, and running in series
     # (took several hours for 1 time))
-    predict_depths(forecast_time, [p.id for p in params], flow_values)
+    predict_depths(forecast_time, latest_model_id, flow_values)
+
+    FlowFingerprint.objects.update_or_create(
+        date=forecast_time,
+        model_version_id=latest_model_id,
+        defaults={"prediction_date": prediction_date, "fingerprint": fingerprint},
+    )
 
     # count the total number of processed pixels.
     total_pixel_count = DepthPrediction.objects.count()
@@ -82,6 +131,11 @@ def run_flood_model_for_time(prediction_date, forecast_time):
         )
     else:
         aggregate_flood_models(forecast_time)
+        build_flood_extents(forecast_time, latest_model_id)
+        chain(
+            export_depth_raster.si(prediction_date, forecast_time, latest_model_id),
+            render_depth_tiles.si(prediction_date, forecast_time),
+        ).delay()
     # batch_size = 1000
     # i = 0
     #
@@ -94,7 +148,7 @@ def run_flood_model_for_time(prediction_date, forecast_time):
 
 
 @shared_task(name="Predict depths for batch of cells")
-def predict_depths(forecast_time, param_ids, flow_values):
+def predict_depths(forecast_time, model_version_id, flow_values):
     bulk_mgr = BulkCreateUpdateManager(
         chunk_size=settings.DATABASE_CHUNK_SIZE,
         fields=(
@@ -106,63 +160,112 @@ def predict_depths(forecast_time, param_ids, flow_values):
         ),
     )
 
-    for i, param_id in enumerate(param_ids):
-        param = FloodModelParameters.objects.get(id=param_id)
-
-        (
-            lower_centile,
-            mid_lower_centile,
-            median,
-            upper_centile,
-        ) = predict_depth(flow_values, param)
-
-        # Replace current object if there is one
-        prediction = DepthPrediction.objects.filter(
-            date=forecast_time, parameters_id=param_id
-        ).first()
-
-        # logger.info(
-        #     f"type {type(param)}"
-        # )
-        # logger.info(
-        #   f"value {i} {param_id} {lower_centile} {mid_lower_centile} {median} {upper_centile}"
-        # )
-        # logger.info(f"prediction {prediction}")
-
-        if upper_centile <= 0:
-            if prediction:
-                # logger.info(f"DB delete")
-                prediction.delete()
-        else:
-            if not prediction:  # create:
-                # logger.info(f"DB add")
+    params = FloodModelParameters.objects.filter(
+        model_version_id=model_version_id
+    ).order_by("id")
+    total_count = params.count()
+    calculated_count = 0
+    unchanged_count = 0
+    dry_count = 0
+
+    # Work through the cells in chunks of consecutive ids, so neither the parameters
+    # nor the current predictions are all held in memory at once
+    last_id = 0
+    while True:
+        chunk = list(params.filter(id__gt=last_id)[: settings.DATABASE_CHUNK_SIZE])
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+
+        # Fetch the current predictions for the chunk in one query, so cells whose
+        # quantised depths are unchanged can be left alone rather than rewritten
+        existing = {
+            row[0]: row[1:]
+            for row in DepthPrediction.objects.filter(
+                date=forecast_time,
+                parameters__model_version_id=model_version_id,
+                parameters_id__gte=chunk[0].id,
+                parameters_id__lte=last_id,
+            ).values_list(
+                "parameters_id",
+                "id",
+                "model_version_id",
+                "lower_centile",
+                "mid_lower_centile",
+                "median_depth",
+                "upper_centile",
+            )
+        }
+        dry_prediction_ids = []
+
+        for param in chunk:
+            depths = predict_depth(flow_values, param)
+            (
+                lower_centile,
+                mid_lower_centile,
+                median,
+                upper_centile,
+            ) = depths
+
+            # Replace current object if there is one
+            prediction = existing.get(param.id)
+
+            if upper_centile <= 0:
+                if prediction:
+                    dry_prediction_ids.append(prediction[0])
+            elif not prediction:  # create:
                 bulk_mgr.add(
                     DepthPrediction(
                         date=forecast_time,
-                        parameters_id=param_id,
-                        model_version=param.model_version,
+                        parameters_id=param.id,
+                        model_version_id=param.model_version_id,
                         median_depth=median,
                         lower_centile=lower_centile,
                         mid_lower_centile=mid_lower_centile,
                         upper_centile=upper_centile,
                     )
                 )
-
+            elif prediction[1] == param.model_version_id and quantise_depths(
+                prediction[2:]
+            ) == quantise_depths(depths):
+                unchanged_count += 1
             else:  # update:
-                # logger.info(f"DB update")
-                prediction.model_version = param.model_version
-                prediction.median_depth = median
-                prediction.lower_centile = lower_centile
-                prediction.mid_lower_centile = mid_lower_centile
-                prediction.upper_centile = upper_centile
-                bulk_mgr.update(prediction)
-
-        if i % 1000 == 0:
-            logger.info(
-                f"Calculated {i} of {len(param_ids)} pixels ({(i / len(param_ids)) * 100 :.1f}%)"
-            )
+                bulk_mgr.update(
+                    DepthPrediction(
+                        id=prediction[0],
+                        model_version_id=param.model_version_id,
+                        median_depth=median,
+                        lower_centile=lower_centile,
+                        mid_lower_centile=mid_lower_centile,
+                        upper_centile=upper_centile,
+                    )
+                )
+
+        DepthPrediction.objects.filter(id__in=dry_prediction_ids).delete()
+        dry_count += len(dry_prediction_ids)
+        calculated_count += len(chunk)
+        logger.info(
+            f"Calculated {calculated_count} of {total_count} pixels "
+            f"({(calculated_count / total_count) * 100 :.1f}%)"
+        )
 
     bulk_mgr.done()
+    logger.info(f"Left {unchanged_count} unchanged predictions, removed {dry_count}")
+
+
+def flow_fingerprint(flow_values):
+    """
+    Summarise an ensemble of river flows as a hash of its quantised centiles, so that
+    forecast times whose flows have barely moved between runs can be detected.
+    """
+    centiles = np.percentile(flow_values, FLOW_FINGERPRINT_CENTILES)
+    quantised = np.round(centiles / settings.FLOW_QUANTISATION).astype(np.int64)
+    return hashlib.sha1(quantised.tobytes()).hexdigest()
+
+
+def quantise_depths(depths):
+    """Round depth centiles to DEPTH_QUANTISATION for comparison between runs"""
+    return tuple(round(d / settings.DEPTH_QUANTISATION) for d in depths)
 
 
 def predict_depth(flow_values, param):
@@ -213,83 +316,169 @@ def aggregate_flood_models(date):
             "Extent is None – no bounding box defined in Flood Model Parameters!"
         )
 
-    for i in [32, 64, 128, 256]:
-        aggregate_flood_models_by_size.delay(date, current_model_version_id, extent, i)
+    aggregate_flood_model_levels.delay(
+        date, current_model_version_id, extent, settings.AGGREGATION_LEVELS
+    )
 
 
-@shared_task(name="aggregate_flood_models_by_size")
-def aggregate_flood_models_by_size(date, model_version_id, extent, i):
-    logger.info(f"Aggregating for date {date} level {i}")
-    bulk_mgr = BulkCreateUpdateManager(
-        chunk_size=settings.DATABASE_CHUNK_SIZE,
-        fields=(
-            "model_version_id",
-            "median_depth",
-            "lower_centile",
-            "mid_lower_centile",
-            "upper_centile",
-            "aggregation_level",
-        ),
-    )
+@shared_task(name="aggregate_flood_model_levels")
+def aggregate_flood_model_levels(date, model_version_id, extent, levels):
+    """
+    Build the aggregation pyramid for a date. The finest level is grouped from the
+    depth predictions in one query; each coarser level is then built by merging 2x2
+    blocks of the level below, keeping sums and counts so the averages are exact.
+    """
+    levels = sorted(levels, reverse=True)
+    for finer, coarser in zip(levels, levels[1:]):
+        if finer != coarser * 2:
+            raise Exception(f"Aggregation levels must halve each time: got {levels}")
+
+    logger.info(f"Aggregating for date {date} levels {levels}")
+    bulk_mgr = BulkCreateManager(chunk_size=settings.DATABASE_CHUNK_SIZE)
 
     total_width = extent[2] - extent[0]
     total_height = extent[3] - extent[1]
-    block_size = min(total_height, total_width) / i
-
-    x = extent[0]
-    y = extent[1]
+    block_size = min(total_height, total_width) / levels[0]
+
+    # Sum all the cells in each block of the finest level in a single GROUP BY,
+    # assigning cells to the block containing their centre
+    blocks = np.array(
+        DepthPrediction.objects.filter(date=date, model_version_id=model_version_id)
+        .annotate(
+            block_x=Floor(
+                (CentroidX("parameters__bounding_box") - extent[0]) / block_size
+            ),
+            block_y=Floor(
+                (CentroidY("parameters__bounding_box") - extent[1]) / block_size
+            ),
+        )
+        .values_list("block_x", "block_y")
+        .annotate(
+            Count("id"),
+            *(Sum(field) for field in AGGREGATED_FIELDS),
+        ),
+        dtype=np.float64,
+    ).reshape(-1, 3 + len(AGGREGATED_FIELDS))
+    block_x = blocks[:, 0].astype(np.int64)
+    block_y = blocks[:, 1].astype(np.int64)
+    counts = blocks[:, 2].astype(np.int64)
+    sums = blocks[:, 3:]
+
+    # Replace any existing aggregations for this date
+    with transaction.atomic():
+        AggregatedDepthPrediction.objects.filter(
+            date=date, aggregation_level__in=levels
+        ).delete()
+
+        for level in levels:
+            if level != levels[0]:
+                block_size *= 2
+                block_x, block_y, counts, sums = merge_blocks(
+                    block_x, block_y, counts, sums
+                )
 
-    while y < extent[3]:
-        while x < extent[2]:
-            x_max = x + block_size
-            y_max = y + block_size
-            new_bb = Polygon.from_bbox((x, y, x_max, y_max))
+            averages = sums / counts[:, np.newaxis]
+            for x, y, count, values in zip(block_x, block_y, counts, averages):
+                x_min = extent[0] + x * block_size
+                y_min = extent[1] + y * block_size
+                bulk_mgr.add(
+                    AggregatedDepthPrediction(
+                        date=date,
+                        bounding_box=Polygon.from_bbox(
+                            (x_min, y_min, x_min + block_size, y_min + block_size)
+                        ),
+                        model_version_id=model_version_id,
+                        aggregation_level=level,
+                        cell_count=count,
+                        **dict(zip(AGGREGATED_FIELDS, values)),
+                    )
+                )
 
-            q = DepthPrediction.objects.filter(
-                date=date,
-                parameters__bounding_box__within=new_bb,
-                model_version_id=model_version_id,
-            )
-            values = q.aggregate(
-                Avg("median_depth"),
-                Avg("lower_centile"),
-                Avg("mid_lower_centile"),
-                Avg("upper_centile"),
-            )
+        bulk_mgr.done()
 
-            if values["median_depth__avg"]:
-                agg = AggregatedDepthPrediction.objects.filter(
-                    date=date, bounding_box=new_bb
-                ).first()
-
-                if not agg:
-                    bulk_mgr.add(
-                        AggregatedDepthPrediction(
-                            date=date,
-                            bounding_box=new_bb,
-                            model_version_id=model_version_id,
-                            median_depth=values["median_depth__avg"],
-                            lower_centile=values["lower_centile__avg"],
-                            mid_lower_centile=values["mid_lower_centile__avg"],
-                            upper_centile=values["upper_centile__avg"],
-                            aggregation_level=i,
-                        )
-                    )
-                else:
-                    agg.model_version_id = model_version_id
-                    agg.median_depth = values["median_depth__avg"]
-                    agg.lower_centile = values["lower_centile__avg"]
-                    agg.mid_lower_centile = values["mid_lower_centile__avg"]
-                    agg.upper_centile = values["upper_centile__avg"]
-                    agg.aggregation_level = i
-                    bulk_mgr.update(agg)
 
-            x += block_size
+def merge_blocks(block_x, block_y, counts, sums):
+    """
+    Merge each 2x2 set of blocks into one block of the next coarser level, adding up
+    their cell counts and sums.
+    """
+    keys, inverse = np.unique(
+        np.stack((block_x // 2, block_y // 2), axis=1), axis=0, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    merged_counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+    merged_sums = np.stack(
+        [
+            np.bincount(inverse, weights=sums[:, i], minlength=len(keys))
+            for i in range(sums.shape[1])
+        ],
+        axis=1,
+    ).reshape(len(keys), sums.shape[1])
+    return keys[:, 0], keys[:, 1], merged_counts.astype(np.int64), merged_sums
+
+
+def get_flood_extent_depths():
+    return sorted(set(settings.FLOOD_EXTENT_DEPTHS) | {settings.ALERT_DEPTH_THRESHOLD})
+
+
+@shared_task(name="Build flood extents")
+def build_flood_extents(date, model_version_id):
+    """
+    Outline the flooded areas at a date for each of the FLOOD_EXTENT_DEPTHS, replacing
+    any outlines from earlier runs. The cells outside the river channel with a 30th
+    centile depth of at least the band's depth are dissolved into simplified polygons,
+    each with the greatest median depth of its cells.
+    """
+    sql = f"""
+        WITH cells AS (
+            SELECT params.bounding_box, prediction.median_depth
+            FROM {DepthPrediction._meta.db_table} AS prediction
+            JOIN {FloodModelParameters._meta.db_table} AS params
+                ON prediction.parameters_id = params.id
+            WHERE prediction.date = %(date)s
+                AND prediction.model_version_id = %(model_version_id)s
+                AND prediction.mid_lower_centile >= %(min_depth)s
+                AND NOT params.in_channel
+        ),
+        outlines AS (
+            SELECT row_number() OVER () AS id, dumped.geom AS outline
+            FROM (SELECT ST_Union(bounding_box) AS geom FROM cells) AS merged,
+                ST_Dump(merged.geom) AS dumped
+        )
+        INSERT INTO {FloodExtent._meta.db_table}
+            (date, model_version_id, min_depth, max_depth, outline)
+        SELECT %(date)s, %(model_version_id)s, %(min_depth)s, MAX(cells.median_depth),
+            ST_SimplifyPreserveTopology(outlines.outline, %(tolerance)s)
+        FROM outlines
+        JOIN cells
+            ON ST_Within(ST_PointOnSurface(cells.bounding_box), outlines.outline)
+        GROUP BY outlines.id, outlines.outline
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        FloodExtent.objects.filter(date=date).delete()
+        for min_depth in get_flood_extent_depths():
+            cursor.execute(
+                sql,
+                {
+                    "date": date,
+                    "model_version_id": model_version_id,
+                    "min_depth": min_depth,
+                    "tolerance": settings.FLOOD_EXTENT_TOLERANCE,
+                },
+            )
+    logger.info(
+        f"Built {FloodExtent.objects.filter(date=date).count()} flood extents for {date}"
+    )
 
-        x = extent[0]
-        y += block_size
 
-    bulk_mgr.done()
+def rebuild_flood_extents():
+    """Rebuild the flood extents for every date, e.g. after the river channel changes"""
+    for date, model_version_id in (
+        FloodExtent.objects.values_list("date", "model_version_id")
+        .order_by()
+        .distinct()
+    ):
+        build_flood_extents(date, model_version_id)
 
 
 @shared_task(name="calculate_risk_percentages")
@@ -324,3 +513,29 @@ def calculate_risk_percentages():
         # Delete existing row for this date before creating new
         PercentageFloodRisk.objects.filter(date=p["date"]).delete()
         PercentageFloodRisk(date=p["date"], risk=risk).save()
+
+    # The risks are the last of the flood outputs to be updated
+    publish_run()
+
+
+def publish_run():
+    """
+    Record that the flood outputs for the latest river flow predictions are complete,
+    and clear the responses cached from the previous run.
+    """
+    latest = RiverFlowCalculationOutput.objects.aggregate(Max("prediction_date"))
+    prediction_date = latest["prediction_date__max"]
+    model_version_id = ModelVersion.get_current_id()
+
+    cache.delete(DAILY_RISKS_CACHE_KEY)
+    if prediction_date is None or model_version_id is None:
+        return None
+
+    run = PublishedRun.objects.create(
+        prediction_date=prediction_date, model_version_id=model_version_id
+    )
+    cache.set(PUBLISHED_RUN_CACHE_KEY, run, settings.PUBLISHED_RUN_CACHE_TIMEOUT)
+    logger.info(
+        f"Published run of {prediction_date} (model version {model_version_id})"
+    )
+    return run
@@ -1,16 +1,159 @@
-from urllib.request import urlretrieve
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+
 import pygrib
+import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from .models import NoaaForecast
 from django.contrib.gis.geos import Point
-from retrying import retry
 from django.conf import settings
-from tqdm import trange
+from django.db import transaction
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# GRIB messages read from each GEFS file, in the order GEFSdownloader returns their
+# values: (variable, level) in the file's inventory
+GEFS_MESSAGES = (
+    # metre relative humidity, unit:% (instant).
+    ("RH", "2 m above ground"),
+    # Maximum temperature: unit:K (max).
+    ("TMAX", "2 m above ground"),
+    # Minimum temperature: unit:K (min).
+    ("TMIN", "2 m above ground"),
+    # metre U wind component: unit:m/s (instant).
+    ("UGRD", "10 m above ground"),
+    # metre V wind component: unit:m/s (instant).
+    ("VGRD", "10 m above ground"),
+    # Total Precipitation: unit:kg/m2 (accum).
+    ("APCP", "surface"),
+)
+
+# Session shared by the download threads, so connections to the server are reused
+session = None
+sessionLock = threading.Lock()
+
+# Decode one GRIB file at a time, as the download threads may not share ecCodes safely
+gribLock = threading.Lock()
+
+
+class GEFSNotPublished(Exception):
+    """The GEFS file for a forecast hour hasn't been published on the server yet"""
+
+
+class GEFSDownloadStopped(Exception):
+    """A GEFS download was stopped while waiting to try again"""
+
+
+def getSession():
+    global session
+    with sessionLock:
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=settings.GEFS_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+
+def downloadGEFSHour(fileDate, forecastHour, latValue, lonValue, member, stop=None):
+    """
+    Download the GEFS data for a member and forecast hour with GEFSdownloader, retrying failed
+    downloads up to GEFS_RETRIES times with exponential backoff. A file that hasn't
+    been published yet is checked for every GEFS_PUBLISH_INTERVAL seconds, for up to
+    GEFS_PUBLISH_WAIT seconds.
+
+    :param stop: a threading.Event which, once set, stops the download waiting to try
+                 again and raises GEFSDownloadStopped.
+    """
+    stop = stop or threading.Event()
+
+    def wait(seconds):
+        if stop.wait(seconds):
+            raise GEFSDownloadStopped(
+                f"Stopped downloading GEFS {member} hour {forecastHour}"
+            )
+
+    deadline = time.monotonic() + settings.GEFS_PUBLISH_WAIT
+    errors = 0
+    while True:
+        try:
+            return GEFSdownloader(fileDate, forecastHour, latValue, lonValue, member)
+        except GEFSNotPublished as e:
+            if time.monotonic() + settings.GEFS_PUBLISH_INTERVAL > deadline:
+                raise
+            logger.info(f"{e} yet: checking again later")
+            wait(settings.GEFS_PUBLISH_INTERVAL)
+        except Exception as e:
+            errors += 1
+            if errors > settings.GEFS_RETRIES:
+                raise
+            delay = settings.GEFS_RETRY_BACKOFF * 2 ** (errors - 1)
+            logger.warning(
+                f"Unable to download GEFS {member} hour {forecastHour} ({e}): "
+                f"retrying in {delay}s"
+            )
+            wait(delay)
+
+
+def gefsCachePath(fileDate, forecastHour, latValue, lonValue, member):
+    """
+    Path of the values read from a GEFS file at a location in the local cache, named by
+    a hash of the forecast cycle date, member, forecast hour and location they are for.
+    """
+    key = f"{fileDate}/{member}/f{forecastHour:03}/{latValue},{lonValue}"
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return Path(settings.GEFS_CACHE_ROOT) / digest[:2] / f"{digest}.json"
+
+
+def loadGEFSHour(fileDate, forecastHour, latValue, lonValue, member, stop=None):
+    """
+    Get the GEFS data for a member and forecast hour from the local cache, or download
+    it with downloadGEFSHour (which stop is passed to) and add it to the cache if it
+    hasn't been downloaded before.
+    """
+    cachePath = gefsCachePath(fileDate, forecastHour, latValue, lonValue, member)
+    if cachePath.exists():
+        return tuple(json.loads(cachePath.read_text()))
+
+    gefsData = tuple(
+        float(value)
+        for value in downloadGEFSHour(
+            fileDate, forecastHour, latValue, lonValue, member, stop
+        )
+    )
 
-# if report error, retrying 72 times (6 hours), sleep 300 seconds (5 minutes) between attempts
-@retry(stop_max_attempt_number=72, wait_fixed=300)
-def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
+    # Write to a temporary file and move it into place, so an interrupted write
+    # doesn't leave a partial entry in the cache
+    cachePath.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cachePath.parent, suffix=".tmp", delete=False
+    ) as cacheFile:
+        json.dump(gefsData, cacheFile)
+    os.replace(cacheFile.name, cachePath)
+    return gefsData
+
+
+def pruneGEFSCache():
+    """Remove entries older than GEFS_CACHE_DAYS from the local cache"""
+    cutoff = time.time() - settings.GEFS_CACHE_DAYS * 24 * 60 * 60
+    for cachePath in Path(settings.GEFS_CACHE_ROOT).glob("*/*"):
+        if cachePath.stat().st_mtime < cutoff:
+            cachePath.unlink(missing_ok=True)
+
+
+def GEFSdownloader(fileDate, forecastHour, latValue, lonValue, member):
     """
     This script is developed to download files, read files, and export necessary data for generating river flows.
     Download from stp server:
@@ -32,6 +175,8 @@ def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
                     (the solution is 0.5 degree. range [-90, 90] with 0.5 interval)
     :param lonValue: the longtitue of the specific cell.
                     (the solution is 0.5 degree, range [-180, 180] with 0.5 interval)
+    :param member: the ensemble member, e.g. geavg for the ensemble mean, gec00 for the
+                   control or gep01 to gep30 for the perturbed members.
     :return: a tuple of values with GEFS data at the specific location and date.
                 0.Relative Humidity.
                 1.Maximum Temperature.
@@ -41,76 +186,119 @@ def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
                 5.Total Precipitation.
     """
 
-    # download GEFSdata from ftp server.
-    rootUrl = "https://ftp.ncep.noaa.gov/data/nccf/com/gens/prod/"
-    subUrl = "/00/atmos/pgrb2ap5/"
-    fileNameBase = "geavg.t00z.pgrb2a.0p50.f"
-    fileName = fileNameBase + (str(forecastHour)).zfill(3)
-    fullUrl = rootUrl + "gefs." + fileDate + subUrl + fileName
+    # download the necessary messages of the GEFS file from the server, reading the
+    # value at the location from each as it arrives.
+    fullUrl = gefsFileUrl(fileDate, forecastHour, member)
 
-    gefsFile = urlretrieve(fullUrl)
-    gefsData = pygrib.open(gefsFile[0])
+    values = {}
+    for key, message in downloadGEFSMessages(fullUrl):
+        values[key] = readGEFSMessage(message, latValue, lonValue)
 
-    # extract necessary data sets:
-    for grb in gefsData:
+    return tuple(values[key] for key in GEFS_MESSAGES)
 
-        # metre relative humidity, unit:% (instant).
-        if grb.parameterName == "Relative humidity" and grb.level == 2:
-            lats, lons = grb.latlons()
-            index = cellIndexFinder(
-                latitudeInfo=lats,
-                longitudeInfo=lons,
-                latValue=latValue,
-                lonValue=lonValue,
-            )
-            RHvalue = grb.values[index]
 
-        # Maximum temperature: unit:K (max).
-        elif grb.parameterName == "Maximum temperature" and grb.level == 2:
-            lats, lons = grb.latlons()
-            index = cellIndexFinder(
-                latitudeInfo=lats,
-                longitudeInfo=lons,
-                latValue=latValue,
-                lonValue=lonValue,
-            )
-            maxTempValue = grb.values[index]
+def gefsFileUrl(fileDate, forecastHour, member):
+    fileName = f"{member}.t00z.pgrb2a.0p50.f" + str(forecastHour).zfill(3)
+    return f"{settings.GEFS_BASE_URL}/gefs.{fileDate}/00/atmos/pgrb2ap5/{fileName}"
 
-        # Minimum temperature: unit:K (min).
-        elif grb.parameterName == "Minimum temperature" and grb.level == 2:
-            lats, lons = grb.latlons()
-            index = cellIndexFinder(
-                latitudeInfo=lats,
-                longitudeInfo=lons,
-                latValue=latValue,
-                lonValue=lonValue,
-            )
-            minTempValue = grb.values[index]
 
-        # metre U wind component: unit:m/s (instant).
-        elif grb.parameterName == "u-component of wind" and grb.level == 10:
-            lats, lons = grb.latlons()
-            index = cellIndexFinder(
-                latitudeInfo=lats,
-                longitudeInfo=lons,
-                latValue=latValue,
-                lonValue=lonValue,
-            )
-            uWindValue = grb.values[index]
+def readInventory(text):
+    """
+    Read a GRIB .idx inventory, which has a line for each message of the file, e.g.
+    "1:0:d=2022020100:HGT:10 mb:6 hour fcst:ENS=mean" for the first message.
 
-        # metre V wind component: unit:m/s (instant).
-        elif grb.parameterName == "v-component of wind" and grb.level == 10:
-            lats, lons = grb.latlons()
-            index = cellIndexFinder(
-                latitudeInfo=lats,
-                longitudeInfo=lons,
-                latValue=latValue,
-                lonValue=lonValue,
-            )
-            vWindValue = grb.values[index]
+    :return: a list of (start, end, variable, level) for each message, where start
+             and end are the positions of its first and last bytes (None for the end
+             of the file).
+    """
+    messages = []
+    for line in text.splitlines():
+        if line.strip():
+            fields = line.split(":")
+            messages.append([int(fields[1]), None, fields[3], fields[4]])
+
+    for message, following in zip(messages, messages[1:]):
+        message[1] = following[0] - 1
+
+    return [tuple(message) for message in messages]
+
+
+def messageRanges(inventory):
+    """
+    Find the byte ranges of the GEFS_MESSAGES in a GRIB file from its inventory,
+    joining adjacent messages into one range.
+
+    :return: a list of (start, end) byte positions, as in readInventory.
+    """
+    wanted = {(variable, level) for *_, variable, level in GEFS_MESSAGES}
+    found = set()
+    ranges = []
+    for start, end, variable, level in inventory:
+        if (variable, level) not in wanted:
+            continue
+        found.add((variable, level))
+        if ranges and ranges[-1][1] == start - 1:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    if found != wanted:
+        raise Exception(f"GEFS file inventory is missing {wanted - found}")
+
+    return ranges
+
+
+def downloadGEFSMessages(url):
+    """
+    Download only the GEFS_MESSAGES of a GRIB file, by reading the .idx inventory
+    alongside it and requesting their byte ranges. Each range is split into its
+    messages as it is downloaded, so only one range is held in memory at a time.
 
-        # Total Precipitation: unit:kg/m2 (accum).
-        elif grb.parameterName == "Total precipitation" and grb.level == 0:
+    :return: a generator of ((variable, level), message bytes) for each message.
+    """
+    session = getSession()
+    response = session.get(url + ".idx", timeout=settings.GEFS_TIMEOUT)
+    if response.status_code == 404:
+        raise GEFSNotPublished(f"{url} is not published")
+    response.raise_for_status()
+    inventory = readInventory(response.text)
+    wanted = set(GEFS_MESSAGES)
+
+    for start, end in messageRanges(inventory):
+        response = session.get(
+            url,
+            headers={"Range": f"bytes={start}-{'' if end is None else end}"},
+            timeout=settings.GEFS_TIMEOUT,
+        )
+        if response.status_code == 404:
+            raise GEFSNotPublished(f"{url} is not published")
+        response.raise_for_status()
+        content = response.content
+        # The whole file is sent if the server doesn't support ranges
+        if response.status_code != 206:
+            content = content[start : None if end is None else end + 1]
+
+        for messageStart, messageEnd, variable, level in inventory:
+            if (
+                (variable, level) in wanted
+                and start <= messageStart
+                and (end is None or messageStart <= end)
+            ):
+                yield (variable, level), content[
+                    messageStart - start : None
+                    if messageEnd is None
+                    else messageEnd + 1 - start
+                ]
+
+
+def readGEFSMessage(message, latValue, lonValue):
+    """
+    Decode a GRIB message from its bytes and read its value at a location.
+    """
+    with gribLock:
+        grb = pygrib.fromstring(message)
+        index = gridIndex(gridDefinition(grb), latValue, lonValue)
+        if index is None:
             lats, lons = grb.latlons()
             index = cellIndexFinder(
                 latitudeInfo=lats,
@@ -118,9 +306,51 @@ def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
                 latValue=latValue,
                 lonValue=lonValue,
             )
-            totalPrecipValue = grb.values[index]
+        return grb.values[index]
+
+
+def gridDefinition(grb):
+    """Get the keys defining the grid of a GRIB message, for use with gridIndex"""
+    return (grb["gridType"],) + tuple(
+        grb[key]
+        for key in (
+            "Ni",
+            "Nj",
+            "latitudeOfFirstGridPointInDegrees",
+            "longitudeOfFirstGridPointInDegrees",
+            "latitudeOfLastGridPointInDegrees",
+            "longitudeOfLastGridPointInDegrees",
+        )
+    )
 
-    return RHvalue, maxTempValue, minTempValue, uWindValue, vWindValue, totalPrecipValue
+
+@lru_cache(maxsize=32)
+def gridIndex(definition, latValue, lonValue):
+    """
+    Find the index of the cell nearest a location in a regular lat/lon grid, from
+    the grid definition alone, so it is only worked out once for each grid.
+
+    :param definition: the grid definition, from gridDefinition.
+    :param latValue: the latitude of the specific cell.
+    :param lonValue: the longitude of the specific cell.
+    :return: the (row, column) index of the cell, or None if the grid isn't a
+             regular lat/lon grid.
+    """
+    gridType, ni, nj, firstLat, firstLon, lastLat, lastLon = definition
+    if gridType != "regular_ll":
+        return None
+
+    latStep = (lastLat - firstLat) / (nj - 1)
+    lonStep = ((lastLon - firstLon) % 360) / (ni - 1)
+    row = round((latValue - firstLat) / latStep)
+    column = round(((lonValue - firstLon) % 360) / lonStep)
+    if math.isclose(lonStep * ni, 360):
+        # The nearest cell to the east of the last column of a global grid is the first
+        column %= ni
+    if not (0 <= row < nj and 0 <= column < ni):
+        raise Exception(f"Location ({latValue}, {lonValue}) is outside the GEFS grid")
+
+    return row, column
 
 
 def cellIndexFinder(latitudeInfo, longitudeInfo, latValue, lonValue):
@@ -142,17 +372,17 @@ def cellIndexFinder(latitudeInfo, longitudeInfo, latValue, lonValue):
     return index
 
 
-def prepareGEFS():
+def getGEFSForecastHours():
     """
-    This function is used to save data from gefs file into Database.
-    ( calculations_noaaforecast table).
+    Get the GEFS forecast hours to download, every MODEL_TIMESTEP days for
+    GEFS_FORECAST_DAYS days.
     """
 
     # calculate the number of time steps
     # For example: update interval: 0.25 day = 6 h.
     #              Number of Days into the future that the forecast is for
     #              16 days = 4 * 16 = 64 loop steps.
-    #  Therefore, the gefs files are:
+    #  Therefore, the gefs files for each member in GEFS_MEMBERS are:
     #  geavg.t00z.pgrb2a.0p50.f006 ---> geavg.t00z.pgrb2a.0p50.f384
 
     dt = float(settings.MODEL_TIMESTEP)  # time-step in days.
@@ -162,34 +392,87 @@ def prepareGEFS():
 
     loopRange = int(forecastDays / dt)
     deltaHour = int(24 * dt)
+    return [deltaHour + i * deltaHour for i in range(loopRange)]
+
+
+def isGEFSComplete(date):
+    """
+    Check whether the GEFS forecast for a date has been saved for every member in
+    GEFS_MEMBERS and every forecast hour.
+
+    :param date: the day of the forecast cycle, at 00:00 UTC.
+    """
+    saved = set(
+        NoaaForecast.objects.filter(
+            date=date, location=Point(settings.LAT_VALUE, settings.LON_VALUE)
+        ).values_list("member", "forecast_hour")
+    )
+    return all(
+        (member, forecastHour) in saved
+        for member in settings.GEFS_MEMBERS
+        for forecastHour in getGEFSForecastHours()
+    )
+
+
+def prepareGEFS():
+    """
+    This function is used to save data from gefs file into Database.
+    ( calculations_noaaforecast table).
+    """
 
     downloadDate = datetime.utcnow()  # download today's GEFS data.
     fileDate = downloadDate.strftime("%Y%m%d")
-    date = datetime.astimezone(downloadDate, tz=timezone(timedelta(hours=0)))
+    # readings are saved for the day of the forecast cycle, so reruns replace them
+    date = datetime(
+        downloadDate.year, downloadDate.month, downloadDate.day, tzinfo=timezone.utc
+    )
 
     # get the lat & lon value of studying cell
     latValue = settings.LAT_VALUE
     lonValue = settings.LON_VALUE
 
-    for i in trange(loopRange, desc="GEFS Download"):
-        forceastHour = deltaHour + i * deltaHour
+    forecastHours = getGEFSForecastHours()
+    pruneGEFSCache()
 
-        gefsData = GEFSdownloader(
-            fileDate=fileDate,
-            forecastHour=forceastHour,
-            latValue=latValue,
-            lonValue=lonValue,
-        )
+    # Download the forecast hours of every member in parallel. If any can't be
+    # downloaded, give up on the rest rather than save a partial forecast, stopping
+    # any downloads waiting to try again. Those already downloaded are in the local
+    # cache for the next attempt.
+    stop = threading.Event()
+    gefsData = {}
+    with ThreadPoolExecutor(max_workers=settings.GEFS_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                loadGEFSHour, fileDate, forecastHour, latValue, lonValue, member, stop
+            ): (member, forecastHour)
+            for forecastHour in forecastHours
+            for member in settings.GEFS_MEMBERS
+        }
+        try:
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="GEFS Download"
+            ):
+                gefsData[futures[future]] = future.result()
+        except BaseException:
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
 
-        gefsData = NoaaForecast(
-            location=Point(latValue, lonValue),
-            date=date,
-            precipitation=gefsData[5],
-            min_temperature=gefsData[2],
-            max_temperature=gefsData[1],
-            wind_u=gefsData[3],
-            wind_v=gefsData[4],
-            relative_humidity=gefsData[0],
-        )
-
-        gefsData.save()
+    # Save the whole forecast together
+    with transaction.atomic():
+        for (member, forecastHour), values in gefsData.items():
+            NoaaForecast.objects.update_or_create(
+                date=date,
+                location=Point(latValue, lonValue),
+                member=member,
+                forecast_hour=forecastHour,
+                defaults=dict(
+                    precipitation=values[5],
+                    min_temperature=values[2],
+                    max_temperature=values[1],
+                    wind_u=values[3],
+                    wind_v=values[4],
+                    relative_humidity=values[0],
+                ),
+            )
@@ -440,7 +440,9 @@ def prepareWeatherForecastData(predictionDate, location, dataSource="gefs", back
     # prepare weather forecast data for model.
     if dataSource == "gefs":
         endTime = startTime + timedelta(hours=23, minutes=59, seconds=59)
-        weatherData = NoaaForecast.objects.filter(date__range=(startTime, endTime))
+        weatherData = NoaaForecast.objects.filter(
+            date__range=(startTime, endTime), member=NoaaForecast.ENSEMBLE_MEAN
+        ).order_by("forecast_hour")
 
     elif dataSource == "zentra":
         endTime = startTime + timedelta(days=backDays)
@@ -478,6 +480,49 @@ def prepareWeatherForecastData(predictionDate, location, dataSource="gefs", back
     return weatherForecastData
 
 
+def prepareEnsembleForecastData(predictionDate, location):
+    """
+
+    This function is for extracting the GEFS data of every ensemble member for a date
+    and location from DB, and returning it as a Numpy array.
+
+    :param predictionDate: date information.
+    :param location: location information.
+    :return members: a list of the ensemble members, in the order of the array.
+    :return forecastHours: a list of the forecast hours, in the order of the array.
+    :return ensembleData: a numpy array of GEFS data indexed by (member, forecast hour,
+                          variable), with the variables in the same order as
+                          prepareWeatherForecastData. Missing readings are NaN.
+
+    """
+
+    startTime = datetime.astimezone(predictionDate, tz=timezone.utc)
+    endTime = startTime + timedelta(hours=23, minutes=59, seconds=59)
+    readings = NoaaForecast.objects.filter(
+        date__range=(startTime, endTime), location=location
+    ).values_list(
+        "member",
+        "forecast_hour",
+        "relative_humidity",
+        "max_temperature",
+        "min_temperature",
+        "wind_u",
+        "wind_v",
+        "precipitation",
+    )
+
+    members = sorted(set(readings.values_list("member", flat=True)))
+    forecastHours = sorted(set(readings.values_list("forecast_hour", flat=True)))
+    memberIndex = {member: i for i, member in enumerate(members)}
+    hourIndex = {forecastHour: i for i, forecastHour in enumerate(forecastHours)}
+
+    ensembleData = np.full((len(members), len(forecastHours), 6), np.nan)
+    for member, forecastHour, *values in readings.iterator():
+        ensembleData[memberIndex[member], hourIndex[forecastHour]] = values
+
+    return members, forecastHours, ensembleData
+
+
 def runningGenerateRiverFlows(
     predictionDate,
     dataLocation,
@@ -0,0 +1,90 @@
+from functools import lru_cache
+
+from django.contrib.gis.db.models import Extent
+from django.db.models import FloatField, Func
+import numpy as np
+
+from .models import FloodModelParameters
+
+
+class XMin(Func):
+    function = "ST_XMin"
+    output_field = FloatField()
+
+
+class YMin(Func):
+    function = "ST_YMin"
+    output_field = FloatField()
+
+
+class XMax(Func):
+    function = "ST_XMax"
+    output_field = FloatField()
+
+
+class YMax(Func):
+    function = "ST_YMax"
+    output_field = FloatField()
+
+
+class CentroidX(Func):
+    template = "ST_X(ST_Centroid(%(expressions)s))"
+    output_field = FloatField()
+
+
+class CentroidY(Func):
+    template = "ST_Y(ST_Centroid(%(expressions)s))"
+    output_field = FloatField()
+
+
+class FloodGrid:
+    """
+    The regular grid that the flood model parameter cells lie on.
+
+    Rows are counted down from the top (north) edge, following the raster convention,
+    so the grid can be written straight out as an image.
+    """
+
+    def __init__(self, x_min, y_min, x_max, y_max, cell_width, cell_height):
+        self.x_min = x_min
+        self.y_min = y_min
+        self.x_max = x_max
+        self.y_max = y_max
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.width = int(round((x_max - x_min) / cell_width))
+        self.height = int(round((y_max - y_min) / cell_height))
+
+    def column_row(self, x, y):
+        """Get the (column, row) indices of the cells containing the points x, y"""
+        columns = np.floor((np.asarray(x) - self.x_min) / self.cell_width)
+        rows = np.floor((self.y_max - np.asarray(y)) / self.cell_height)
+        return columns.astype(np.int64), rows.astype(np.int64)
+
+    def geo_transform(self):
+        """GDAL geotransform of the grid (top left corner, pixel size)"""
+        return (self.x_min, self.cell_width, 0, self.y_max, 0, -self.cell_height)
+
+    def block_size(self, aggregation_level):
+        """Size of the square blocks that aggregation_level splits the grid into"""
+        return min(self.x_max - self.x_min, self.y_max - self.y_min) / aggregation_level
+
+
+@lru_cache(maxsize=8)
+def get_flood_grid(model_version_id):
+    """Get the FloodGrid for the parameters of a model version"""
+    params = FloodModelParameters.objects.filter(model_version_id=model_version_id)
+    extent = params.aggregate(Extent("bounding_box"))["bounding_box__extent"]
+
+    if extent is None:
+        raise Exception(
+            "Extent is None – no bounding box defined in Flood Model Parameters!"
+        )
+
+    cell = params.values_list(
+        XMin("bounding_box"),
+        YMin("bounding_box"),
+        XMax("bounding_box"),
+        YMax("bounding_box"),
+    ).first()
+    return FloodGrid(*extent, cell[2] - cell[0], cell[3] - cell[1])
@@ -0,0 +1,44 @@
+# Generated by Django 4.1.3 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0003_riverchannel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FlowFingerprint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateTimeField()),
+                ("prediction_date", models.DateTimeField()),
+                ("fingerprint", models.CharField(max_length=40)),
+                (
+                    "model_version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="calculations.modelversion",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="flowfingerprint",
+            constraint=models.UniqueConstraint(
+                fields=("date", "model_version"), name="unique_flow_fingerprint"
+            ),
+        ),
+    ]
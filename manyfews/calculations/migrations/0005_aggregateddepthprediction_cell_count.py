@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0004_flowfingerprint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aggregateddepthprediction",
+            name="cell_count",
+            field=models.IntegerField(default=0),
+        ),
+    ]
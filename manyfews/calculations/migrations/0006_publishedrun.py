@@ -0,0 +1,37 @@
+# Generated by Django 4.1.3 on 2026-10-19 12:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0005_aggregateddepthprediction_cell_count"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PublishedRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("prediction_date", models.DateTimeField()),
+                ("published_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "model_version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="calculations.modelversion",
+                    ),
+                ),
+            ],
+        ),
+    ]
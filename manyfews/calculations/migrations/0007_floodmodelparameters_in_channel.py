@@ -0,0 +1,33 @@
+# Generated by Django 4.1.3 on 2026-10-19 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0006_publishedrun"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="floodmodelparameters",
+            name="in_channel",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE calculations_floodmodelparameters AS params
+            SET in_channel = COALESCE(
+                channel.geom && params.bounding_box
+                AND ST_CoveredBy(params.bounding_box, channel.geom),
+                false
+            )
+            FROM (
+                SELECT ST_Union(ST_Buffer(channel_location, 0)) AS geom
+                FROM calculations_riverchannel
+            ) AS channel
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
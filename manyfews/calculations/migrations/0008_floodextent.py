@@ -0,0 +1,51 @@
+# Generated by Django 4.1.3 on 2026-10-19 14:40
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0007_floodmodelparameters_in_channel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FloodExtent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateTimeField()),
+                ("min_depth", models.FloatField()),
+                ("max_depth", models.FloatField()),
+                (
+                    "outline",
+                    django.contrib.gis.db.models.fields.PolygonField(srid=4326),
+                ),
+                (
+                    "model_version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="calculations.modelversion",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["date", "min_depth"],
+                        name="calculation_date_0ed3a3_idx",
+                    )
+                ],
+            },
+        ),
+    ]
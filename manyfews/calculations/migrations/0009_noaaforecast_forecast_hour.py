@@ -0,0 +1,45 @@
+# Generated by Django 4.1.3 on 2026-10-19 16:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_forecast_hours(apps, schema_editor):
+    # Each download saved its forecast hours in order with the same date, so number
+    # them from the first forecast hour
+    NoaaForecast = apps.get_model("calculations", "NoaaForecast")
+    delta_hour = int(24 * float(settings.MODEL_TIMESTEP))
+    previous = None
+    forecasts = []
+    for forecast in NoaaForecast.objects.order_by("date", "id"):
+        key = (forecast.date, forecast.location.coords)
+        hour = hour + delta_hour if key == previous else delta_hour
+        previous = key
+        forecast.forecast_hour = hour
+        forecasts.append(forecast)
+    NoaaForecast.objects.bulk_update(
+        forecasts, ["forecast_hour"], batch_size=settings.DATABASE_CHUNK_SIZE
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0008_floodextent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="noaaforecast",
+            name="forecast_hour",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(number_forecast_hours, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="noaaforecast",
+            constraint=models.UniqueConstraint(
+                fields=("date", "location", "forecast_hour"),
+                name="unique_noaa_forecast_hour",
+            ),
+        ),
+    ]
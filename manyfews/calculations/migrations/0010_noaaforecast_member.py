@@ -0,0 +1,29 @@
+# Generated by Django 4.1.3 on 2026-10-19 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0009_noaaforecast_forecast_hour"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="noaaforecast",
+            name="unique_noaa_forecast_hour",
+        ),
+        migrations.AddField(
+            model_name="noaaforecast",
+            name="member",
+            field=models.CharField(default="geavg", max_length=5),
+        ),
+        migrations.AddConstraint(
+            model_name="noaaforecast",
+            constraint=models.UniqueConstraint(
+                fields=("date", "location", "member", "forecast_hour"),
+                name="unique_noaa_forecast_member_hour",
+            ),
+        ),
+    ]
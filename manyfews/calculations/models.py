@@ -1,3 +1,4 @@
+from django.db import connection
 from django.db.models import Max
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import MultiPolygon, Point, Polygon
@@ -70,7 +71,21 @@ class WeatherReading(models.Model):
 
 
 class NoaaForecast(WeatherReading):
-    pass
+    # GEFS ensemble member of the ensemble mean
+    ENSEMBLE_MEAN = "geavg"
+
+    # date is the day of the GEFS forecast cycle, and forecast_hour the number of hours
+    # after it that the reading is forecast for by the ensemble member
+    member = models.CharField(max_length=5, default=ENSEMBLE_MEAN)
+    forecast_hour = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "location", "member", "forecast_hour"],
+                name="unique_noaa_forecast_member_hour",
+            )
+        ]
 
 
 class AggregatedZentraReading(WeatherReading):
@@ -118,11 +133,67 @@ class FloodModelParameters(models.Model):
     beta10 = models.FloatField(null=True)
     beta11 = models.FloatField(null=True)
     beta12 = models.FloatField(null=True)
+    # Whether the cell is covered by the river channel, so isn't used for alerts
+    in_channel = models.BooleanField(default=False)
+
+    @staticmethod
+    def update_in_channel(model_version_id=None):
+        """Set in_channel for all parameters (or a model version's) from the river channels"""
+        sql = f"""
+            UPDATE {FloodModelParameters._meta.db_table} AS params
+            SET in_channel = COALESCE(
+                channel.geom && params.bounding_box
+                AND ST_CoveredBy(params.bounding_box, channel.geom),
+                false
+            )
+            FROM (
+                SELECT ST_Union(ST_Buffer(channel_location, 0)) AS geom
+                FROM {RiverChannel._meta.db_table}
+            ) AS channel
+        """
+        params = []
+        if model_version_id is not None:
+            sql += " WHERE params.model_version_id = %s"
+            params.append(model_version_id)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+class FlowFingerprint(models.Model):
+    # Summary of the river flows the depths for a forecast time were last calculated from
+    date = models.DateTimeField()
+    model_version = models.ForeignKey(ModelVersion, on_delete=models.CASCADE)
+    prediction_date = models.DateTimeField()
+    fingerprint = models.CharField(max_length=40)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "model_version"], name="unique_flow_fingerprint"
+            )
+        ]
 
 
 class RiverChannel(models.Model):
     channel_location = models.MultiPolygonField(default=MultiPolygon())
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        RiverChannel.update_parameters()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        RiverChannel.update_parameters()
+        return result
+
+    @staticmethod
+    def update_parameters():
+        """Update the cells in the channel, and the flood extents excluding them"""
+        from .flood_risk import rebuild_flood_extents
+
+        FloodModelParameters.update_in_channel()
+        rebuild_flood_extents()
+
 
 class AbstractDepthPrediction(models.Model):
     date = models.DateTimeField()
@@ -146,6 +217,33 @@ class DepthPrediction(AbstractDepthPrediction):
 class AggregatedDepthPrediction(AbstractDepthPrediction):
     bounding_box = models.PolygonField(default=Polygon.from_bbox((0, 0, 1, 1)))
     aggregation_level = models.IntegerField()
+    # Number of depth predictions averaged into this block
+    cell_count = models.IntegerField(default=0)
+
+
+class FloodExtent(models.Model):
+    # Simplified outline of adjoining cells outside the river channel with a 30th
+    # centile depth of at least min_depth, and the greatest median depth within it
+    date = models.DateTimeField()
+    model_version = models.ForeignKey(ModelVersion, on_delete=models.CASCADE)
+    min_depth = models.FloatField()
+    max_depth = models.FloatField()
+    outline = models.PolygonField()
+
+    class Meta:
+        indexes = [models.Index(fields=["date", "min_depth"])]
+
+
+class PublishedRun(models.Model):
+    # Marks the flood outputs of a forecast run as complete, so that responses built
+    # from them can be cached until the next run is published
+    prediction_date = models.DateTimeField()
+    model_version = models.ForeignKey(ModelVersion, on_delete=models.CASCADE)
+    published_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def get_latest():
+        return PublishedRun.objects.order_by("-id").first()
 
 
 class PercentageFloodRisk(models.Model):
@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+import logging
+import os
+from pathlib import Path
+
+from celery import shared_task
+from django.conf import settings
+import numpy as np
+from osgeo import gdal, osr
+
+from .grid import CentroidX, CentroidY, get_flood_grid
+from .models import DepthPrediction
+
+logger = logging.getLogger(__name__)
+
+gdal.UseExceptions()
+
+# Bands written to each depth raster, in order
+DEPTH_BANDS = ("median_depth", "lower_centile", "mid_lower_centile", "upper_centile")
+
+COG_OPTIONS = ["COMPRESS=DEFLATE", "PREDICTOR=YES", "BLOCKSIZE=256"]
+
+
+def depth_raster_path(prediction_date, forecast_time):
+    """Path of the depth raster for a forecast time from the run on prediction_date"""
+    return Path(settings.RASTER_ROOT).joinpath(
+        prediction_date.strftime("%Y%m%d"), forecast_time.strftime("%Y%m%dT%H%M.tif")
+    )
+
+
+def find_depth_raster(forecast_time):
+    """
+    Find the most recent depth raster for a forecast time. Runs whose flows were
+    unchanged for a forecast time don't write a new raster, so this may come from an
+    earlier run.
+    """
+    file_name = forecast_time.strftime("%Y%m%dT%H%M.tif")
+    root = Path(settings.RASTER_ROOT)
+    if not root.exists():
+        return None
+
+    for run_dir in sorted(root.iterdir(), reverse=True):
+        path = run_dir.joinpath(file_name)
+        if path.exists():
+            return path
+
+    return None
+
+
+def prune_depth_rasters():
+    """
+    Delete the depth rasters for forecast times before today, and those replaced by a
+    raster for the same forecast time from a later run, then any emptied run
+    directories, so only the rasters find_depth_raster can return are kept.
+    """
+    root = Path(settings.RASTER_ROOT)
+    if not root.exists():
+        return
+
+    today = datetime.now(timezone.utc).strftime("%Y%m%d")
+    latest = set()
+    for run_dir in sorted(root.iterdir(), reverse=True):
+        if not run_dir.is_dir():
+            continue
+        for path in run_dir.glob("*.tif"):
+            if path.name < today or path.name in latest:
+                path.unlink(missing_ok=True)
+            else:
+                latest.add(path.name)
+        if not any(run_dir.iterdir()):
+            try:
+                run_dir.rmdir()
+            except OSError:
+                # A raster for a new run is being written to it
+                pass
+
+
+def write_depth_raster(path, grid, x, y, depths):
+    """
+    Write depths at the cell centres x, y to a Cloud-Optimized GeoTIFF with one band
+    per column of depths. Cells without a prediction are written as 0 (no flood).
+    """
+    data = np.zeros((len(DEPTH_BANDS), grid.height, grid.width), dtype=np.float32)
+    columns, rows = grid.column_row(x, y)
+    data[:, rows, columns] = np.asarray(depths, dtype=np.float32).T
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", grid.width, grid.height, len(DEPTH_BANDS), gdal.GDT_Float32
+    )
+    dataset.SetGeoTransform(grid.geo_transform())
+    dataset.SetProjection(srs.ExportToWkt())
+    for i, name in enumerate(DEPTH_BANDS):
+        band = dataset.GetRasterBand(i + 1)
+        band.WriteArray(data[i])
+        band.SetDescription(name)
+        band.SetNoDataValue(0)
+
+    # Write alongside and rename, so readers never see a partially written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    gdal.GetDriverByName("COG").CreateCopy(str(temp_path), dataset, options=COG_OPTIONS)
+    os.replace(temp_path, path)
+
+
+@shared_task(name="Export depth raster")
+def export_depth_raster(prediction_date, forecast_time, model_version_id):
+    logger.info(f"Writing depth raster for {forecast_time}")
+    grid = get_flood_grid(model_version_id)
+    cells = np.array(
+        DepthPrediction.objects.filter(
+            date=forecast_time, model_version_id=model_version_id
+        ).values_list(
+            CentroidX("parameters__bounding_box"),
+            CentroidY("parameters__bounding_box"),
+            *DEPTH_BANDS,
+        ),
+        dtype=np.float64,
+    ).reshape(-1, 2 + len(DEPTH_BANDS))
+
+    path = depth_raster_path(prediction_date, forecast_time)
+    write_depth_raster(path, grid, cells[:, 0], cells[:, 1], cells[:, 2:])
+    logger.info(f"Wrote {len(cells)} cells to {path}")
+
+    prune_depth_rasters()
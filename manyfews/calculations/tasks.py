@@ -3,18 +3,23 @@ import csv
 from celery import Celery, shared_task
 
 from django.conf import settings
-from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.geos import Polygon
 
 import numpy as np
 from tqdm import tqdm, trange
 
-from webapp.models import UserAlert, UserPhoneNumber, AlertType
+from webapp.models import AlertType
+from webapp.tasks import warm_caches
 from zentra.api import ZentraToken
 
-from .alerts import send_phone_alerts_for_user
+from .alerts import (
+    get_alert_period,
+    send_changed_alerts,
+    send_phone_alerts_for_user,
+)
 from .bulk_create_manager import BulkCreateManager
 from .flood_risk import run_all_flood_models, calculate_risk_percentages
-from .gefs import prepareGEFS
+from .gefs import isGEFSComplete, prepareGEFS
 from .generate_river_flows import (
     prepareWeatherForecastData,
     runningGenerateRiverFlows,
@@ -24,7 +29,6 @@ from .models import (
     FloodModelParameters,
     InitialCondition,
     ModelVersion,
-    NoaaForecast,
     ZentraDevice,
 )
 from .zentra import prepareZentra, offsetTime
@@ -189,10 +193,8 @@ def dailyModelUpdate():
 
     ## part 2
     # Put together all of the time series from GEFS
-    gefsData = NoaaForecast.objects.filter(date__range=(today[0], today[1]))
-
-    if len(gefsData) == 0:
-        # Check whether GEFS data has been downloaded
+    if not isGEFSComplete(today[0]):
+        # Download any GEFS data missing from an earlier attempt
         prepareGEFS()
 
     weatherForecastData = prepareWeatherForecastData(
@@ -220,6 +222,9 @@ def run_flood_model():
 def calculate_percentage_risk():
     calculate_risk_percentages()
 
+    # Fill the caches for the newly published run, on the cache warming queue
+    warm_caches.delay()
+
 
 @shared_task(name="Send user SMS alerts")
 def send_user_sms_alerts(user_id, phone_number_id):
@@ -229,16 +234,10 @@ def send_user_sms_alerts(user_id, phone_number_id):
 @shared_task(name="Send all alerts")
 def send_alerts():
     # Get and send SMS alerts
-    # Group by user and phone number, so we can send alerts for multiple locations at once
-    sms_alerts = (
-        UserAlert.objects.filter(verified=True, alert_type=AlertType.SMS)
-        .values("user_id", "phone_number")
-        .distinct()
-    )
-    for alert_details in sms_alerts:
-        result = send_user_sms_alerts.delay(
-            alert_details["user_id"], alert_details["phone_number"]
-        )
+    # Find the flooding for all users and phone numbers at once, and send alerts where
+    # it has changed together, so they share the dispatcher's connections and rate limit
+    start_date, end_date = get_alert_period()
+    send_changed_alerts(start_date, end_date, alert_type=AlertType.SMS)
 
 
 @shared_task(name="Load parameters", bind=True)
@@ -300,6 +299,9 @@ def load_params_from_csv(self, filename, model_version_id):
 
     logger.info("Saved model parameters.")
 
+    FloodModelParameters.update_in_channel(model_version_id)
+    logger.info("Marked model parameters in the river channel")
+
     # Clean up old parameters from db
     current_model_version_id = ModelVersion.get_current_id()
     FloodModelParameters.objects.exclude(
@@ -1,18 +1,55 @@
 from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
+import re
+import threading
+from pathlib import Path
+import tempfile
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import MultiPolygon, Point, Polygon
 from django.test import TestCase
 import numpy as np
+from osgeo import gdal
 import xlrd
 from unittest import mock
 
-from webapp.models import UserAlert, UserPhoneNumber, AlertType
-from .alerts import send_phone_alerts_for_user
-from .flood_risk import predict_depth
+from webapp.models import (
+    AlertDelivery,
+    AlertState,
+    AlertType,
+    DeliveryStatus,
+    UserAlert,
+    UserPhoneNumber,
+)
+from .alerts import is_material_change, send_phone_alerts_for_user
+from .flood_risk import (
+    aggregate_flood_model_levels,
+    build_flood_extents,
+    flow_fingerprint,
+    merge_blocks,
+    predict_depth,
+    predict_depths,
+)
+from .gefs import (
+    GEFSDownloadStopped,
+    GEFSNotPublished,
+    GEFSdownloader,
+    cellIndexFinder,
+    downloadGEFSHour,
+    gridIndex,
+    isGEFSComplete,
+    messageRanges,
+    prepareGEFS,
+    readInventory,
+)
+from .generate_river_flows import prepareEnsembleForecastData
+from .grid import FloodGrid
 from .models import (
+    AggregatedDepthPrediction,
     DepthPrediction,
+    FloodExtent,
     FloodModelParameters,
     ModelVersion,
     RiverChannel,
@@ -24,6 +61,19 @@ from .models import (
     RiverFlowPrediction,
     RiverFlowCalculationOutput,
 )
+from .rasters import (
+    DEPTH_BANDS,
+    find_depth_raster,
+    prune_depth_rasters,
+    write_depth_raster,
+)
+from .tiles import (
+    colour_depths,
+    lon_lat_to_tile,
+    render_tiles,
+    tile_bounds,
+    update_tile_manifest,
+)
 from .tasks import initialModelSetUp, dailyModelUpdate, send_alerts
 from .zentra import offsetTime
 
@@ -92,6 +142,7 @@ def prepare_test_Data():
         testGefsData = NoaaForecast(
             date=date,
             location=testLocation,
+            forecast_hour=(i + 1) * 6,
             relative_humidity=gefsData[i, 0],
             min_temperature=gefsData[i, 2],
             max_temperature=gefsData[i, 1],
@@ -169,6 +220,227 @@ class taskTest(TestCase):
         assert len(initialCondition) == 200
 
 
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    # Serves the server's files by path, supporting single byte range requests
+    def do_GET(self):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+
+        self.server.ranges.append(self.headers.get("Range"))
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = int(match[2]) if match[2] else len(content) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+            content = content[start : end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GEFSTests(TestCase):
+    # Inventory of a GEFS file with the messages read out of order, between others
+    INVENTORY = """1:0:d=2022020100:HGT:10 mb:6 hour fcst:ENS=mean
+2:100:d=2022020100:RH:2 m above ground:6 hour fcst:ENS=mean
+3:250:d=2022020100:TMAX:2 m above ground:0-6 hour max fcst:ENS=mean
+4:300:d=2022020100:TMIN:2 m above ground:0-6 hour min fcst:ENS=mean
+5:420:d=2022020100:TMP:2 m above ground:6 hour fcst:ENS=mean
+6:500:d=2022020100:UGRD:10 m above ground:6 hour fcst:ENS=mean
+7:640:d=2022020100:VGRD:10 m above ground:6 hour fcst:ENS=mean
+8:700:d=2022020100:PRES:surface:6 hour fcst:ENS=mean
+9:800:d=2022020100:APCP:surface:0-6 hour acc fcst:ENS=mean
+"""
+
+    def test_message_ranges(self):
+        inventory = readInventory(self.INVENTORY)
+        assert inventory[0] == (0, 99, "HGT", "10 mb")
+        assert inventory[-1] == (800, None, "APCP", "surface")
+        assert messageRanges(inventory) == [(100, 419), (500, 699), (800, None)]
+
+        with self.assertRaises(Exception):
+            messageRanges(inventory[:-1])
+
+    @mock.patch("calculations.gefs.readGEFSMessage")
+    def test_download_gefs_messages(self, read_mock):
+        # Serve a GEFS member's file and its inventory from a local server
+        content = bytes(i % 251 for i in range(1000))
+        path = "/gefs.20220201/00/atmos/pgrb2ap5/gep01.t00z.pgrb2a.0p50.f006"
+        server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        server.files = {path: content, path + ".idx": self.INVENTORY.encode()}
+        server.ranges = []
+        host, port = server.server_address
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        read_mock.side_effect = lambda message, latValue, lonValue: len(message)
+        try:
+            with self.settings(GEFS_BASE_URL=f"http://{host}:{port}"):
+                values = GEFSdownloader("20220201", 6, -7, 107.5, "gep01")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Only the byte ranges of the messages read are downloaded, and each message
+        # is decoded on its own
+        assert server.ranges == [None, "bytes=100-419", "bytes=500-699", "bytes=800-"]
+        assert [c[0][0] for c in read_mock.call_args_list] == [
+            content[100:250],
+            content[250:300],
+            content[300:420],
+            content[500:640],
+            content[640:700],
+            content[800:],
+        ]
+        assert read_mock.call_args[0][1:] == (-7, 107.5)
+        assert values == (150, 50, 120, 140, 60, 200)
+
+    @mock.patch("calculations.gefs.GEFSdownloader")
+    def test_download_gefs_hour(self, downloader_mock):
+        values = (1, 2, 3, 4, 5, 6)
+        stop = mock.Mock()
+        stop.wait.return_value = False
+        retry_settings = dict(
+            GEFS_RETRIES=2,
+            GEFS_RETRY_BACKOFF=2,
+            GEFS_PUBLISH_INTERVAL=300,
+            GEFS_PUBLISH_WAIT=3600,
+        )
+
+        # Unpublished files are checked for at the publishing interval, and failed
+        # downloads retried with exponential backoff
+        downloader_mock.side_effect = [
+            GEFSNotPublished("Not published"),
+            GEFSNotPublished("Not published"),
+            Exception("Server error"),
+            Exception("Server error"),
+            values,
+        ]
+        with self.settings(**retry_settings):
+            assert downloadGEFSHour("20220201", 6, -7, 107.5, "geavg", stop) == values
+        assert [c[0][0] for c in stop.wait.call_args_list] == [300, 300, 2, 4]
+        downloader_mock.assert_called_with("20220201", 6, -7, 107.5, "geavg")
+
+        # Failures are raised once the retries are used up
+        stop.reset_mock()
+        downloader_mock.side_effect = Exception("Server error")
+        with self.settings(**retry_settings), self.assertRaises(Exception):
+            downloadGEFSHour("20220201", 6, -7, 107.5, "geavg", stop)
+        assert downloader_mock.call_count == 8
+        assert stop.wait.call_count == 2
+
+        # Once stopped, a download waiting to try again gives up
+        downloader_mock.reset_mock()
+        downloader_mock.side_effect = GEFSNotPublished("Not published")
+        stopped = threading.Event()
+        stopped.set()
+        with self.settings(**retry_settings):
+            with self.assertRaises(GEFSDownloadStopped):
+                downloadGEFSHour("20220201", 6, -7, 107.5, "geavg", stopped)
+        downloader_mock.assert_called_once()
+
+        # A file still unpublished after waiting is given up on
+        downloader_mock.side_effect = GEFSNotPublished("Not published")
+        with self.settings(**retry_settings, GEFS_PUBLISH_WAIT=0):
+            with self.assertRaises(GEFSNotPublished):
+                downloadGEFSHour("20220201", 6, -7, 107.5, "geavg")
+
+    @mock.patch("calculations.gefs.downloadGEFSHour")
+    def test_prepare_gefs(self, download_mock):
+        failing = {("gep01", 30)}
+        stops = set()
+
+        def download_gefs_hour(fileDate, forecastHour, lat, lon, member, stop):
+            stops.add(stop)
+            if (member, forecastHour) in failing:
+                raise Exception("Server error")
+            return forecastHour, 2, 1, 3, 4, int(member[-2:])
+
+        def downloaded():
+            return {(c[0][4], c[0][1]) for c in download_mock.call_args_list}
+
+        def saved():
+            return set(NoaaForecast.objects.values_list("member", "forecast_hour"))
+
+        download_mock.side_effect = download_gefs_hour
+        NoaaForecast.objects.all().delete()
+        hours = [6, 12, 18, 24, 30, 36, 42, 48]
+        members = ["gec00", "gep01"]
+        files = {(member, hour) for member in members for hour in hours}
+        with tempfile.TemporaryDirectory() as cacheDir, self.settings(
+            MODEL_TIMESTEP=0.25,
+            GEFS_FORECAST_DAYS=2,
+            GEFS_MEMBERS=members,
+            GEFS_WORKERS=4,
+            GEFS_CACHE_ROOT=cacheDir,
+        ):
+            # A forecast hour failing to download stops any of the forecast being saved
+            date = datetime.utcnow().replace(
+                hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc
+            )
+            with self.assertRaises(Exception):
+                prepareGEFS()
+            assert saved() == set()
+            assert not isGEFSComplete(date)
+            # Downloads still waiting to try again are stopped
+            assert all(stop.is_set() for stop in stops)
+            cached = downloaded() - failing
+
+            # Rerunning only downloads the files not already cached, and saves every
+            # member's forecast hours once
+            failing.clear()
+            download_mock.reset_mock()
+            prepareGEFS()
+            assert downloaded() == files - cached
+            assert saved() == files
+            assert NoaaForecast.objects.filter(date=date).count() == len(files)
+            assert isGEFSComplete(date)
+
+            # Everything is cached after a complete run
+            download_mock.reset_mock()
+            prepareGEFS()
+            download_mock.assert_not_called()
+            assert NoaaForecast.objects.count() == len(files)
+
+        # The members' readings load as a (member, time, variable) array
+        location = Point(settings.LAT_VALUE, settings.LON_VALUE)
+        NoaaForecast.objects.filter(member="gec00", forecast_hour=48).delete()
+        loadedMembers, loadedHours, ensembleData = prepareEnsembleForecastData(
+            date, location
+        )
+        assert loadedMembers == members
+        assert loadedHours == hours
+        assert ensembleData.shape == (2, 8, 6)
+        assert list(ensembleData[1, :, 0]) == hours
+        assert list(ensembleData[:, 0, 5]) == [0, 1]
+        assert np.isnan(ensembleData[0, -1]).all()
+
+    def test_grid_index(self):
+        # Global 0.5 degree grid, as in the GEFS pgrb2a.0p50 files
+        definition = ("regular_ll", 720, 361, 90.0, 0.0, -90.0, 359.5)
+        lons, lats = np.meshgrid(np.arange(0, 360, 0.5), np.arange(90, -90.5, -0.5))
+        for lat, lon in ((-7, 107.5), (90, 0), (-90, 359.5), (12.5, 175)):
+            assert gridIndex(definition, lat, lon) == cellIndexFinder(
+                latitudeInfo=lats, longitudeInfo=lons, latValue=lat, lonValue=lon
+            )
+
+        # Nearest cell, with longitudes west of 0 wrapped around
+        assert gridIndex(definition, -7.05, 107.74) == (194, 215)
+        assert gridIndex(definition, 0, -172.5) == (180, 375)
+        assert gridIndex(definition, 0, 359.8) == (180, 0)
+        assert gridIndex(definition, 0, -0.1) == (180, 0)
+
+        # Other grids need the full latitudes and longitudes
+        assert gridIndex(("reduced_gg", 0, 0, 90, 0, -90, 360), 0, 0) is None
+
+
 class UserAlertTests(TestCase):
     def setUpAlerts(self):
         # Add some user alerts to db
@@ -204,13 +476,36 @@ class UserAlertTests(TestCase):
         )
         self.alert3.save()
 
-    @mock.patch("calculations.tasks.send_user_sms_alerts")
+    def add_alert_prediction(self, bounding_box, median_depth=1):
+        model_version = ModelVersion.objects.first()
+        if not model_version:
+            model_version = ModelVersion(version_name="v1", is_current=True)
+            model_version.save()
+        parameters = FloodModelParameters(
+            model_version=model_version,
+            bounding_box=Polygon.from_bbox(bounding_box),
+            beta0=0,
+        )
+        parameters.save()
+        DepthPrediction(
+            date=datetime.utcnow().date() + timedelta(days=1),
+            parameters=parameters,
+            median_depth=median_depth,
+            lower_centile=0.5,
+            mid_lower_centile=0.7,
+            upper_centile=1.5,
+            model_version=model_version,
+        ).save()
+
+    @mock.patch("webapp.alerts.TwilioBackend.send", return_value="SM1")
     def test_send_alerts(self, mock):
         # Call send_alerts: mock should not be called as nothing in db
         send_alerts()
         mock.assert_not_called()
 
         self.setUpAlerts()
+        # Add a prediction crossing alert1 only
+        self.add_alert_prediction((1, 1, 2, 2))
 
         # Call send_alerts again. Should not call mock as alerts not verified.
         send_alerts()
@@ -222,26 +517,117 @@ class UserAlertTests(TestCase):
         self.alert2.verified = True
         self.alert2.save()
 
-        # Call send_alerts again. Should call mock delay with user and phone number1 ids
+        # Call send_alerts again. Should send to phone number1 only, and record it
         send_alerts()
-        mock.delay.assert_called_once_with(self.user.id, self.phone_number1.id)
+        mock.assert_called_once()
+        phone_number, message = mock.call_args[0]
+        assert phone_number == "+441234567890"
+        assert message.startswith("Floods up to 1.0m predicted from ")
+        delivery = AlertDelivery.objects.get()
+        assert delivery.phone_number_id == self.phone_number1.id
+        assert delivery.status == DeliveryStatus.SENT
+        assert delivery.provider_id == "SM1"
 
         mock.reset_mock()
 
-        # Verify alert 3
+        # Verify alert 3. Nothing is predicted there, and the flooding for phone number1
+        # is unchanged, so nothing is sent
         self.alert3.verified = True
         self.alert3.save()
-        # Call send_alerts again. Should call mock delay twice with both phone numbers
         send_alerts()
-        mock.delay.assert_has_calls(
-            mock.call(self.user.id, self.phone_number1.id),
-            mock.call(self.user.id, self.phone_number2.id),
+        mock.assert_not_called()
+
+        # Add a deeper prediction crossing alert3. Should send to phone number2 only
+        self.add_alert_prediction((15, 15, 16, 16), median_depth=2)
+        send_alerts()
+        mock.assert_called_once()
+        phone_number, message = mock.call_args[0]
+        assert phone_number == "+449876543210"
+        assert message.startswith("Floods up to 2.0m")
+
+        mock.reset_mock()
+
+        # Flooding crossing alert2 moves phone number1 into a deeper band, so it is
+        # sent again with the deepest flood at its locations
+        self.add_alert_prediction((5, 15, 6, 16), median_depth=2.5)
+        send_alerts()
+        mock.assert_called_once()
+        phone_number, message = mock.call_args[0]
+        assert phone_number == "+441234567890"
+        assert message.startswith("Floods up to 2.5m")
+        assert AlertState.objects.get(alert=self.alert2).depth_band == 3
+
+        mock.reset_mock()
+
+        # Once the flooding at alert3 is no longer forecast its state is forgotten, so
+        # it is alerted about again if it returns
+        prediction = DepthPrediction.objects.get(
+            parameters__bounding_box__intersects=self.alert3.location
         )
+        prediction.mid_lower_centile = 0
+        prediction.save()
+        send_alerts()
+        mock.assert_not_called()
+        assert not AlertState.objects.filter(alert=self.alert3).exists()
+
+        prediction.mid_lower_centile = 0.7
+        prediction.save()
+        send_alerts()
+        mock.assert_called_once()
+        assert mock.call_args[0][0] == "+449876543210"
 
-    @mock.patch("calculations.alerts.TwilioAlerts.send_alert_sms")
+    @mock.patch("webapp.alerts.TwilioBackend.send", return_value="SM1")
+    def test_send_alerts_at_edge(self, mock):
+        # A location touching the edge of a shallow cell, in a flooded area that is
+        # deeper further away
+        self.setUpAlerts()
+        self.alert1.verified = True
+        self.alert1.save()
+        self.add_alert_prediction((10, 8, 10.5, 8.5), median_depth=0.3)
+        self.add_alert_prediction((10.5, 8, 11, 8.5), median_depth=0.4)
+        self.add_alert_prediction((11, 8, 11.5, 8.5), median_depth=2)
+
+        # Alerts are sent with the depth at the location
+        send_alerts()
+        mock.assert_called_once()
+        phone_number, message = mock.call_args[0]
+        assert phone_number == "+441234567890"
+        assert message.startswith("Floods up to 0.3m")
+        assert AlertState.objects.get(alert=self.alert1).max_depth == 0.3
+
+    def test_is_material_change(self):
+        now = datetime(2022, 4, 1, tzinfo=timezone.utc)
+        state = AlertState(
+            start_date=now + timedelta(days=2),
+            end_date=now + timedelta(days=3),
+            max_depth=0.6,
+            depth_band=1,
+            sent_at=now - timedelta(days=1),
+        )
+        start, end = state.start_date, state.end_date
+        with self.settings(
+            ALERT_CHANGE_DEPTHS=(0.5, 1), ALERT_CHANGE_DAYS=1, ALERT_REPEAT_DAYS=0
+        ):
+            assert not is_material_change(state, start, end, 0.9, now)
+            assert is_material_change(state, start, end, 1.1, now)
+            assert is_material_change(state, start, end, 0.4, now)
+            assert not is_material_change(
+                state, start, end + timedelta(days=1), 0.6, now
+            )
+            assert is_material_change(state, start, end + timedelta(days=2), 0.6, now)
+            assert is_material_change(state, start - timedelta(days=2), end, 0.6, now)
+
+            # Flooding under way starts later each day the alert period moves on
+            later = now + timedelta(days=5)
+            assert not is_material_change(state, later, end, 0.6, later)
+
+        with self.settings(ALERT_CHANGE_DEPTHS=(0.5, 1), ALERT_REPEAT_DAYS=1):
+            assert is_material_change(state, start, end, 0.6, now)
+
+    @mock.patch("webapp.alerts.TwilioBackend.send", return_value="SM1")
     def test_send_sms_alerts(self, sms_mock):
         self.setUpAlerts()
-        # No depths in db so should not make any calls to Twilio apart from constructor
+        # No depths in db so should not make any calls to Twilio
         send_phone_alerts_for_user(1, 1)
         sms_mock.assert_not_called()
 
@@ -289,6 +675,8 @@ class UserAlertTests(TestCase):
             channel_location=MultiPolygon([Polygon.from_bbox((8, 8, 12, 12))])
         )
         channel.save()
+        parameters.refresh_from_db()
+        assert parameters.in_channel
         send_phone_alerts_for_user(self.user.id, self.phone_number2.id)
         assert sms_mock.call_count == 0
 
@@ -299,12 +687,73 @@ class UserAlertTests(TestCase):
             [Polygon.from_bbox((10, 10, 10.5, 10.5))]
         )
         channel.save()
+        parameters.refresh_from_db()
+        assert not parameters.in_channel
         send_phone_alerts_for_user(self.user.id, self.phone_number2.id)
         assert sms_mock.call_count == 1
         call_args2 = sms_mock.call_args[0]
         assert call_args2[0] == "+449876543210"
         assert call_args2[1] == call_args[1]
 
+        # Deleting a channel covering the prediction should also update the parameters
+        channel.channel_location = MultiPolygon([Polygon.from_bbox((8, 8, 12, 12))])
+        channel.save()
+        channel.delete()
+        parameters.refresh_from_db()
+        assert not parameters.in_channel
+
+
+class FloodExtentTests(TestCase):
+    def test_build_flood_extents(self):
+        model_version = ModelVersion(version_name="v1", is_current=True)
+        model_version.save()
+        date = datetime(2022, 4, 1, 6, tzinfo=timezone.utc)
+
+        # Three adjoining cells, one separate cell, and one in the river channel
+        cells = [
+            ((0, 0, 1, 1), 0.2, 0.3),
+            ((1, 0, 2, 1), 0.6, 0.8),
+            ((2, 0, 3, 1), 0.05, 0.1),
+            ((5, 5, 6, 6), 1.2, 1.5),
+            ((8, 8, 9, 9), 3, 3),
+        ]
+        for bounding_box, mid_lower_centile, median_depth in cells:
+            parameters = FloodModelParameters(
+                model_version=model_version,
+                bounding_box=Polygon.from_bbox(bounding_box),
+                beta0=0,
+            )
+            parameters.save()
+            DepthPrediction(
+                date=date,
+                parameters=parameters,
+                median_depth=median_depth,
+                lower_centile=0,
+                mid_lower_centile=mid_lower_centile,
+                upper_centile=median_depth + 0.5,
+                model_version=model_version,
+            ).save()
+        RiverChannel(
+            channel_location=MultiPolygon([Polygon.from_bbox((7, 7, 10, 10))])
+        ).save()
+
+        with self.settings(FLOOD_EXTENT_DEPTHS=(0.5, 1), ALERT_DEPTH_THRESHOLD=0.1):
+            build_flood_extents(date, model_version.id)
+            # Building again replaces the extents
+            build_flood_extents(date, model_version.id)
+
+        extents = {
+            (extent.min_depth, extent.outline.extent): extent.max_depth
+            for extent in FloodExtent.objects.all()
+        }
+        assert extents == {
+            (0.1, (0, 0, 2, 1)): 0.8,
+            (0.1, (5, 5, 6, 6)): 1.5,
+            (0.5, (1, 0, 2, 1)): 0.8,
+            (0.5, (5, 5, 6, 6)): 1.5,
+            (1, (5, 5, 6, 6)): 1.5,
+        }
+
 
 class FloodCalculationTests(TestCase):
     def test_predict_depth(self):
@@ -325,3 +774,236 @@ class FloodCalculationTests(TestCase):
         flows = np.array([0.1, 2, 1.5, 5])
         stats = predict_depth(flows, params)
         assert stats == (0, 0, 0, 0)
+
+    def test_flow_fingerprint(self):
+        flows = np.array([0.1, 2, 1.5, 5])
+
+        # Changes smaller than FLOW_QUANTISATION don't change the fingerprint
+        assert flow_fingerprint(flows) == flow_fingerprint(flows + 0.001)
+        assert flow_fingerprint(flows) != flow_fingerprint(flows + 0.5)
+        assert flow_fingerprint(flows) != flow_fingerprint(np.array([0.1, 2, 1.5, 6]))
+
+    def test_predict_depths_skips_unchanged_cells(self):
+        model_version = ModelVersion(version_name="v1", is_current=True)
+        model_version.save()
+        wet = FloodModelParameters(
+            model_version=model_version,
+            bounding_box=Polygon.from_bbox((0, 0, 1, 1)),
+            beta0=1,
+        )
+        wet.save()
+        dry = FloodModelParameters(
+            model_version=model_version,
+            bounding_box=Polygon.from_bbox((1, 0, 2, 1)),
+            beta0=-1,
+        )
+        dry.save()
+        forecast_time = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        flows = np.array([1.0, 2.0])
+
+        # Cells are worked through in chunks of DATABASE_CHUNK_SIZE
+        with self.settings(DATABASE_CHUNK_SIZE=1):
+            predict_depths(forecast_time, model_version.id, flows)
+        predictions = DepthPrediction.objects.filter(date=forecast_time)
+        assert len(predictions) == 1
+        assert predictions[0].parameters_id == wet.id
+
+        # Values within DEPTH_QUANTISATION of the stored ones are not rewritten
+        predictions.update(median_depth=1.001)
+        predict_depths(forecast_time, model_version.id, flows)
+        assert DepthPrediction.objects.get(date=forecast_time).median_depth == 1.001
+
+        # Cells that become dry are removed
+        wet.beta0 = -1
+        wet.save()
+        predict_depths(forecast_time, model_version.id, flows)
+        assert not DepthPrediction.objects.filter(date=forecast_time).exists()
+
+    def test_aggregate_flood_model_levels(self):
+        model_version = ModelVersion(version_name="v1", is_current=True)
+        model_version.save()
+        forecast_time = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        for bbox, depth in (
+            ((0, 0, 1, 1), 1),
+            ((1, 0, 2, 1), 2),
+            ((3, 3, 4, 4), 4),
+        ):
+            parameters = FloodModelParameters(
+                model_version=model_version,
+                bounding_box=Polygon.from_bbox(bbox),
+                beta0=depth,
+            )
+            parameters.save()
+            DepthPrediction(
+                date=forecast_time,
+                parameters=parameters,
+                model_version=model_version,
+                median_depth=depth,
+                lower_centile=depth,
+                mid_lower_centile=depth,
+                upper_centile=depth,
+            ).save()
+
+        # Split (0, 0, 4, 4) into 2x2 blocks: the first two cells share a block
+        aggregate_flood_model_levels(
+            forecast_time, model_version.id, (0, 0, 4, 4), (1, 2)
+        )
+        aggregated = AggregatedDepthPrediction.objects.filter(
+            date=forecast_time, aggregation_level=2
+        ).order_by("median_depth")
+        assert len(aggregated) == 2
+        assert aggregated[0].bounding_box == Polygon.from_bbox((0, 0, 2, 2))
+        assert aggregated[0].median_depth == 1.5
+        assert aggregated[0].cell_count == 2
+        assert aggregated[1].bounding_box == Polygon.from_bbox((2, 2, 4, 4))
+        assert aggregated[1].median_depth == 4
+
+        # The coarser level is built from the level below, averaging all 3 cells
+        aggregated = AggregatedDepthPrediction.objects.get(
+            date=forecast_time, aggregation_level=1
+        )
+        assert aggregated.bounding_box == Polygon.from_bbox((0, 0, 4, 4))
+        assert aggregated.median_depth == 7 / 3
+        assert aggregated.cell_count == 3
+
+        # Running again replaces rather than duplicates the aggregations
+        aggregate_flood_model_levels(
+            forecast_time, model_version.id, (0, 0, 4, 4), (1, 2)
+        )
+        assert AggregatedDepthPrediction.objects.count() == 3
+
+        self.assertRaises(
+            Exception,
+            aggregate_flood_model_levels,
+            forecast_time,
+            model_version.id,
+            (0, 0, 4, 4),
+            (1, 4),
+        )
+
+    def test_merge_blocks(self):
+        block_x, block_y, counts, sums = merge_blocks(
+            np.array([0, 1, 2, -1]),
+            np.array([0, 1, 0, 0]),
+            np.array([1, 2, 3, 4]),
+            np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0], [7.0, 8.0]]),
+        )
+        assert list(block_x) == [-1, 0, 1]
+        assert list(block_y) == [0, 0, 0]
+        assert list(counts) == [4, 3, 3]
+        np.testing.assert_equal(sums, [[7, 8], [4, 6], [5, 6]])
+
+
+class RasterTests(TestCase):
+    def test_flood_grid(self):
+        grid = FloodGrid(10, 20, 14, 22, 0.5, 0.5)
+        assert (grid.width, grid.height) == (8, 4)
+
+        # Rows count down from the top of the grid
+        columns, rows = grid.column_row([10.25, 13.75], [21.75, 20.25])
+        assert list(columns) == [0, 7]
+        assert list(rows) == [0, 3]
+        assert grid.block_size(4) == 0.5
+
+    def test_write_depth_raster(self):
+        grid = FloodGrid(10, 20, 14, 22, 0.5, 0.5)
+        depths = [[1, 0.5, 0.7, 1.5], [2, 1, 1.5, 3]]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir).joinpath("run", "time.tif")
+            write_depth_raster(path, grid, [10.25, 13.75], [21.75, 20.25], depths)
+            assert path.exists()
+
+            dataset = gdal.Open(str(path))
+            assert dataset.GetGeoTransform() == (10, 0.5, 0, 22, 0, -0.5)
+            assert [
+                dataset.GetRasterBand(i + 1).GetDescription() for i in range(4)
+            ] == list(DEPTH_BANDS)
+            data = dataset.ReadAsArray()
+            assert data.shape == (4, 4, 8)
+            np.testing.assert_almost_equal(data[:, 0, 0], depths[0])
+            np.testing.assert_almost_equal(data[:, 3, 7], depths[1])
+            assert np.count_nonzero(data) == 8
+
+    def test_tile_coordinates(self):
+        assert lon_lat_to_tile(0, 0, 1) == (1, 1)
+        assert lon_lat_to_tile(-180, 85, 2) == (0, 0)
+        np.testing.assert_almost_equal(
+            tile_bounds(1, 1, 0), (0, 0, 20037508.34, 20037508.34), 2
+        )
+
+    def test_colour_depths(self):
+        depths = np.zeros((4, 1, 3))
+        depths[0] = [0, 2, 1]
+        depths[3] = [0, 2, 1]
+        image = colour_depths(depths, 2)
+        assert image.shape == (4, 1, 3)
+
+        # Dry cells are transparent, max depth has the darkest colour
+        assert image[3, 0, 0] == 0
+        assert list(image[:, 0, 1]) == [8, 29, 88, 0]
+        assert image[3, 0, 2] == 128
+
+    def test_render_tiles(self):
+        grid = FloodGrid(10, 20, 14, 22, 0.5, 0.5)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir).joinpath("time.tif")
+            write_depth_raster(path, grid, [10.25], [21.75], [[1, 0.5, 0.7, 1.5]])
+
+            tile_dir = Path(tmp_dir).joinpath("tiles")
+            count = render_tiles(path, tile_dir, [5, 6], 2)
+            assert count == 2
+            assert tile_dir.joinpath("5", "16", "14.png").exists()
+
+    def test_prune_runs(self):
+        today = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        yesterday = today - timedelta(days=1)
+        tomorrow = today + timedelta(days=1)
+        with tempfile.TemporaryDirectory() as tmp_dir, self.settings(
+            RASTER_ROOT=Path(tmp_dir).joinpath("rasters"),
+            TILE_ROOT=Path(tmp_dir).joinpath("tiles"),
+        ):
+            # The earlier run wrote today and tomorrow, and the later run only
+            # tomorrow, as today's flows were unchanged
+            for run, time in (
+                (yesterday, yesterday),
+                (yesterday, today),
+                (yesterday, tomorrow),
+                (today, tomorrow),
+            ):
+                for path in (
+                    f"rasters/{run:%Y%m%d}/{time:%Y%m%dT%H%M}.tif",
+                    f"tiles/{run:%Y%m%d}/{time:%Y%m%dT%H%M}/10/1/1.png",
+                ):
+                    path = Path(tmp_dir).joinpath(path)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.touch()
+
+            # Past forecast times, and those replaced by a later run, are deleted
+            prune_depth_rasters()
+            rasters = sorted(
+                str(p.relative_to(tmp_dir))
+                for p in Path(tmp_dir).joinpath("rasters").glob("*/*")
+            )
+            assert rasters == [
+                f"rasters/{yesterday:%Y%m%d}/{today:%Y%m%dT%H%M}.tif",
+                f"rasters/{today:%Y%m%d}/{tomorrow:%Y%m%dT%H%M}.tif",
+            ]
+            assert find_depth_raster(today).parent.name == f"{yesterday:%Y%m%d}"
+
+            manifest = update_tile_manifest()
+            assert manifest["runs"] == [f"{yesterday:%Y%m%d}", f"{today:%Y%m%d}"]
+            assert manifest["times"] == {
+                f"{today:%Y-%m-%dT%H:%M:%SZ}": f"{yesterday:%Y%m%d}/{today:%Y%m%dT%H%M}",
+                f"{tomorrow:%Y-%m-%dT%H:%M:%SZ}": f"{today:%Y%m%d}/{tomorrow:%Y%m%dT%H%M}",
+            }
+            tiles = sorted(
+                str(p.relative_to(tmp_dir))
+                for p in Path(tmp_dir).joinpath("tiles").glob("*/*")
+            )
+            assert tiles == [
+                f"tiles/{yesterday:%Y%m%d}/{today:%Y%m%dT%H%M}",
+                f"tiles/{today:%Y%m%d}/{tomorrow:%Y%m%dT%H%M}",
+            ]
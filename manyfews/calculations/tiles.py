@@ -0,0 +1,265 @@
+from datetime import datetime, timezone
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import shutil
+
+from celery import shared_task
+from django.conf import settings
+from django.db import connection
+import numpy as np
+from osgeo import gdal
+
+from .models import AggregatedDepthPrediction, DepthPrediction, FloodModelParameters
+from .rasters import depth_raster_path
+
+logger = logging.getLogger(__name__)
+
+gdal.UseExceptions()
+
+# Name of the layer in the depth vector tiles
+DEPTH_TILE_LAYER = "depths"
+
+# Size in pixels of the raster tiles
+TILE_SIZE = 256
+
+# Half the width of the web mercator projection, in metres
+MERCATOR_ORIGIN = 20037508.342789244
+
+# The d3 YlGnBu colour scheme, which maps.js uses to colour depths
+YL_GN_BU = np.array(
+    [
+        (255, 255, 217),
+        (237, 248, 177),
+        (199, 233, 180),
+        (127, 205, 187),
+        (65, 182, 196),
+        (29, 145, 192),
+        (34, 94, 168),
+        (37, 52, 148),
+        (8, 29, 88),
+    ],
+    dtype=np.float64,
+)
+
+TILE_TIME_FORMAT = "%Y%m%dT%H%M"
+
+
+def get_depth_tile(forecast_time, aggregation_level, z, x, y):
+    """
+    Get a Mapbox Vector Tile of the depth predictions for a forecast time.
+
+    :param aggregation_level: the level of AggregatedDepthPrediction to use, or -1 for
+                              the individual DepthPrediction cells.
+    :param z, x, y: the (web mercator) tile coordinates.
+    :return: the encoded tile as bytes.
+    """
+    if aggregation_level > 0:
+        source = f"""
+            SELECT bounding_box, median_depth, lower_centile, upper_centile
+            FROM {AggregatedDepthPrediction._meta.db_table}
+            WHERE date = %(date)s AND aggregation_level = %(level)s
+        """
+    else:
+        source = f"""
+            SELECT p.bounding_box, d.median_depth, d.lower_centile, d.upper_centile
+            FROM {DepthPrediction._meta.db_table} d
+            JOIN {FloodModelParameters._meta.db_table} p ON p.id = d.parameters_id
+            WHERE d.date = %(date)s
+        """
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH envelope AS (
+                SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS tile
+            ),
+            cells AS ({source}),
+            features AS (
+                SELECT
+                    ST_AsMVTGeom(ST_Transform(bounding_box, 3857), envelope.tile) AS geom,
+                    median_depth AS depth,
+                    lower_centile,
+                    upper_centile
+                FROM cells, envelope
+                WHERE bounding_box && ST_Transform(envelope.tile, 4326)
+            )
+            SELECT ST_AsMVT(features.*, %(layer)s) FROM features
+            """,
+            {
+                "date": forecast_time,
+                "level": aggregation_level,
+                "z": z,
+                "x": x,
+                "y": y,
+                "layer": DEPTH_TILE_LAYER,
+            },
+        )
+        return bytes(cursor.fetchone()[0] or b"")
+
+
+def tile_range(bounds, z):
+    """Get the (x_min, y_min, x_max, y_max) tiles at zoom z covering lon/lat bounds"""
+    x_min, y_min = lon_lat_to_tile(bounds[0], bounds[3], z)
+    x_max, y_max = lon_lat_to_tile(bounds[2], bounds[1], z)
+    return x_min, y_min, x_max, y_max
+
+
+def lon_lat_to_tile(lon, lat, z):
+    """Get the x, y indices of the tile at zoom z containing a point"""
+    n = 2**z
+    x = int((lon + 180) / 360 * n)
+    lat_radians = math.radians(lat)
+    y = int((1 - math.asinh(math.tan(lat_radians)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(z, x, y):
+    """Get the web mercator bounds (x_min, y_min, x_max, y_max) of a tile"""
+    size = 2 * MERCATOR_ORIGIN / 2**z
+    x_min = -MERCATOR_ORIGIN + x * size
+    y_max = MERCATOR_ORIGIN - y * size
+    return x_min, y_max - size, x_min + size, y_max
+
+
+def colour_depths(depths, max_depth):
+    """
+    Colour depth bands (median, lower, mid-lower and upper centiles) as an RGBA image,
+    with the same colours and opacity as the depths drawn by maps.js. Cells with no
+    predicted flooding are transparent.
+
+    :return: an array of shape (4, rows, columns) of uint8.
+    """
+    median, lower, _, upper = depths.astype(np.float64)
+    position = np.clip(median / max_depth, 0, 1) * (len(YL_GN_BU) - 1)
+    index = np.minimum(position.astype(np.int64), len(YL_GN_BU) - 2)
+    fraction = (position - index)[..., np.newaxis]
+    rgb = YL_GN_BU[index] * (1 - fraction) + YL_GN_BU[index + 1] * fraction
+
+    alpha = np.clip(1 - (upper - lower) / max_depth, 0, 1) * 255
+    alpha[upper <= 0] = 0
+
+    rgba = np.concatenate((rgb, alpha[..., np.newaxis]), axis=-1)
+    return np.round(rgba).astype(np.uint8).transpose(2, 0, 1)
+
+
+def render_tiles(raster_path, tile_dir, zoom_levels, max_depth):
+    """
+    Render PNG tiles of a depth raster into tile_dir/z/x/y.png. Tiles without any
+    flooding aren't written.
+
+    :return: the number of tiles written.
+    """
+    source = gdal.Open(str(raster_path))
+    x_origin, cell_width, _, y_origin, _, cell_height = source.GetGeoTransform()
+    bounds = (
+        x_origin,
+        y_origin + source.RasterYSize * cell_height,
+        x_origin + source.RasterXSize * cell_width,
+        y_origin,
+    )
+
+    png_driver = gdal.GetDriverByName("PNG")
+    count = 0
+    for z in zoom_levels:
+        x_min, y_min, x_max, y_max = tile_range(bounds, z)
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                tile = gdal.Warp(
+                    "",
+                    source,
+                    format="MEM",
+                    outputBounds=tile_bounds(z, x, y),
+                    width=TILE_SIZE,
+                    height=TILE_SIZE,
+                    dstSRS="EPSG:3857",
+                    resampleAlg="near",
+                )
+                image = colour_depths(tile.ReadAsArray(), max_depth)
+                if not image[3].any():
+                    continue
+
+                rgba = gdal.GetDriverByName("MEM").Create(
+                    "", TILE_SIZE, TILE_SIZE, 4, gdal.GDT_Byte
+                )
+                for i in range(4):
+                    rgba.GetRasterBand(i + 1).WriteArray(image[i])
+
+                path = Path(tile_dir).joinpath(str(z), str(x), f"{y}.png")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                png_driver.CreateCopy(str(path), rgba)
+                count += 1
+
+    return count
+
+
+def update_tile_manifest():
+    """
+    Write TILE_ROOT/manifest.json listing the runs with rendered tiles, and the tiles
+    to use for each forecast time from today: those from the most recent run that
+    rendered it. Tiles for earlier forecast times, or replaced by a later run, are
+    deleted along with any emptied run directories.
+    """
+    root = Path(settings.TILE_ROOT)
+    today = datetime.now(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    runs = []
+    times = {}
+    run_dirs = sorted(d for d in root.iterdir() if d.is_dir()) if root.exists() else []
+    for run_dir in reversed(run_dirs):
+        for time_dir in run_dir.iterdir():
+            if time_dir.is_dir() and not time_dir.name.endswith(".tmp"):
+                forecast_time = datetime.strptime(
+                    time_dir.name, TILE_TIME_FORMAT
+                ).replace(tzinfo=timezone.utc)
+                key = forecast_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                if forecast_time < today or key in times:
+                    shutil.rmtree(time_dir, ignore_errors=True)
+                else:
+                    times[key] = f"{run_dir.name}/{time_dir.name}"
+        if any(run_dir.iterdir()):
+            runs.insert(0, run_dir.name)
+        else:
+            run_dir.rmdir()
+
+    manifest = {
+        "url": settings.TILE_URL,
+        "zoom_levels": list(settings.TILE_ZOOM_LEVELS),
+        "runs": runs,
+        "times": dict(sorted(times.items())),
+    }
+
+    # Write alongside and rename, so the web server never serves a partial file
+    root.mkdir(parents=True, exist_ok=True)
+    temp_path = root.joinpath("manifest.json.tmp")
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temp_path, root.joinpath("manifest.json"))
+    return manifest
+
+
+@shared_task(name="Render depth tiles")
+def render_depth_tiles(prediction_date, forecast_time):
+    logger.info(f"Rendering depth tiles for {forecast_time}")
+    tile_dir = Path(settings.TILE_ROOT).joinpath(
+        prediction_date.strftime("%Y%m%d"), forecast_time.strftime(TILE_TIME_FORMAT)
+    )
+
+    # Render into a temporary directory and swap it in once complete
+    temp_dir = tile_dir.with_name(tile_dir.name + ".tmp")
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    count = render_tiles(
+        depth_raster_path(prediction_date, forecast_time),
+        temp_dir,
+        settings.TILE_ZOOM_LEVELS,
+        settings.MAX_FLOOD_DEPTH,
+    )
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    os.replace(temp_dir, tile_dir)
+
+    update_tile_manifest()
+    logger.info(f"Rendered {count} tiles to {tile_dir}")
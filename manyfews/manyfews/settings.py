@@ -84,6 +84,28 @@ MODEL_TIMESTEP = env.float("MODEL_TIMESTEP", 0.25)
 GEFS_FORECAST_DAYS = env.int("GEFS_FORECAST_DAYS", 16)
 LAT_VALUE = env.float("LAT_VALUE", -7.05)
 LON_VALUE = env.float("LON_VALUE", 175)
+# Server to download GEFS files from, and the number of seconds to wait for responses
+GEFS_BASE_URL = env.str(
+    "GEFS_BASE_URL", "https://ftp.ncep.noaa.gov/data/nccf/com/gens/prod"
+)
+GEFS_TIMEOUT = env.float("GEFS_TIMEOUT", 60)
+# GEFS ensemble members to download: the ensemble mean (used to run the model), the
+# control and the 30 perturbed members
+GEFS_MEMBERS = env.tuple(
+    "GEFS_MEMBERS",
+    str,
+    ("geavg", "gec00") + tuple(f"gep{i:02}" for i in range(1, 31)),
+)
+# Number of GEFS forecast hours to download at once
+GEFS_WORKERS = env.int("GEFS_WORKERS", 8)
+# Attempts to retry a failed GEFS download, and the seconds to wait before the first
+# retry, doubling for each one after
+GEFS_RETRIES = env.int("GEFS_RETRIES", 5)
+GEFS_RETRY_BACKOFF = env.float("GEFS_RETRY_BACKOFF", 2)
+# Seconds between checks for GEFS files that aren't published yet, and the most
+# seconds to wait for them to be published
+GEFS_PUBLISH_INTERVAL = env.float("GEFS_PUBLISH_INTERVAL", 300)
+GEFS_PUBLISH_WAIT = env.float("GEFS_PUBLISH_WAIT", 6 * 60 * 60)
 
 # Thresholds for number of m^2 cells that count towards flood risk
 # CHANNEL_CELL_COUNT is number of cells in the river channel
@@ -95,6 +117,11 @@ FLOOD_MODEL_PARAMETERS = env.tuple(
     "FLOOD_MODEL_PARAMETERS", float, (1, 1, 0.12, 0.399, 0.00395, 0.00565)
 )
 
+# Resolution at which river flows (m3/s) and depths (m) are compared with the previous
+# run, so forecast times and cells that have not materially changed are not recalculated
+FLOW_QUANTISATION = env.float("FLOW_QUANTISATION", 0.01)
+DEPTH_QUANTISATION = env.float("DEPTH_QUANTISATION", 0.01)
+
 # Leaflet map tiles URL (including API key if needed)
 MAP_URL = env.str(
     "MAP_URL", "https://tiles.stadiamaps.com/tiles/osm_bright/{z}/{x}/{y}{r}.png"
@@ -113,6 +140,22 @@ TWILIO_ACCOUNT_SID = env.str("TWILIO_ACCOUNT_SID", "")
 TWILIO_AUTH_TOKEN = env.str("TWILIO_AUTH_TOKEN", "")
 TWILIO_PHONE_NUMBER = env.str("TWILIO_PHONE_NUMBER", "")
 TWILIO_VERIFICATION_SID = env.str("TWILIO_VERIFICATION_SID", "")
+# Twilio REST API used to send alerts: set to the URL shown by
+# `python manage.py fake_sms_server` to send them to a local stand-in instead
+TWILIO_API_URL = env.str("TWILIO_API_URL", "https://api.twilio.com/2010-04-01")
+
+# Class used to send alerts (webapp.alerts.TwilioBackend, or
+# webapp.alerts.LoggingBackend to only log them)
+ALERT_BACKEND = env.str("ALERT_BACKEND", "webapp.alerts.TwilioBackend")
+# Number of alerts to send at once, the maximum number to send per second (the
+# provider's rate limit), and the number of seconds to wait for each
+ALERT_WORKERS = env.int("ALERT_WORKERS", 8)
+ALERT_RATE_LIMIT = env.float("ALERT_RATE_LIMIT", 10)
+ALERT_TIMEOUT = env.float("ALERT_TIMEOUT", 10)
+# Number of times to retry alerts which may succeed later (e.g. when rate limited),
+# waiting ALERT_RETRY_BACKOFF seconds, doubling after each attempt
+ALERT_RETRIES = env.int("ALERT_RETRIES", 3)
+ALERT_RETRY_BACKOFF = env.float("ALERT_RETRY_BACKOFF", 1)
 
 # Site URL (or short URL) for use in messages
 SITE_URL = env.str("SITE_URL", "http://localhost:8000")
@@ -126,14 +169,81 @@ ALERT_TEXT = env.str(
 ALERT_DATE_FORMAT = env.str("ALERT_DATE_FORMAT", "%b %d")
 ALERT_DEPTH_THRESHOLD = env.float("ALERT_DEPTH_THRESHOLD", 0.1)
 
+# Alerts are only sent again for a location when the forecast flooding changes
+# materially: its maximum depth moves across one of ALERT_CHANGE_DEPTHS (in m), or its
+# dates move by more than ALERT_CHANGE_DAYS. Set ALERT_REPEAT_DAYS to also repeat
+# alerts for flooding still forecast after that many days (0 never repeats them).
+ALERT_CHANGE_DEPTHS = env.tuple("ALERT_CHANGE_DEPTHS", float, (0.5, 1, 2))
+ALERT_CHANGE_DAYS = env.int("ALERT_CHANGE_DAYS", 1)
+ALERT_REPEAT_DAYS = env.int("ALERT_REPEAT_DAYS", 0)
+
+# Depths in m at which the flooded areas are outlined after each run for the map
+# (ALERT_DEPTH_THRESHOLD is always included, to show the areas alerted about), and the
+# tolerance in degrees that the outlines are simplified to
+FLOOD_EXTENT_DEPTHS = env.tuple("FLOOD_EXTENT_DEPTHS", float, (0.1, 0.5, 1, 2))
+FLOOD_EXTENT_TOLERANCE = env.float("FLOOD_EXTENT_TOLERANCE", 0.0001)
+
 # Location to store parameter files uploaded
 MEDIA_ROOT = env.str(
     "MEDIA_ROOT", Path(__file__).resolve().parent.parent.joinpath("files")
 )
 
+# Levels to aggregate depths at for display at lower zoom levels: the extent is split
+# into blocks of 1/level of its size. Each level must be half the next.
+AGGREGATION_LEVELS = env.tuple("AGGREGATION_LEVELS", int, (32, 64, 128, 256))
+
+# Number of seconds that browsers and proxies may cache depth map tiles for
+TILE_MAX_AGE = env.int("TILE_MAX_AGE", 3600)
+
+# Maximum number of cells to return for an area of the map: larger areas are shown at a
+# coarser aggregation level
+DEPTH_CELL_BUDGET = env.int("DEPTH_CELL_BUDGET", 20000)
+
+# Number of seconds that browsers and proxies may cache flood depths for before
+# revalidating them (they are unchanged until the next forecast run is published)
+DEPTH_MAX_AGE = env.int("DEPTH_MAX_AGE", 300)
+
+# Location to store Cloud-Optimized GeoTIFFs of depth predictions for each forecast time
+RASTER_ROOT = env.str("RASTER_ROOT", Path(MEDIA_ROOT).joinpath("rasters"))
+
+# Location and URL of the PNG map tiles rendered for each forecast time, and the zoom
+# levels to render (the map scales up the tiles at higher zoom levels)
+TILE_ROOT = env.str("TILE_ROOT", Path(MEDIA_ROOT).joinpath("tiles"))
+TILE_URL = env.str("TILE_URL", "/tiles/")
+TILE_ZOOM_LEVELS = env.tuple("TILE_ZOOM_LEVELS", int, tuple(range(10, 18)))
+
+# Location to cache the GEFS data downloaded for each forecast cycle, member and
+# forecast hour, and the number of days to keep it for
+GEFS_CACHE_ROOT = env.str("GEFS_CACHE_ROOT", Path(MEDIA_ROOT).joinpath("gefs"))
+GEFS_CACHE_DAYS = env.int("GEFS_CACHE_DAYS", 7)
+
 # Maximum depth for floods in m (used to determine colour bands for flood depths)
 MAX_FLOOD_DEPTH = env.float("MAX_FLOOD_DEPTH", 2)
 
+# Cache used for rendered pages and map data, e.g. locmemcache://?max_entries=10000 or
+# rediscache://redis:6379/1 (see https://django-environ.readthedocs.io). Use a cache
+# shared with celery so that updated results clear cached pages straight away, and
+# bound its size with least recently used eviction (e.g. redis maxmemory-policy
+# allkeys-lru).
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://?max_entries=10000")}
+
+# Maximum number of seconds to cache which run is published for. A cache not shared
+# with celery (e.g. locmemcache) only sees newly published runs once this expires.
+PUBLISHED_RUN_CACHE_TIMEOUT = env.int("PUBLISHED_RUN_CACHE_TIMEOUT", 60)
+
+# Maximum number of seconds to cache the home page flood risks for
+RISK_CACHE_TIMEOUT = env.int("RISK_CACHE_TIMEOUT", 600)
+
+# Maximum number of seconds to cache fragments of flood depth responses for. They are
+# keyed by the published run, so entries from earlier runs expire or are evicted when
+# the cache is full.
+DEPTH_CACHE_TIMEOUT = env.int("DEPTH_CACHE_TIMEOUT", 86400)
+
+# Maximum number of seconds to spend filling the caches after each run is published,
+# and the size in pixels of the map view to fill them for
+CACHE_WARMING_TIME_LIMIT = env.int("CACHE_WARMING_TIME_LIMIT", 600)
+CACHE_WARMING_VIEWPORT = env.tuple("CACHE_WARMING_VIEWPORT", int, (1280, 720))
+
 # =======================================================================================
 # End of user configurable settings
 # =======================================================================================
@@ -290,6 +400,11 @@ CELERY_RESULT_BACKEND = "django-db"
 CELERY_CACHE_BACKEND = "django-cache"
 CELERY_RESULT_EXTENDED = True
 
+# Warm the caches on a queue of its own, so it never holds up the forecast tasks. Workers
+# only take the default "celery" queue unless given it with -Q
+CACHE_WARMING_QUEUE = env.str("CACHE_WARMING_QUEUE", "cache_warming")
+CELERY_TASK_ROUTES = {"Warm caches": {"queue": CACHE_WARMING_QUEUE}}
+
 DATA_UPLOAD_MAX_MEMORY_SIZE = env.int(
     "DATA_UPLOAD_MAX_MEMORY_SIZE", 67108864
 )  # 2^26 or ~ 64MB default
@@ -24,3 +24,4 @@ urlpatterns = [
     path("accounts/", include("django.contrib.auth.urls")),
     path("", include("webapp.urls")),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+urlpatterns += static(settings.TILE_URL, document_root=settings.TILE_ROOT)
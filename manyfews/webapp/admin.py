@@ -1,3 +1,17 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import AlertDelivery
+
+
+@admin.register(AlertDelivery)
+class AlertDeliveryAdmin(admin.ModelAdmin):
+    list_display = [
+        "id",
+        "created_at",
+        "phone_number_id",
+        "status",
+        "attempts",
+        "provider_id",
+        "error",
+    ]
+    list_filter = ["status"]
@@ -1,9 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import os
+import threading
+import time
 
 from django.conf import settings
+from django.utils.module_loading import import_string
+import requests
 from twilio.rest import Client
 
+from .models import AlertDelivery, DeliveryStatus
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,20 +33,136 @@ class TwilioAlerts:
         ).verification_checks.create(to=phone_number, code=code)
         return verification_check.status
 
-    def send_alert_sms(self, phone_number, message):
-        self._send_alert_message(settings.TWILIO_PHONE_NUMBER, phone_number, message)
 
-    def send_alert_whatsapp(self, phone_number, message):
-        self._send_alert_message(
-            f"whatsapp:{settings.TWILIO_PHONE_NUMBER}",
-            f"whatsapp:{phone_number}",
-            message,
+class AlertDeliveryError(Exception):
+    def __init__(self, message, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class TwilioBackend:
+    """Sends alerts with the Twilio Messages API, reusing connections between alerts"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.ALERT_WORKERS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        self.url = (
+            f"{settings.TWILIO_API_URL}/Accounts/{settings.TWILIO_ACCOUNT_SID}"
+            "/Messages.json"
         )
 
-    def _send_alert_message(self, from_number, to_number, message):
+    def send(self, phone_number, message):
+        """Send a message to a phone number (prefixed whatsapp: for WhatsApp)"""
+        from_number = settings.TWILIO_PHONE_NUMBER
+        if phone_number.startswith("whatsapp:"):
+            from_number = f"whatsapp:{from_number}"
+
         try:
-            message = self.client.messages.create(
-                body=message, from_=from_number, to=to_number
+            response = self.session.post(
+                self.url,
+                data={"To": phone_number, "From": from_number, "Body": message},
+                timeout=settings.ALERT_TIMEOUT,
             )
-        except Exception as e:
-            logger.error(f"Unable to send message to {to_number}: {e}")
+        except requests.RequestException as e:
+            raise AlertDeliveryError(str(e), retryable=True)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get("Retry-After")
+            raise AlertDeliveryError(
+                f"HTTP {response.status_code}",
+                retryable=True,
+                retry_after=float(retry_after) if retry_after else None,
+            )
+        elif not response.ok:
+            raise AlertDeliveryError(
+                f"HTTP {response.status_code}: {response.text[:200]}"
+            )
+        return response.json().get("sid", "")
+
+
+class LoggingBackend:
+    """Logs alerts instead of sending them"""
+
+    def send(self, phone_number, message):
+        logger.info(f"Alert to {phone_number}: {message}")
+        return ""
+
+
+class RateLimiter:
+    """Spaces out calls from any number of threads to at most rate per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+class AlertDispatcher:
+    """
+    Sends alerts concurrently through the ALERT_BACKEND, within ALERT_RATE_LIMIT,
+    retrying failures which may succeed later and recording the outcome of each.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or import_string(settings.ALERT_BACKEND)()
+        self.rate_limiter = RateLimiter(settings.ALERT_RATE_LIMIT)
+
+    def send(self, alerts, on_delivery=None):
+        """
+        Each delivery is saved as soon as it succeeds or fails, so a batch interrupted
+        part way through still records the alerts already sent.
+
+        :param alerts: iterable of (phone_number_id, phone_number, message)
+        :param on_delivery: function called with each AlertDelivery once saved
+        :return: list of AlertDelivery records saved
+        """
+        deliveries = []
+        with ThreadPoolExecutor(max_workers=settings.ALERT_WORKERS) as executor:
+            futures = [executor.submit(self._send, *alert) for alert in alerts]
+            for future in as_completed(futures):
+                delivery = future.result()
+                delivery.save()
+                if on_delivery:
+                    on_delivery(delivery)
+                deliveries.append(delivery)
+
+        sent = sum(1 for d in deliveries if d.status == DeliveryStatus.SENT)
+        logger.info(f"Sent {sent} of {len(deliveries)} alerts")
+        return deliveries
+
+    def _send(self, phone_number_id, phone_number, message):
+        delivery = AlertDelivery(phone_number_id=phone_number_id, message=message)
+        for attempt in range(settings.ALERT_RETRIES + 1):
+            self.rate_limiter.wait()
+            delivery.attempts = attempt + 1
+            try:
+                delivery.provider_id = self.backend.send(phone_number, message)
+                delivery.status = DeliveryStatus.SENT
+                delivery.error = ""
+                return delivery
+            except AlertDeliveryError as e:
+                delivery.error = str(e)
+                if not e.retryable or attempt == settings.ALERT_RETRIES:
+                    break
+                time.sleep(e.retry_after or settings.ALERT_RETRY_BACKOFF * 2**attempt)
+            except Exception as e:
+                delivery.error = str(e)
+                break
+
+        logger.error(
+            f"Unable to send message to phone number id {phone_number_id}: "
+            f"{delivery.error}"
+        )
+        delivery.status = DeliveryStatus.FAILED
+        return delivery
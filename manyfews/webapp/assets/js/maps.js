@@ -1,46 +1,210 @@
 import $ from 'jquery';
 import {interpolateYlGnBu} from 'd3-scale-chromatic';
 
+// Media type of the binary depth format (see encode_depth_binary in webapp/views.py)
+var DEPTH_BINARY_CONTENT_TYPE = 'application/vnd.manyfews.depths';
 var floodOverlayLayerGroup = L.layerGroup();
+var floodTileLayer = null;
+var tileManifest = null;
 var currentDay = 0;
 var currentHour = 0;
+var depthSeries = null;
+var floodExtentLayer = null;
+var floodExtents = {};
+
+function getTileManifest() {
+  return fetch('/tiles/manifest.json')
+    .then(function(resp) {
+      return resp.ok ? resp.json() : null;
+    })
+    .catch(function() {
+      return null;
+    });
+}
+
+function getForecastTimeKey(day, hour) {
+  // Forecast times in the tile manifest are UTC, e.g. 2022-04-01T06:00:00Z
+  var now = new Date();
+  var forecastTime = new Date(Date.UTC(
+    now.getUTCFullYear(), now.getUTCMonth(), now.getUTCDate() + Number(day), Number(hour)
+  ));
+  return forecastTime.toISOString().replace('.000Z', 'Z');
+}
+
+function getFloodTiles(map, day, hour) {
+  // Use the pre-rendered tiles for this time if there are any at the current zoom
+  if (!tileManifest || map.getZoom() > Math.max(...tileManifest.zoom_levels)) {
+    return false;
+  }
+  var tilePath = tileManifest.times[getForecastTimeKey(day, hour)];
+  if (!tilePath) {
+    return false;
+  }
+
+  var tileUrl = tileManifest.url + tilePath + '/{z}/{x}/{y}.png';
+  if (!floodTileLayer) {
+    floodTileLayer = L.tileLayer(tileUrl, {
+      minNativeZoom: Math.min(...tileManifest.zoom_levels),
+      maxNativeZoom: Math.max(...tileManifest.zoom_levels),
+    });
+  } else {
+    floodTileLayer.setUrl(tileUrl);
+  }
+  floodOverlayLayerGroup.clearLayers();
+  floodTileLayer.addTo(map);
+  return true;
+}
+
+function getExtentsUrl(day, hour) {
+  return '/depths/' + day + '/' + hour + '/extents';
+}
+
+function getFloodExtents(map, day, hour) {
+  // Outline the flooded areas at this time over the depths, fetching each time once
+  var dataUrl = getExtentsUrl(day, hour);
+  if (!floodExtents[dataUrl]) {
+    floodExtents[dataUrl] = fetch(dataUrl)
+      .then(function(resp) {
+        return resp.ok ? resp.json() : null;
+      })
+      .catch(function() {
+        return null;
+      });
+  }
+  floodExtents[dataUrl].then(function(data) {
+    if (data && dataUrl === getExtentsUrl(currentDay, currentHour)) {
+      drawExtents(map, data);
+    }
+  });
+}
+
+function drawExtents(map, data) {
+  if (floodExtentLayer) {
+    floodExtentLayer.remove();
+  }
+  floodExtentLayer = L.geoJSON(data, {
+    style: function(feature) {
+      var depth = feature.properties.min_depth;
+      return {
+        color: interpolateYlGnBu(depth > data["max_depth"] ? 1 : depth/data["max_depth"]),
+        weight: 2,
+        fill: false
+      };
+    },
+    onEachFeature: function(feature, layer) {
+      layer.bindTooltip(
+        "Depth over " + feature.properties.min_depth.toFixed(2) + "m<br>Up to " +
+            feature.properties.max_depth.toFixed(2) + "m"
+      );
+    }
+  });
+  floodExtentLayer.addTo(map);
+}
 
 function getFloodOverlays(map, day, hour) {
   currentDay = day;
   currentHour = hour;
+  getFloodExtents(map, day, hour);
+  if (getFloodTiles(map, day, hour)) {
+    return;
+  }
+  if (floodTileLayer) {
+    floodTileLayer.remove();
+  }
+
+  // Draw from the depths already loaded for this area if possible, so stepping through
+  // the forecast times doesn't need any more requests
   var bounding_box = map.getBounds();
-  var dataUrl = '/depths/' + currentDay + '/'  + currentHour + '/' + bounding_box.getWest() + ',' + bounding_box.getSouth() + ','
+  if (depthSeries && depthSeries.zoom === map.getZoom() && depthSeries.bounds.contains(bounding_box)) {
+    drawDepths(map, getSeriesDepths(depthSeries.data, day, hour));
+    return;
+  }
+
+  var dataUrl = '/depths/series/' + bounding_box.getWest() + ',' + bounding_box.getSouth() + ','
     + bounding_box.getEast() + ',' + bounding_box.getNorth();
-  fetch(dataUrl)
+  fetch(dataUrl, {headers: {Accept: DEPTH_BINARY_CONTENT_TYPE}})
     .then(function(resp) {
-      return resp.json();
+      return resp.arrayBuffer();
     })
-    .then(function(data) {
-      floodOverlayLayerGroup.clearLayers();
-      data["items"].forEach(i => {
-        var colorVal = i.depth > data["max_depth"] ? 1 : i.depth/data["max_depth"];
-        var opacity = (i.upper_centile - i.lower_centile) > data["max_depth"] ? 0 : 1 - (i.upper_centile - i.lower_centile)/data["max_depth"];
-        var layer = L.rectangle(i.bounds,
-          {
-            color: null,
-            fillColor: interpolateYlGnBu(colorVal),
-            fillOpacity: opacity
-          }
-        );
-        layer.bindTooltip(
-          "Depth: " + i.depth.toFixed(2) + "m<br>Lower centile: " + i.lower_centile.toFixed(2) +
-              "m<br>Upper centile: " + i.upper_centile.toFixed(2) + "m"
-        );
-        floodOverlayLayerGroup.addLayer(layer);
-      });
-      floodOverlayLayerGroup.addTo(map);
+    .then(function(buffer) {
+      depthSeries = {bounds: bounding_box, zoom: map.getZoom(), data: decodeDepthSeries(buffer)};
+      drawDepths(map, getSeriesDepths(depthSeries.data, currentDay, currentHour));
     });
 }
 
+function decodeDepths(view, offset) {
+  // Decode the depths at one time in the binary format, which starts with a header of
+  // the number of cells and the grid they are on, followed by their indices on the grid
+  // and their depths in mm
+  var count = view.getUint32(offset + 4, true);
+  var originX = view.getFloat64(offset + 8, true);
+  var originY = view.getFloat64(offset + 16, true);
+  var cellWidth = view.getFloat64(offset + 24, true);
+  var cellHeight = view.getFloat64(offset + 32, true);
+  var maxDepth = view.getFloat32(offset + 40, true);
+  var indices = offset + 48;
+  var depths = indices + count * 4;
+  var items = [];
+  for (var i = 0; i < count; i++) {
+    var index = view.getUint32(indices + i * 4, true);
+    var west = originX + (index & 0xffff) * cellWidth;
+    var south = originY + (index >>> 16) * cellHeight;
+    items.push({
+      bounds: [[south, west], [south + cellHeight, west + cellWidth]],
+      depth: view.getUint16(depths + i * 6, true) / 1000,
+      lower_centile: view.getUint16(depths + i * 6 + 2, true) / 1000,
+      upper_centile: view.getUint16(depths + i * 6 + 4, true) / 1000,
+    });
+  }
+  return {items: items, max_depth: maxDepth, size: 48 + count * 10};
+}
+
+function decodeDepthSeries(buffer) {
+  // A series gives the depths at each forecast time in turn
+  var view = new DataView(buffer);
+  var steps = [];
+  var offset = 0;
+  while (offset < buffer.byteLength) {
+    var step = decodeDepths(view, offset);
+    steps.push(step);
+    offset += step.size;
+  }
+  return steps;
+}
+
+function getSeriesDepths(steps, day, hour) {
+  // Get the depths at a forecast time from a series of depths
+  return steps[Number(day) * 4 + Number(hour) / 6];
+}
+
+function drawDepths(map, data) {
+  floodOverlayLayerGroup.clearLayers();
+  data["items"].forEach(i => {
+    var colorVal = i.depth > data["max_depth"] ? 1 : i.depth/data["max_depth"];
+    var opacity = (i.upper_centile - i.lower_centile) > data["max_depth"] ? 0 : 1 - (i.upper_centile - i.lower_centile)/data["max_depth"];
+    var layer = L.rectangle(i.bounds,
+      {
+        color: null,
+        fillColor: interpolateYlGnBu(colorVal),
+        fillOpacity: opacity
+      }
+    );
+    layer.bindTooltip(
+      "Depth: " + i.depth.toFixed(2) + "m<br>Lower centile: " + i.lower_centile.toFixed(2) +
+          "m<br>Upper centile: " + i.upper_centile.toFixed(2) + "m"
+    );
+    floodOverlayLayerGroup.addLayer(layer);
+  });
+  floodOverlayLayerGroup.addTo(map);
+}
+
 export function initialiseDepthMap() {
   window.addEventListener("map:init", function (e) {
     var detail = e.detail;
-    getFloodOverlays(detail.map, currentDay, currentHour);
+    getTileManifest().then(function(manifest) {
+      tileManifest = manifest;
+      getFloodOverlays(detail.map, currentDay, currentHour);
+    });
     detail.map.on('moveend', function() {
       getFloodOverlays(detail.map, currentDay, currentHour);
     });
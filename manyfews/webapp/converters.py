@@ -1,4 +1,4 @@
-from django.contrib.gis.geos import Polygon
+from django.contrib.gis.geos import Point, Polygon
 
 
 class BoundingBoxUrlParameterConverter:
@@ -26,3 +26,29 @@ class BoundingBoxUrlParameterConverter:
 
     def to_url(self, value):
         return str(value)
+
+
+class PointUrlParameterConverter:
+    """
+    Class to convert GIS coordinates representing a point from a string in the URL
+    into a GEOS Point object.
+
+    Expects comma-separated (x, y) coordinates, e.g. 107.75,-7.05
+    """
+
+    regex = r"\-?[0-9]+(\.?[0-9]+)?,\-?[0-9]+(\.?[0-9]+)?"
+
+    def to_python(self, value):
+        vals = value.split(",")
+        if len(vals) != 2:
+            raise ValueError(f"Invalid coordinates {value}")
+
+        try:
+            point = Point(float(vals[0]), float(vals[1]))
+        except:
+            raise ValueError(f"Invalid coordinates {value}")
+
+        return point
+
+    def to_url(self, value):
+        return f"{value.x},{value.y}"
@@ -0,0 +1,103 @@
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSmsServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Twilio Messages API, to test and load test alerts offline.
+
+    Accepts messages posted to /Accounts/<sid>/Messages.json after latency seconds.
+    Answers 429 (Too Many Requests) when more than rate_limit messages arrive in a
+    second, 400 to numbers in reject, and 503 to the first failures other messages.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        rate_limit=None,
+        failures=0,
+        reject=(),
+        latency=0,
+    ):
+        super().__init__(address, FakeSmsHandler)
+        self.rate_limit = rate_limit
+        self.failures = failures
+        self.reject = set(reject)
+        self.latency = latency
+        self.messages = []
+        self.requests = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.recent = deque()
+        # Times the first and last messages were accepted, to measure throughput
+        self.first_time = None
+        self.last_time = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def receive(self, data):
+        """Return the status and response for a message posted to the server"""
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self.recent and self.recent[0] <= now - 1:
+                self.recent.popleft()
+            if self.rate_limit and len(self.recent) >= self.rate_limit:
+                return 429, {"code": 20429, "message": "Too Many Requests"}
+            self.recent.append(now)
+
+            if data.get("To") in self.reject:
+                return 400, {"code": 21211, "message": "Invalid 'To' Phone Number"}
+            if self.failed < self.failures:
+                self.failed += 1
+                return 503, {"code": 20503, "message": "Service Unavailable"}
+
+            self.messages.append(data)
+            sid = f"SM{len(self.messages):032x}"
+            self.first_time = self.first_time or now
+            self.last_time = now
+
+        return 201, {"sid": sid, "status": "queued", **data}
+
+
+class FakeSmsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if not re.fullmatch(r"/Accounts/[^/]+/Messages\.json", self.path):
+            self.respond(404, {"code": 20404, "message": "Not Found"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        data = {
+            key: values[0]
+            for key, values in parse_qs(self.rfile.read(length).decode()).items()
+        }
+        self.respond(*self.server.receive(data))
+
+    def respond(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
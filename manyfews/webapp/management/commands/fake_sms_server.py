@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from webapp.fake_sms import FakeSmsServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for the Twilio Messages API. Set TWILIO_API_URL to the "
+        "URL shown to send alerts to it, e.g. to load test sending alerts offline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8025)
+        parser.add_argument(
+            "--rate-limit",
+            type=int,
+            help="Maximum messages per second before answering 429",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Seconds to wait before answering each message",
+        )
+
+    def handle(self, *args, **options):
+        server = FakeSmsServer(
+            (options["host"], options["port"]),
+            rate_limit=options["rate_limit"],
+            latency=options["latency"],
+        )
+        self.stdout.write(f"Fake SMS server running at {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+        self.stdout.write(
+            f"Received {len(server.messages)} messages from {server.requests} requests"
+        )
+        if len(server.messages) > 1:
+            elapsed = server.last_time - server.first_time
+            self.stdout.write(
+                f"{len(server.messages) / elapsed:.1f} messages per second"
+                if elapsed
+                else "All messages received at once"
+            )
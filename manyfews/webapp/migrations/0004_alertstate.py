@@ -0,0 +1,41 @@
+# Generated by Django 4.1.3 on 2026-10-19 15:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("webapp", "0003_alertdelivery"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AlertState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start_date", models.DateTimeField()),
+                ("end_date", models.DateTimeField()),
+                ("max_depth", models.FloatField()),
+                ("depth_band", models.IntegerField()),
+                ("sent_at", models.DateTimeField()),
+                (
+                    "alert",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="state",
+                        to="webapp.useralert",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -40,10 +40,49 @@ class UserAlert(models.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__original_phone_number_id = self.phone_number_id
+        self.__original_location = self.location
 
     def save(self, force_insert=False, force_update=False, *args, **kwargs):
+        changed = (
+            self.phone_number_id != self.__original_phone_number_id
+            or self.location != self.__original_location
+        )
         if self.phone_number_id != self.__original_phone_number_id:
             self.verified = False
 
         super().save(force_insert, force_update, *args, **kwargs)
         self.__original_phone_number_id = self.phone_number_id
+        self.__original_location = self.location
+
+        # Alert about the flooding at a new location or number, even if unchanged
+        if changed:
+            AlertState.objects.filter(alert=self).delete()
+
+
+class AlertState(models.Model):
+    # Summary of the flooding at an alert's location when an alert was last sent for it
+    alert = models.OneToOneField(
+        UserAlert, on_delete=models.CASCADE, related_name="state"
+    )
+    start_date = models.DateTimeField()
+    end_date = models.DateTimeField()
+    max_depth = models.FloatField()
+    depth_band = models.IntegerField()
+    sent_at = models.DateTimeField()
+
+
+class DeliveryStatus(models.TextChoices):
+    SENT = "sent", "Sent"
+    FAILED = "failed", "Failed"
+
+
+class AlertDelivery(models.Model):
+    # Outcome of sending an alert message to a phone number
+    phone_number = models.ForeignKey(UserPhoneNumber, on_delete=models.CASCADE)
+    message = models.TextField()
+    status = models.CharField(max_length=8, choices=DeliveryStatus.choices)
+    # Message id given by the provider
+    provider_id = models.CharField(max_length=64, blank=True, default="")
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
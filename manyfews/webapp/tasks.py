@@ -0,0 +1,137 @@
+import json
+import logging
+import math
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from celery import shared_task
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.utils import timezone
+
+from calculations.tiles import TILE_SIZE, tile_range
+from .views import (
+    get_daily_risks,
+    get_depth_series,
+    get_flood_extents,
+    get_published_run,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def get_viewport(center, zoom, width, height):
+    """
+    Get the bounding box shown by a web mercator map of width x height pixels,
+    centred on center (lat, lon) at a zoom level.
+    """
+    scale = TILE_SIZE * 2**zoom
+    lat, lon = center
+    x = (lon + 180) / 360 * scale
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * scale
+
+    def to_lon_lat(pixel_x, pixel_y):
+        lon = pixel_x / scale * 360 - 180
+        lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * pixel_y / scale))))
+        return lon, lat
+
+    west, north = to_lon_lat(x - width / 2, y - height / 2)
+    east, south = to_lon_lat(x + width / 2, y + height / 2)
+    return Polygon.from_bbox((west, south, east, north))
+
+
+def read_tiles(tile_dir, bounds, z):
+    """
+    Read the depth tiles rendered at zoom z covering lon/lat bounds, bringing them into
+    the page cache for the web server.
+
+    :return: the number of tiles read.
+    """
+    count = 0
+    x_min, y_min, x_max, y_max = tile_range(bounds, z)
+    for x in range(x_min, x_max + 1):
+        for y in range(y_min, y_max + 1):
+            try:
+                tile_dir.joinpath(str(z), str(x), f"{y}.png").read_bytes()
+                count += 1
+            except FileNotFoundError:
+                # No tiles are rendered where nothing floods
+                pass
+    return count
+
+
+@shared_task(name="Warm caches")
+def warm_caches(time_limit=None):
+    """
+    Fill the caches of the responses most visitors request after a run is published:
+    the home page risks, the flood extents at each forecast time, the depth tiles for
+    the map's default view, then the series of depths the map draws from once zoomed in
+    past the tiles. Stops once time_limit seconds have passed.
+
+    :return: a report of what was warmed.
+    """
+    if time_limit is None:
+        time_limit = settings.CACHE_WARMING_TIME_LIMIT
+    deadline = time.monotonic() + time_limit
+    run = get_published_run()
+    report = {
+        "run": run.id if run else None,
+        "risks": False,
+        "extents": 0,
+        "tiles": 0,
+        "series": False,
+        "complete": False,
+    }
+
+    def finish():
+        logger.info(f"Warmed caches: {report}")
+        return report
+
+    if time.monotonic() >= deadline:
+        return finish()
+    get_daily_risks()
+    report["risks"] = True
+
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in range(10):
+        for hour in range(0, 24, 6):
+            if time.monotonic() >= deadline:
+                return finish()
+            get_flood_extents(today + timedelta(days=day, hours=hour))
+            report["extents"] += 1
+
+    # The map uses the tiles up to their highest zoom level, then the series
+    default_zoom = settings.LEAFLET_CONFIG["DEFAULT_ZOOM"]
+    viewport = get_viewport(
+        settings.MAP_CENTER, default_zoom, *settings.CACHE_WARMING_VIEWPORT
+    )
+    series_zoom = default_zoom
+    tile_root = Path(settings.TILE_ROOT)
+    try:
+        with open(tile_root.joinpath("manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = None
+    if manifest and default_zoom <= max(manifest["zoom_levels"]):
+        tile_zoom = max(default_zoom, min(manifest["zoom_levels"]))
+        for tile_path in manifest["times"].values():
+            if time.monotonic() >= deadline:
+                return finish()
+            report["tiles"] += read_tiles(
+                tile_root.joinpath(tile_path), viewport.extent, tile_zoom
+            )
+        series_zoom = max(manifest["zoom_levels"]) + 1
+
+    if time.monotonic() >= deadline:
+        return finish()
+    get_depth_series(
+        get_viewport(
+            settings.MAP_CENTER, series_zoom, *settings.CACHE_WARMING_VIEWPORT
+        ),
+        "binary",
+    )
+    report["series"] = True
+
+    report["complete"] = True
+    return finish()
@@ -1,11 +1,23 @@
+import json
 import re
+import tempfile
+import threading
+import time
 from time import sleep
 from unittest import mock
 
-from django.contrib.gis.geos import Polygon
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point, Polygon
+from django.core.cache import cache
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from django.core import mail
 from django.test import TestCase, LiveServerTestCase
+from django.utils import timezone
+import numpy as np
 from selenium import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
@@ -13,8 +25,34 @@ from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait, Select
 
-from .alerts import TwilioAlerts
-from .converters import BoundingBoxUrlParameterConverter
+from .alerts import AlertDispatcher, TwilioAlerts, TwilioBackend
+from calculations.flood_risk import (
+    build_flood_extents,
+    calculate_risk_percentages,
+    publish_run,
+)
+from calculations.models import (
+    AggregatedDepthPrediction,
+    DepthPrediction,
+    FloodModelParameters,
+    ModelVersion,
+    PercentageFloodRisk,
+    PublishedRun,
+    RiverFlowCalculationOutput,
+    RiverFlowPrediction,
+)
+from calculations.tiles import lon_lat_to_tile
+from .converters import BoundingBoxUrlParameterConverter, PointUrlParameterConverter
+from .fake_sms import FakeSmsServer
+from .models import AlertDelivery, DeliveryStatus, UserPhoneNumber
+from .tasks import get_viewport, warm_caches
+from .views import (
+    DEPTH_BINARY_CONTENT_TYPE,
+    DEPTH_BINARY_HEADER,
+    choose_aggregation_level,
+    get_aggregation_level,
+    get_fragment_size,
+)
 
 
 class ConverterTestCase(TestCase):
@@ -41,6 +79,664 @@ class ConverterTestCase(TestCase):
         assert not re.fullmatch(converter.regex, "1,2-")
         assert not re.fullmatch(converter.regex, "not,a,valid,coordinate")
 
+    def test_point_url_parameter_converter(self):
+        converter = PointUrlParameterConverter()
+
+        point = converter.to_python("-1,2.345")
+        assert point == Point(-1, 2.345)
+        assert converter.to_url(point) == "-1.0,2.345"
+
+        self.assertRaises(ValueError, converter.to_python, "1,2,3")
+        self.assertRaises(ValueError, converter.to_python, "not,valid")
+
+        assert re.fullmatch(converter.regex, "107.75,-7.05")
+        assert not re.fullmatch(converter.regex, "1,2,3,4")
+        assert not re.fullmatch(converter.regex, "1")
+
+
+class IndexTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_daily_risks(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        PercentageFloodRisk(date=today + timedelta(days=1, hours=6), risk=0.5).save()
+
+        # All risks are fetched in one query (after finding the published run), then
+        # cached
+        with self.assertNumQueries(2):
+            response = self.client.get("/")
+        risks = response.context["daily_risks"]
+        assert len(risks) == 10
+        assert [r["risk"] for r in risks[1]["risks"]] == [0, 0.5, 0, 0]
+
+        with self.assertNumQueries(0):
+            self.client.get("/")
+
+        # Updating the risks clears the cache
+        calculate_risk_percentages()
+        with self.assertNumQueries(1):
+            self.client.get("/")
+
+    def test_conditional_requests(self):
+        response = self.client.get("/")
+        assert response["Cache-Control"] == "private, no-cache"
+        etag = response["ETag"]
+
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+
+class DepthViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_get_aggregation_level(self):
+        assert get_aggregation_level(0.0005) == -1
+        assert get_aggregation_level(0.002) == 256
+        assert get_aggregation_level(0.004) == 128
+        assert get_aggregation_level(0.008) == 64
+        assert get_aggregation_level(1) == 32
+
+    def test_get_fragment_size(self):
+        assert get_fragment_size(-1) == 0.0005
+        assert get_fragment_size(256) == 0.001
+        # Other levels have fragments in proportion to their blocks
+        assert get_fragment_size(512) == 0.000625
+        assert get_fragment_size(16) == 0.02
+
+    def test_depth_predictions_configured_level(self):
+        # A level only in AGGREGATION_LEVELS, chosen as the cells are over budget
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.add_depth_predictions()
+        AggregatedDepthPrediction(
+            date=today + timedelta(days=1, hours=6),
+            bounding_box=Polygon.from_bbox((0, 0, 0.0004, 0.0004)),
+            aggregation_level=512,
+            model_version=ModelVersion.objects.get(),
+            median_depth=2,
+            lower_centile=0.5,
+            mid_lower_centile=0.7,
+            upper_centile=2.5,
+            cell_count=3,
+        ).save()
+        RiverFlowCalculationOutput(
+            prediction_date=today,
+            forecast_time=today,
+            rain_fall=0,
+            potential_evapotranspiration=0,
+        ).save()
+        publish_run()
+
+        with self.settings(
+            AGGREGATION_LEVELS=(32, 64, 128, 256, 512), DEPTH_CELL_BUDGET=1
+        ):
+            response = self.client.get("/depths/1/6/0,0,0.0005,0.0005")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["aggregation_level"] == 512
+        assert len(data["items"]) == 1
+
+    def add_depth_predictions(self):
+        # Add predictions for a row of 3 cells, for tomorrow at 06:00
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        model_version = ModelVersion(version_name="v1", is_current=True)
+        model_version.save()
+        for i in range(3):
+            parameters = FloodModelParameters(
+                model_version=model_version,
+                bounding_box=Polygon.from_bbox(
+                    (i * 0.0001, 0, (i + 1) * 0.0001, 0.0001)
+                ),
+                beta0=0,
+            )
+            parameters.save()
+            DepthPrediction(
+                date=today + timedelta(days=1, hours=6),
+                parameters=parameters,
+                median_depth=i + 1,
+                lower_centile=0.5,
+                mid_lower_centile=0.7,
+                upper_centile=i + 1.5,
+                model_version=model_version,
+            ).save()
+
+    def test_depth_predictions(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.add_depth_predictions()
+
+        # Individual cells are shown in one query (after estimating the number of
+        # cells), once the published run is cached
+        self.client.get("/depths/1/6/0,0,0.0005,0.0005")
+        with self.assertNumQueries(2):
+            response = self.client.get("/depths/1/6/0,0,0.0005,0.0005")
+        data = response.json()
+        assert data["aggregation_level"] == -1
+        assert len(data["items"]) == 3
+        item = sorted(data["items"], key=lambda i: i["depth"])[1]
+        assert item["bounds"] == [[0, 0.0001], [0.0001, 0.0002]]
+        assert item["depth"] == 2
+        assert item["lower_centile"] == 0.5
+        assert item["upper_centile"] == 2.5
+
+        # Large responses are streamed, with the same content
+        with mock.patch("webapp.views.DEPTH_STREAM_THRESHOLD", 1), mock.patch(
+            "webapp.views.DEPTH_STREAM_CHUNK_SIZE", 2
+        ):
+            response = self.client.get("/depths/1/6/0,0,0.0005,0.0005")
+        assert response.streaming
+        assert json.loads(b"".join(response.streaming_content)) == data
+
+        # Once a run is published, responses are built from cached fragments, which
+        # are shared by requests for overlapping areas
+        RiverFlowCalculationOutput(
+            prediction_date=today,
+            forecast_time=today,
+            rain_fall=0,
+            potential_evapotranspiration=0,
+        ).save()
+        publish_run()
+        items = sorted(data["items"], key=lambda i: i["depth"])
+        response = self.client.get("/depths/1/6/0,0,0.0005,0.0005")
+        assert sorted(response.json()["items"], key=lambda i: i["depth"]) == items
+        with self.assertNumQueries(0):
+            response = self.client.get("/depths/1/6/0.0001,0,0.0006,0.0005")
+        assert sorted(response.json()["items"], key=lambda i: i["depth"]) == items
+
+        # Fragments are cached for each forecast time
+        with self.assertNumQueries(2):
+            response = self.client.get("/depths/1/12/0,0,0.0005,0.0005")
+        assert response.json()["items"] == []
+
+    def test_depth_predictions_fragment_edges(self):
+        # Two cells either side of the edge of a fragment, the first with its centre in
+        # the fragment to the west of the one requested
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        model_version = ModelVersion(version_name="v1", is_current=True)
+        model_version.save()
+        for x in (0.00042, 0.00052):
+            parameters = FloodModelParameters(
+                model_version=model_version,
+                bounding_box=Polygon.from_bbox((x, 0, x + 0.0001, 0.0001)),
+                beta0=0,
+            )
+            parameters.save()
+            DepthPrediction(
+                date=today + timedelta(days=1, hours=6),
+                parameters=parameters,
+                median_depth=1,
+                lower_centile=0.5,
+                mid_lower_centile=0.7,
+                upper_centile=1.5,
+                model_version=model_version,
+            ).save()
+        RiverFlowCalculationOutput(
+            prediction_date=today,
+            forecast_time=today,
+            rain_fall=0,
+            potential_evapotranspiration=0,
+        ).save()
+        publish_run()
+
+        # Both cells cross into the area, so both are shown
+        response = self.client.get("/depths/1/6/0.0005,0,0.0009,0.0004")
+        data = response.json()
+        assert data["aggregation_level"] == -1
+        assert len(data["items"]) == 2
+
+    def test_depth_predictions_binary(self):
+        self.add_depth_predictions()
+        url = "/depths/1/6/0,0,0.0005,0.0005"
+        json_response = self.client.get(url)
+        response = self.client.get(url, HTTP_ACCEPT=DEPTH_BINARY_CONTENT_TYPE)
+        assert response["Content-Type"] == DEPTH_BINARY_CONTENT_TYPE
+        assert "Accept" in response["Vary"]
+        assert response["ETag"] != json_response["ETag"]
+        assert len(response.content) < len(json_response.content) / 4
+
+        content = response.content
+        header = DEPTH_BINARY_HEADER.unpack(content[: DEPTH_BINARY_HEADER.size])
+        magic, count, x, y, width, height, max_depth, level = header
+        assert magic == b"MFD1"
+        assert count == 3
+        assert (x, y) == (0, 0)
+        self.assertAlmostEqual(width, 0.0001)
+        self.assertAlmostEqual(height, 0.0001)
+        assert max_depth == 2
+        assert level == -1
+
+        indices = np.frombuffer(content, "<u4", count, DEPTH_BINARY_HEADER.size)
+        depths = np.frombuffer(
+            content, "<u2", count * 3, DEPTH_BINARY_HEADER.size + count * 4
+        ).reshape(count, 3)
+        cells = sorted(zip(indices & 0xFFFF, indices >> 16, depths.tolist()))
+        assert cells == [
+            (0, 0, [1000, 500, 1500]),
+            (1, 0, [2000, 500, 2500]),
+            (2, 0, [3000, 500, 3500]),
+        ]
+
+    def test_choose_aggregation_level(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.add_depth_predictions()
+        model_version = ModelVersion.objects.get()
+        AggregatedDepthPrediction(
+            date=today + timedelta(days=1, hours=6),
+            bounding_box=Polygon.from_bbox((0, 0, 0.0004, 0.0004)),
+            aggregation_level=256,
+            model_version=model_version,
+            cell_count=3,
+            median_depth=2,
+            lower_centile=0.5,
+            mid_lower_centile=0.7,
+            upper_centile=2.5,
+        ).save()
+        times = [today + timedelta(days=1, hours=6)]
+        bounding_box = Polygon.from_bbox((0, 0, 0.0005, 0.0005))
+
+        with self.settings(DEPTH_CELL_BUDGET=3):
+            assert choose_aggregation_level(times, bounding_box) == -1
+
+        # Too many cells, so use the finest aggregation level
+        with self.settings(DEPTH_CELL_BUDGET=2):
+            assert choose_aggregation_level(times, bounding_box) == 256
+            data = self.client.get("/depths/1/6/0,0,0.0005,0.0005").json()
+            assert data["aggregation_level"] == 256
+            assert len(data["items"]) == 1
+
+        # Coarser levels have fewer blocks
+        with self.settings(DEPTH_CELL_BUDGET=0.5):
+            assert choose_aggregation_level(times, bounding_box) == 128
+        with self.settings(DEPTH_CELL_BUDGET=0):
+            assert choose_aggregation_level(times, bounding_box) == 32
+
+        # Larger areas are already at the coarsest level
+        assert choose_aggregation_level(times, Polygon.from_bbox((0, 0, 1, 1))) == 32
+
+    def test_depth_series(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.add_depth_predictions()
+
+        # All forecast times are fetched in one query (after finding the published
+        # run and estimating the number of cells), then cached
+        with self.assertNumQueries(3):
+            response = self.client.get("/depths/series/0,0,0.0005,0.0005")
+        series = response.json()
+        assert series["aggregation_level"] == -1
+        assert len(series["times"]) == 40
+        assert len(series["steps"]) == 40
+        assert len(series["cells"]) == 3
+        # Tomorrow at 06:00 is the 7th time
+        flooded_cells = [len(step["cells"]) for step in series["steps"]]
+        assert flooded_cells == [0] * 6 + [3] + [0] * 33
+
+        step = series["steps"][6]
+        cells = sorted(
+            (series["cells"][cell], depth, lower, upper)
+            for cell, depth, lower, upper in zip(
+                step["cells"],
+                step["depth"],
+                step["lower_centile"],
+                step["upper_centile"],
+            )
+        )
+        assert cells[1] == ([0, 0.0001, 0.0001, 0.0002], 2, 0.5, 2.5)
+
+        with self.assertNumQueries(0):
+            self.client.get("/depths/series/0,0,0.0005,0.0005")
+
+        # In the binary format, the depths at each time follow each other
+        response = self.client.get(
+            "/depths/series/0,0,0.0005,0.0005", HTTP_ACCEPT=DEPTH_BINARY_CONTENT_TYPE
+        )
+        assert response["Content-Type"] == DEPTH_BINARY_CONTENT_TYPE
+        content = response.content
+        offset = 0
+        flooded_cells = []
+        for i in range(40):
+            magic, count, *header = DEPTH_BINARY_HEADER.unpack_from(content, offset)
+            assert magic == b"MFD1"
+            flooded_cells.append(count)
+            offset += DEPTH_BINARY_HEADER.size + count * 10
+        assert offset == len(content)
+        assert flooded_cells == [0] * 6 + [3] + [0] * 33
+
+        # Aggregated blocks are listed once, whichever times they flood at
+        model_version = ModelVersion.objects.get()
+        for day in (0, 2):
+            AggregatedDepthPrediction(
+                date=today + timedelta(days=day),
+                bounding_box=Polygon.from_bbox((0, 0, 0.01, 0.01)),
+                aggregation_level=32,
+                model_version=model_version,
+                median_depth=day,
+                lower_centile=0,
+                mid_lower_centile=0,
+                upper_centile=day,
+            ).save()
+        series = self.client.get("/depths/series/0,0,0.02,0.02").json()
+        assert series["aggregation_level"] == 32
+        assert series["cells"] == [[0, 0, 0.01, 0.01]]
+        assert series["steps"][0]["cells"] == [0]
+        assert series["steps"][8]["cells"] == [0]
+        assert series["steps"][8]["depth"] == [2]
+
+    def test_hydrograph(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.add_depth_predictions()
+
+        response = self.client.get("/depths/point/0.00015,0.00005")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["location"] == [0.00015, 0.00005]
+        assert data["cell"] == [0, 0.0001, 0.0001, 0.0002]
+        assert len(data["times"]) == 40
+        assert data["median_depth"] == [0] * 6 + [2] + [0] * 33
+        assert data["upper_centile"][6] == 2.5
+        assert data["river_flow"] is None
+
+        # Points outside any cell have no depths
+        data = self.client.get("/depths/point/1,1").json()
+        assert data["cell"] is None
+        assert data["median_depth"] == [0] * 40
+
+        # River flow centiles from the published run
+        for hour in (0, 6):
+            output = RiverFlowCalculationOutput(
+                prediction_date=today,
+                forecast_time=today + timedelta(hours=hour),
+                rain_fall=0,
+                potential_evapotranspiration=0,
+            )
+            output.save()
+            for flow in range(11):
+                RiverFlowPrediction(
+                    prediction_index=flow, calculation_output=output, river_flow=flow
+                ).save()
+        publish_run()
+
+        data = self.client.get("/depths/point/0.00015,0.00005").json()
+        assert data["median_depth"][6] == 2
+        assert len(data["river_flow"]["times"]) == 2
+        assert data["river_flow"]["centiles"]["10"] == [1, 1]
+        assert data["river_flow"]["centiles"]["50"] == [5, 5]
+
+        # Cached until the next run
+        with self.assertNumQueries(0):
+            self.client.get("/depths/point/0.00015,0.00005")
+
+    def test_flood_extents(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.add_depth_predictions()
+        build_flood_extents(
+            today + timedelta(days=1, hours=6), ModelVersion.get_current_id()
+        )
+
+        # The row of cells is one outline in each band up to its 30th centile depth
+        data = self.client.get("/depths/1/6/extents").json()
+        assert data["type"] == "FeatureCollection"
+        assert [f["properties"]["min_depth"] for f in data["features"]] == [0.1, 0.5]
+        assert data["features"][0]["properties"]["max_depth"] == 3
+        assert data["features"][0]["geometry"]["type"] == "Polygon"
+
+        # Cached until the next run
+        with self.assertNumQueries(0):
+            self.client.get("/depths/1/6/extents")
+
+        # No extents at other times
+        assert self.client.get("/depths/2/6/extents").json()["features"] == []
+
+    def test_depth_predictions_conditional(self):
+        url = "/depths/1/6/0,0,0.0005,0.0005"
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert "public" in response["Cache-Control"]
+        assert "max-age" in response["Cache-Control"]
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+
+        # Unchanged until a run is published
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 304
+
+        model_version = ModelVersion(version_name="v1", is_current=True)
+        model_version.save()
+        FloodModelParameters(
+            model_version=model_version,
+            bounding_box=Polygon.from_bbox((0, 0, 0.0001, 0.0001)),
+            beta0=0,
+        ).save()
+        RiverFlowCalculationOutput(
+            prediction_date=timezone.now(),
+            forecast_time=timezone.now(),
+            rain_fall=0,
+            potential_evapotranspiration=0,
+        ).save()
+        run = publish_run()
+        assert run.model_version == model_version
+        assert PublishedRun.get_latest() == run
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response["ETag"] != etag
+
+        # Runs published by a process not sharing the cache are seen once the cached
+        # run expires
+        etag = response["ETag"]
+        PublishedRun.objects.create(
+            prediction_date=run.prediction_date, model_version=model_version
+        )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        expired = time.time() + settings.PUBLISHED_RUN_CACHE_TIMEOUT + 1
+        with mock.patch("django.core.cache.backends.locmem.time.time") as time_mock:
+            time_mock.return_value = expired
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+
+    def test_depth_tile(self):
+        # x and y must be within the tiles at the zoom level
+        response = self.client.get("/depths/0/0/tiles/1/5/0.mvt")
+        assert response.status_code == 404
+
+        # Empty tile as there are no predictions
+        response = self.client.get("/depths/0/0/tiles/10/0/0.mvt")
+        assert response.status_code == 200
+        assert response["Content-Type"] == "application/vnd.mapbox-vector-tile"
+        assert "max-age" in response["Cache-Control"]
+
+        # Individual cells are given at high zoom levels, in the tile north east of 0, 0
+        self.add_depth_predictions()
+        response = self.client.get("/depths/1/6/tiles/21/1048576/1048575.mvt")
+        assert response.status_code == 200
+        assert b"depths" in response.content
+
+    def test_depth_raster(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        forecast_time = today + timedelta(days=1, hours=6)
+        content = bytes(range(100))
+        with tempfile.TemporaryDirectory() as tmp_dir, self.settings(
+            RASTER_ROOT=tmp_dir
+        ):
+            response = self.client.get("/depths/1/6/raster.tif")
+            assert response.status_code == 404
+
+            path = Path(tmp_dir).joinpath(
+                f"{today:%Y%m%d}", f"{forecast_time:%Y%m%dT%H%M}.tif"
+            )
+            path.parent.mkdir()
+            path.write_bytes(content)
+
+            # The whole raster
+            response = self.client.get("/depths/1/6/raster.tif")
+            assert response.status_code == 200
+            assert response["Accept-Ranges"] == "bytes"
+            assert b"".join(response.streaming_content) == content
+            response.close()
+
+            # Ranges of the raster
+            for header, expected in (
+                ("bytes=10-19", (10, 19)),
+                ("bytes=90-", (90, 99)),
+                ("bytes=-5", (95, 99)),
+                ("bytes=95-200", (95, 99)),
+            ):
+                response = self.client.get("/depths/1/6/raster.tif", HTTP_RANGE=header)
+                assert response.status_code == 206
+                first, last = expected
+                assert response["Content-Range"] == f"bytes {first}-{last}/100"
+                assert response.content == content[first : last + 1]
+
+            # Ranges past the end can't be satisfied, and invalid ranges are ignored
+            response = self.client.get(
+                "/depths/1/6/raster.tif", HTTP_RANGE="bytes=100-"
+            )
+            assert response.status_code == 416
+            assert response["Content-Range"] == "bytes */100"
+            response = self.client.get("/depths/1/6/raster.tif", HTTP_RANGE="bytes=9-3")
+            assert response.status_code == 200
+            response.close()
+
+
+class CacheWarmingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_get_viewport(self):
+        # The whole world at zoom 0
+        extent = get_viewport((0, 0), 0, 256, 256).extent
+        self.assertAlmostEqual(extent[0], -180)
+        self.assertAlmostEqual(extent[1], -85.0511287798)
+        self.assertAlmostEqual(extent[2], 180)
+        self.assertAlmostEqual(extent[3], 85.0511287798)
+
+        # Each zoom level halves the size
+        extent = get_viewport((0, 10), 2, 256, 256).extent
+        self.assertAlmostEqual(extent[0], -35)
+        self.assertAlmostEqual(extent[2], 55)
+
+    def test_warm_caches(self):
+        report = warm_caches(time_limit=0)
+        assert report["risks"] is False
+        assert report["complete"] is False
+
+        with tempfile.TemporaryDirectory() as tmp_dir, self.settings(TILE_ROOT=tmp_dir):
+            # One tile rendered in the map's default view
+            lat, lon = settings.MAP_CENTER
+            zoom = settings.LEAFLET_CONFIG["DEFAULT_ZOOM"]
+            x, y = lon_lat_to_tile(lon, lat, zoom)
+            tile_dir = Path(tmp_dir).joinpath("20220401", "20220401T0000")
+            tile_dir.joinpath(str(zoom), str(x)).mkdir(parents=True)
+            tile_dir.joinpath(str(zoom), str(x), f"{y}.png").write_bytes(b"png")
+            with open(Path(tmp_dir).joinpath("manifest.json"), "w") as manifest:
+                json.dump(
+                    {
+                        "url": "/tiles/",
+                        "zoom_levels": list(range(10, zoom + 2)),
+                        "runs": ["20220401"],
+                        "times": {"2022-04-01T00:00:00Z": "20220401/20220401T0000"},
+                    },
+                    manifest,
+                )
+
+            report = warm_caches(time_limit=600)
+        assert report["risks"] is True
+        assert report["extents"] == 40
+        assert report["tiles"] == 1
+        assert report["series"] is True
+        assert report["tiles"] > 0
+        assert report["complete"] is True
+
+        # The home page risks are now cached
+        with self.assertNumQueries(0):
+            self.client.get("/")
+
+
+class AlertDispatcherTestCase(TestCase):
+    def setUp(self):
+        user = User(username="user1")
+        user.save()
+        self.phone_numbers = [
+            UserPhoneNumber.objects.create(user=user, phone_number=f"+4412345678{i:02}")
+            for i in range(10)
+        ]
+
+    def send_alerts(self, server, on_delivery=None, **settings):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with self.settings(
+                TWILIO_API_URL=server.url,
+                TWILIO_ACCOUNT_SID="AC123",
+                ALERT_WORKERS=4,
+                ALERT_RATE_LIMIT=None,
+                ALERT_RETRY_BACKOFF=0.01,
+                **settings,
+            ):
+                return AlertDispatcher(TwilioBackend()).send(
+                    [
+                        (phone_number.id, str(phone_number.phone_number), "Flood")
+                        for phone_number in self.phone_numbers
+                    ],
+                    on_delivery,
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_send(self):
+        # Retry the first 3 requests, which fail, and don't retry rejected numbers
+        server = FakeSmsServer(failures=3, reject=["+441234567805"])
+
+        # Each delivery is saved as it completes, rather than after the whole batch
+        recorded = []
+
+        def on_delivery(delivery):
+            assert AlertDelivery.objects.count() == len(recorded) + 1
+            recorded.append(delivery.id)
+
+        deliveries = self.send_alerts(server, on_delivery)
+        assert sorted(recorded) == sorted(d.id for d in deliveries)
+
+        assert len(server.messages) == 9
+        assert server.requests == 13
+        assert {m["To"] for m in server.messages} == {
+            str(p.phone_number) for p in self.phone_numbers
+        } - {"+441234567805"}
+        assert server.messages[0]["Body"] == "Flood"
+
+        statuses = {d.phone_number_id: d.status for d in AlertDelivery.objects.all()}
+        assert len(statuses) == 10
+        assert statuses[self.phone_numbers[5].id] == DeliveryStatus.FAILED
+        assert list(statuses.values()).count(DeliveryStatus.SENT) == 9
+        assert sum(d.attempts for d in deliveries) == 13
+        failed = AlertDelivery.objects.get(status=DeliveryStatus.FAILED)
+        assert failed.attempts == 1
+        assert failed.error.startswith("HTTP 400")
+        assert all(
+            d.provider_id.startswith("SM")
+            for d in deliveries
+            if d.status == DeliveryStatus.SENT
+        )
+
+    def test_send_retries_exhausted(self):
+        server = FakeSmsServer(failures=100)
+        deliveries = self.send_alerts(server, ALERT_RETRIES=2)
+        assert server.requests == 30
+        assert all(d.status == DeliveryStatus.FAILED for d in deliveries)
+        assert all(d.attempts == 3 for d in deliveries)
+        assert deliveries[0].error == "HTTP 503"
+
+    def test_rate_limit(self):
+        # Sending at 20 per second takes about half a second for 10 messages
+        server = FakeSmsServer()
+        start = time.monotonic()
+        self.send_alerts(server, ALERT_RATE_LIMIT=20)
+        assert time.monotonic() - start >= 0.45
+        assert len(server.messages) == 10
+
 
 class WebAppTestCase(StaticLiveServerTestCase):
     @classmethod
@@ -3,6 +3,7 @@ from django.urls import path, re_path, register_converter
 from . import views, converters
 
 register_converter(converters.BoundingBoxUrlParameterConverter, "bbox")
+register_converter(converters.PointUrlParameterConverter, "point")
 
 urlpatterns = [
     path("", views.index, name="index"),
@@ -11,6 +12,31 @@ urlpatterns = [
         views.depth_predictions,
         name="depths",
     ),
+    path(
+        "depths/series/<bbox:bounding_box>",
+        views.depth_series,
+        name="depth_series",
+    ),
+    path(
+        "depths/point/<point:location>",
+        views.hydrograph,
+        name="hydrograph",
+    ),
+    path(
+        "depths/<int:day>/<int:hour>/extents",
+        views.flood_extents,
+        name="flood_extents",
+    ),
+    path(
+        "depths/<int:day>/<int:hour>/raster.tif",
+        views.depth_raster,
+        name="depth_raster",
+    ),
+    path(
+        "depths/<int:day>/<int:hour>/tiles/<int:z>/<int:x>/<int:y>.mvt",
+        views.depth_tile,
+        name="depth_tile",
+    ),
     path("alerts/verify", views.verify_alert, name="verify"),
     path(
         "alerts/resend-verification/<int:id>", views.resend_verification, name="verify"
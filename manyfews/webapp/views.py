@@ -1,52 +1,162 @@
 from datetime import date, timedelta
+import json
 import logging
+import math
+import os
 import random
+import re
+import struct
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum
 from django.forms import ValidationError
-from django.http import HttpResponse, JsonResponse
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect
 from django.template import loader
 from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.contrib.gis.db.models.functions import AsGeoJSON
+from django.contrib.gis.geos import Polygon
+import numpy as np
 
 from calculations.models import (
     AggregatedDepthPrediction,
     DepthPrediction,
+    FloodExtent,
     PercentageFloodRisk,
+    PublishedRun,
+    RiverFlowPrediction,
+)
+from calculations.flood_risk import DAILY_RISKS_CACHE_KEY, PUBLISHED_RUN_CACHE_KEY
+from calculations.grid import (
+    CentroidX,
+    CentroidY,
+    XMax,
+    XMin,
+    YMax,
+    YMin,
+    get_flood_grid,
 )
+from calculations.rasters import find_depth_raster
+from calculations.tiles import get_depth_tile
 from .alerts import TwilioAlerts
 from .forms import UserAlertForm
 from .models import UserAlert, UserPhoneNumber
 
 
+# Typical number of map tiles across the map, for choosing the aggregation level of tiles
+TILES_PER_VIEWPORT = 4
+
+# Number of depth predictions above which the response is streamed, and the number of
+# items encoded at a time when streaming
+DEPTH_STREAM_THRESHOLD = 5000
+DEPTH_STREAM_CHUNK_SIZE = 1000
+
+# Media type and header layout of the binary depth format (see encode_depth_binary)
+DEPTH_BINARY_CONTENT_TYPE = "application/vnd.manyfews.depths"
+DEPTH_BINARY_HEADER = struct.Struct("<4sIddddfi")
+
+# Single byte range of a Range header: the first and last bytes, or a suffix length
+BYTE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+# Depths given at a point, and the centiles of the river flow ensemble given with them
+# (matching the depth centiles)
+POINT_DEPTH_FIELDS = (
+    "median_depth",
+    "lower_centile",
+    "mid_lower_centile",
+    "upper_centile",
+)
+RIVER_FLOW_CENTILES = (10, 30, 50, 90)
+
+# Size in degrees of the fragments that depth predictions are cached in at each
+# aggregation level: around half the shortest side of the map that shows the level
+DEPTH_FRAGMENT_SIZES = {-1: 0.0005, 256: 0.001, 128: 0.0025, 64: 0.005, 32: 0.01}
+
 MESSAGE_TAGS = {
     messages.ERROR: "danger",
 }
 
 
+def get_published_run():
+    """Get the most recently published forecast run, which cached responses are from"""
+    run = cache.get(PUBLISHED_RUN_CACHE_KEY)
+    if run is None:
+        # Cache False if no run has been published yet, which publish_run replaces
+        run = PublishedRun.get_latest() or False
+        cache.set(PUBLISHED_RUN_CACHE_KEY, run, settings.PUBLISHED_RUN_CACHE_TIMEOUT)
+    return run or None
+
+
+def get_current_run():
+    """Identify the forecast run currently shown, for use in cache keys"""
+    run = get_published_run()
+    return str(run.id) if run else "none"
+
+
+def run_etag(request, *args, **kwargs):
+    """
+    ETag for responses which only change when a run is published. Forecast days in
+    URLs are relative to today, so the responses also change each day.
+    """
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return f"{get_current_run()}-{today:%Y%m%d}"
+
+
+def run_last_modified(request, *args, **kwargs):
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    run = get_published_run()
+    return max(run.published_at, today) if run else today
+
+
+def index_etag(request):
+    # The page header depends on the logged in user
+    return f"{run_etag(request)}-{request.user.id or 0}"
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=index_etag, last_modified_func=run_last_modified)
 def index(request):
     template = loader.get_template("webapp/index.html")
+    return HttpResponse(template.render({"daily_risks": get_daily_risks()}, request))
 
-    # Prepare risk data for the home page
+
+def get_daily_risks():
+    """
+    Prepare risk data for the home page: the risk for each 6 hours of the next 10
+    days. This is cached until calculate_risk_percentages updates the risks, or a
+    new run is published.
+    """
     today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    run = get_current_run()
+    cached = cache.get(DAILY_RISKS_CACHE_KEY)
+    if cached and cached["date"] == today and cached["run"] == run:
+        return cached["daily_risks"]
+
+    risks = dict(
+        PercentageFloodRisk.objects.filter(
+            date__gte=today, date__lt=today + timedelta(days=10)
+        ).values_list("date", "risk")
+    )
+
     daily_risks = []
     for i in range(10):
         six_hour_risks = []
         date = today + timedelta(days=i)
         for j in range(4):
-
-            percentage_flood_risk = PercentageFloodRisk.objects.filter(
-                date=date + timedelta(hours=j * 6)
-            ).first()
-
-            if percentage_flood_risk:
-                risk = percentage_flood_risk.risk
-            else:
-                risk = 0
-
+            risk = risks.get(date + timedelta(hours=j * 6), 0)
             six_hour_risks.append(
                 {"hour": j * 6, "risk": risk, "percentage_risk": risk * 100}
             )
@@ -59,60 +169,681 @@ def index(request):
             }
         )
 
-    return HttpResponse(template.render({"daily_risks": daily_risks}, request))
+    cache.set(
+        DAILY_RISKS_CACHE_KEY,
+        {"date": today, "run": run, "daily_risks": daily_risks},
+        settings.RISK_CACHE_TIMEOUT,
+    )
+    return daily_risks
+
+
+def get_fragment_size(aggregation_level):
+    """
+    Get the size in degrees of the fragments that depth predictions are cached in at an
+    aggregation level. Other levels in AGGREGATION_LEVELS have fragments in proportion
+    to their blocks, as the coarsest level does.
+    """
+    if aggregation_level in DEPTH_FRAGMENT_SIZES:
+        return DEPTH_FRAGMENT_SIZES[aggregation_level]
+    coarsest = min(level for level in DEPTH_FRAGMENT_SIZES if level > 0)
+    return DEPTH_FRAGMENT_SIZES[coarsest] * coarsest / aggregation_level
+
+
+def get_aggregation_level(size):
+    """
+    Choose the aggregation level to display for an area of the map, from the size
+    (in degrees) of its shortest side. Returns -1 to use the individual cells.
+    """
+    if size < 0.001:
+        return -1
+    elif size < 0.0025:
+        return 256
+    elif size < 0.005:
+        return 128
+    elif size < 0.01:
+        return 64
+
+    return 32
+
+
+def choose_aggregation_level(forecast_times, bounding_box):
+    """
+    Choose the aggregation level to show for a bounding box: the level for its size,
+    or a coarser level if that would give more than DEPTH_CELL_BUDGET cells at any of
+    the forecast times.
+
+    The number of cells at each level is estimated in one query from the blocks of the
+    finest aggregation level, which record how many cells they contain. Once a run is
+    published, the choice is cached for the area around the bounding box.
+    """
+    x_min, y_min, x_max, y_max = bounding_box.extent
+    aggregation_level = get_aggregation_level(min(x_max - x_min, y_max - y_min))
+    levels = [-1] + sorted(settings.AGGREGATION_LEVELS, reverse=True)
+    if aggregation_level not in levels or aggregation_level == levels[-1]:
+        return aggregation_level
+
+    run = get_published_run()
+    if run:
+        size = get_fragment_size(aggregation_level)
+        cache_key = (
+            f"depth_level:{run.id}:{forecast_times[0]:%Y%m%d%H}:{len(forecast_times)}:"
+            f"{aggregation_level}:{math.floor(x_min / size)}:{math.floor(y_min / size)}:"
+            f"{math.floor(x_max / size)}:{math.floor(y_max / size)}"
+        )
+        cached_level = cache.get(cache_key)
+        if cached_level is not None:
+            return cached_level
+
+    finest_level = levels[1]
+    estimates = (
+        AggregatedDepthPrediction.objects.filter(
+            date__in=forecast_times,
+            aggregation_level=finest_level,
+            bounding_box__intersects=bounding_box,
+        )
+        .values("date")
+        .annotate(cells=Sum("cell_count"), blocks=Count("id"))
+    )
+    cells = max((estimate["cells"] for estimate in estimates), default=0)
+    blocks = max((estimate["blocks"] for estimate in estimates), default=0)
+
+    # Each coarser level has around a quarter of the blocks of the level below
+    chosen_level = levels[-1]
+    for level in levels[levels.index(aggregation_level) :]:
+        estimate = cells if level == -1 else blocks * (level / finest_level) ** 2
+        if estimate <= settings.DEPTH_CELL_BUDGET:
+            chosen_level = level
+            break
+
+    if run:
+        cache.set(cache_key, chosen_level, settings.DEPTH_CACHE_TIMEOUT)
+    return chosen_level
+
+
+def get_depth_format(request):
+    """Get the format of depths requested: JSON, unless the binary format is accepted"""
+    if DEPTH_BINARY_CONTENT_TYPE in request.headers.get("Accept", ""):
+        return "binary"
+    return "json"
+
 
+def depth_etag(request, *args, **kwargs):
+    return f"{run_etag(request)}-{get_depth_format(request)}"
 
+
+@cache_control(public=True, max_age=settings.DEPTH_MAX_AGE)
+@vary_on_headers("Accept")
+@condition(etag_func=depth_etag, last_modified_func=run_last_modified)
 def depth_predictions(request, day, hour, bounding_box):
     # Get the depth predictions for this bounding box and day days ahead
     today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    depth_format = get_depth_format(request)
+    aggregation_level, fragments = get_depth_fragments(
+        today + timedelta(days=day, hours=hour), bounding_box, depth_format
+    )
 
-    # Determine aggregation level by current extent
-    total_width = bounding_box.extent[2] - bounding_box.extent[0]
-    total_height = bounding_box.extent[3] - bounding_box.extent[1]
+    if depth_format == "binary":
+        rows = [fragment for count, fragment in fragments if count]
+        return HttpResponse(
+            encode_depth_binary(
+                np.concatenate(rows) if rows else np.zeros((0, 7)), aggregation_level
+            ),
+            content_type=DEPTH_BINARY_CONTENT_TYPE,
+        )
 
-    aggregation_level = 32
-    objects_to_fetch = AggregatedDepthPrediction
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    start = '{"max_depth":%s,"aggregation_level":%d,"items":[' % (
+        encoder.encode(settings.MAX_FLOOD_DEPTH),
+        aggregation_level,
+    )
+    items = [fragment for count, fragment in fragments if count]
+    if sum(count for count, fragment in fragments) <= DEPTH_STREAM_THRESHOLD:
+        return HttpResponse(
+            start + ",".join(items) + "]}", content_type="application/json"
+        )
 
-    size = min(total_height, total_width)
+    # Stream large responses a fragment at a time, rather than joining them in memory
+    def stream():
+        yield start
+        for i, fragment in enumerate(items):
+            yield ("," if i else "") + fragment
+        yield "]}"
+
+    return StreamingHttpResponse(stream(), content_type="application/json")
+
+
+@cache_control(public=True, max_age=settings.DEPTH_MAX_AGE)
+@vary_on_headers("Accept")
+@condition(etag_func=depth_etag, last_modified_func=run_last_modified)
+def depth_series(request, bounding_box):
+    # Get the depth predictions for this bounding box at every forecast time on the
+    # home page, so the map can step through them without further requests
+    depth_format = get_depth_format(request)
+    series = get_depth_series(bounding_box, depth_format)
+    if depth_format == "binary":
+        return HttpResponse(series, content_type=DEPTH_BINARY_CONTENT_TYPE)
+    return HttpResponse(series, content_type="application/json")
+
+
+def get_depth_series(bounding_box, depth_format="json"):
+    """
+    Get the depths in a bounding box for each 6 hours of the next 10 days.
+
+    As JSON, each cell is listed once, as [south, west, north, east]. The depths at
+    each time are sparse: only the cells predicted to flood at that time are given, by
+    their index in the list of cells. In the binary format, the depths at each time
+    are given in turn, each encoded as by encode_depth_binary.
+
+    The bounding box is expanded to the depth fragments covering it, and the series
+    is cached until the next run is published.
+    """
+    x_min, y_min, x_max, y_max = bounding_box.extent
+    size_level = get_aggregation_level(min(x_max - x_min, y_max - y_min))
+    size = get_fragment_size(size_level)
+    column_min, row_min = math.floor(x_min / size), math.floor(y_min / size)
+    column_max, row_max = math.floor(x_max / size), math.floor(y_max / size)
+
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    cache_key = (
+        f"depth_series:{get_current_run()}:{today:%Y%m%d}:{depth_format}:"
+        f"{size_level}:{column_min}:{row_min}:{column_max}:{row_max}"
+    )
+    series = cache.get(cache_key)
+    if series is not None:
+        return series
+
+    times = [
+        today + timedelta(days=day, hours=hour)
+        for day in range(10)
+        for hour in range(0, 24, 6)
+    ]
+    time_index = {time: i for i, time in enumerate(times)}
+    expanded_box = Polygon.from_bbox(
+        (
+            column_min * size,
+            row_min * size,
+            (column_max + 1) * size,
+            (row_max + 1) * size,
+        )
+    )
+    aggregation_level = choose_aggregation_level(times, expanded_box)
+    predictions, box_field = get_depth_queryset(aggregation_level, expanded_box)
+
+    step_rows = [[] for time in times]
+    for date, *row in predictions.filter(date__in=times).values_list(
+        "date",
+        YMin(box_field),
+        XMin(box_field),
+        YMax(box_field),
+        XMax(box_field),
+        "median_depth",
+        "lower_centile",
+        "upper_centile",
+    ):
+        step_rows[time_index[date]].append(row)
+
+    if depth_format == "binary":
+        series = b"".join(
+            encode_depth_binary(rows, aggregation_level) for rows in step_rows
+        )
+        cache.set(cache_key, series, settings.DEPTH_CACHE_TIMEOUT)
+        return series
+
+    # Aggregated blocks are separate rows for each time, so identify cells by bounds
+    cells = {}
+    steps = [
+        {"cells": [], "depth": [], "lower_centile": [], "upper_centile": []}
+        for time in times
+    ]
+    for step, rows in zip(steps, step_rows):
+        for *bounds, median_depth, lower_centile, upper_centile in rows:
+            cell = cells.setdefault(tuple(round(b, 9) for b in bounds), len(cells))
+            step["cells"].append(cell)
+            step["depth"].append(round(median_depth, 3))
+            step["lower_centile"].append(round(lower_centile, 3))
+            step["upper_centile"].append(round(upper_centile, 3))
+
+    series = json.dumps(
+        {
+            "max_depth": settings.MAX_FLOOD_DEPTH,
+            "aggregation_level": aggregation_level,
+            "times": [time.isoformat() for time in times],
+            "cells": list(cells),
+            "steps": steps,
+        },
+        separators=(",", ":"),
+    )
+    cache.set(cache_key, series, settings.DEPTH_CACHE_TIMEOUT)
+    return series
+
+
+@cache_control(public=True, max_age=settings.DEPTH_MAX_AGE)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
+def flood_extents(request, day, hour):
+    # Get the outlines of the flooded areas at a time, for a light map layer
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return HttpResponse(
+        get_flood_extents(today + timedelta(days=day, hours=hour)),
+        content_type="application/json",
+    )
 
-    if size < 0.001:
-        aggregation_level = -1
-        objects_to_fetch = DepthPrediction
-    elif size < 0.0025:
-        aggregation_level = 256
-    elif size < 0.005:
-        aggregation_level = 128
-    elif size < 0.01:
-        aggregation_level = 64
 
+def get_flood_extents(forecast_time):
+    """
+    Get the flood extents at a forecast time as a GeoJSON FeatureCollection, shallowest
+    first, cached until the next run is published.
+    """
+    cache_key = f"flood_extents:{get_current_run()}:{forecast_time:%Y%m%d%H}"
+    extents = cache.get(cache_key)
+    if extents is not None:
+        return extents
+
+    features = [
+        {
+            "type": "Feature",
+            "geometry": json.loads(geometry),
+            "properties": {"min_depth": min_depth, "max_depth": max_depth},
+        }
+        for geometry, min_depth, max_depth in FloodExtent.objects.filter(
+            date=forecast_time
+        )
+        .order_by("min_depth", "id")
+        .values_list(AsGeoJSON("outline", precision=6), "min_depth", "max_depth")
+    ]
+    extents = json.dumps(
+        {
+            "type": "FeatureCollection",
+            "max_depth": settings.MAX_FLOOD_DEPTH,
+            "features": features,
+        },
+        separators=(",", ":"),
+    )
+    cache.set(cache_key, extents, settings.DEPTH_CACHE_TIMEOUT)
+    return extents
+
+
+@cache_control(public=True, max_age=settings.DEPTH_MAX_AGE)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
+def hydrograph(request, location):
+    # Get the predicted depths at a location for each 6 hours of the next 10 days,
+    # with the river flows they were predicted from
+    return JsonResponse(
+        {
+            "location": [location.x, location.y],
+            **get_point_depths(location),
+            "river_flow": get_river_flow_centiles(),
+        }
+    )
+
+
+def get_point_depths(location):
+    """
+    Get the depth centiles of the cell containing a location, for each 6 hours of the
+    next 10 days (0 when no flooding is predicted). This is cached for each cell until
+    the next run is published.
+    """
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    run = get_published_run()
+    cache_key = None
+    if run:
+        column, row = get_flood_grid(run.model_version_id).column_row(
+            location.x, location.y
+        )
+        cache_key = f"point_depths:{run.id}:{today:%Y%m%d}:{column}:{row}"
+        depths = cache.get(cache_key)
+        if depths is not None:
+            return depths
+
+    times = [
+        today + timedelta(days=day, hours=hour)
+        for day in range(10)
+        for hour in range(0, 24, 6)
+    ]
+    time_index = {time: i for i, time in enumerate(times)}
+    depths = {
+        "cell": None,
+        "times": [time.isoformat() for time in times],
+        **{field: [0] * len(times) for field in POINT_DEPTH_FIELDS},
+    }
+
+    for date, *bounds_and_depths in DepthPrediction.objects.filter(
+        parameters__bounding_box__contains=location, date__in=times
+    ).values_list(
+        "date",
+        YMin("parameters__bounding_box"),
+        XMin("parameters__bounding_box"),
+        YMax("parameters__bounding_box"),
+        XMax("parameters__bounding_box"),
+        *POINT_DEPTH_FIELDS,
+    ):
+        depths["cell"] = bounds_and_depths[:4]
+        for field, depth in zip(POINT_DEPTH_FIELDS, bounds_and_depths[4:]):
+            depths[field][time_index[date]] = depth
+
+    if cache_key:
+        cache.set(cache_key, depths, settings.DEPTH_CACHE_TIMEOUT)
+    return depths
+
+
+def get_river_flow_centiles():
+    """
+    Get centiles of the river flow ensemble of the published run, for each forecast
+    time in the next 10 days. This is cached until the next run is published.
+    """
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    run = get_published_run()
+    if run is None:
+        return None
+
+    cache_key = f"river_flow_centiles:{run.id}:{today:%Y%m%d}"
+    centiles = cache.get(cache_key)
+    if centiles is not None:
+        return centiles
+
+    flows = {}
+    for forecast_time, river_flow in (
+        RiverFlowPrediction.objects.filter(
+            calculation_output__prediction_date=run.prediction_date,
+            calculation_output__forecast_time__gte=today,
+            calculation_output__forecast_time__lt=today + timedelta(days=10),
+        )
+        .order_by("calculation_output__forecast_time")
+        .values_list("calculation_output__forecast_time", "river_flow")
+    ):
+        flows.setdefault(forecast_time, []).append(river_flow)
+
+    values = (
+        np.percentile(list(flows.values()), RIVER_FLOW_CENTILES, axis=1)
+        if flows
+        else np.zeros((len(RIVER_FLOW_CENTILES), 0))
+    )
+    centiles = {
+        "times": [time.isoformat() for time in flows],
+        "centiles": {
+            str(centile): list(values[i])
+            for i, centile in enumerate(RIVER_FLOW_CENTILES)
+        },
+    }
+    cache.set(cache_key, centiles, settings.DEPTH_CACHE_TIMEOUT)
+    return centiles
+
+
+def get_depth_fragments(forecast_time, bounding_box, depth_format="json"):
+    """
+    Get the depth predictions to show for a bounding box, as the aggregation level
+    and a list of (number of items, items) fragments. The items are encoded as JSON,
+    or as an array of rows for the binary format.
+
+    Once a run is published, the fragments are cached on a fixed grid for the
+    aggregation level, so that requests for overlapping areas of the map share them.
+    Each fragment has the predictions whose centres lie within it, so the fragments
+    within half a cell of the bounding box are included for the cells crossing into it.
+    """
+    x_min, y_min, x_max, y_max = bounding_box.extent
+    aggregation_level = choose_aggregation_level([forecast_time], bounding_box)
+
+    encode = DEPTH_FRAGMENT_ENCODERS[depth_format]
+    run = get_published_run()
+    if run is None:
+        rows = list(get_depth_rows(forecast_time, aggregation_level, bounding_box))
+        return aggregation_level, [
+            (len(chunk), encode(chunk))
+            for chunk in (
+                rows[i : i + DEPTH_STREAM_CHUNK_SIZE]
+                for i in range(0, len(rows), DEPTH_STREAM_CHUNK_SIZE)
+            )
+        ]
+
+    # Snap the bounding box to the fragments covering it, within the model's grid
+    size = get_fragment_size(aggregation_level)
+    grid = get_flood_grid(run.model_version_id)
+    if aggregation_level > 0:
+        margin_x = margin_y = grid.block_size(aggregation_level) / 2
+    else:
+        margin_x, margin_y = grid.cell_width / 2, grid.cell_height / 2
+    columns = range(
+        math.floor(max(x_min - margin_x, grid.x_min) / size),
+        math.floor(min(x_max + margin_x, grid.x_max) / size) + 1,
+    )
+    rows = range(
+        math.floor(max(y_min - margin_y, grid.y_min) / size),
+        math.floor(min(y_max + margin_y, grid.y_max) / size) + 1,
+    )
+    keys = {
+        (column, row): (
+            f"depths:{depth_format}:{run.id}:{forecast_time:%Y%m%d%H}:"
+            f"{aggregation_level}:{column}:{row}"
+        )
+        for column in columns
+        for row in rows
+    }
+    fragments = cache.get_many(keys.values())
+
+    # Fetch all missing fragments in one query, and sort the predictions into them
+    missing = {block: [] for block, key in keys.items() if key not in fragments}
+    if missing:
+        missing_box = Polygon.from_bbox(
+            (
+                min(column for column, row in missing) * size,
+                min(row for column, row in missing) * size,
+                (max(column for column, row in missing) + 1) * size,
+                (max(row for column, row in missing) + 1) * size,
+            )
+        )
+        for prediction in get_depth_rows(
+            forecast_time, aggregation_level, missing_box, centres=True
+        ):
+            block = (
+                math.floor(prediction[-2] / size),
+                math.floor(prediction[-1] / size),
+            )
+            if block in missing:
+                missing[block].append(prediction[:-2])
+
+        new_fragments = {
+            keys[block]: (len(predictions), encode(predictions))
+            for block, predictions in missing.items()
+        }
+        cache.set_many(new_fragments, settings.DEPTH_CACHE_TIMEOUT)
+        fragments.update(new_fragments)
+
+    return aggregation_level, [fragments[key] for key in keys.values()]
+
+
+def get_depth_rows(forecast_time, aggregation_level, bounding_box, centres=False):
+    """
+    Query the corners and depths of the predictions intersecting a bounding box, with
+    the x, y of their centres at the end of each row if centres is True.
+    """
+    predictions, box_field = get_depth_queryset(aggregation_level, bounding_box)
+
+    # Bounding box is (xmin, ymin, xmax, ymax) but leaflet expects [[lat, lon], [lat, lon]],
+    # so fetch the corners in that order along with the depths in a single query
+    fields = [
+        YMin(box_field),
+        XMin(box_field),
+        YMax(box_field),
+        XMax(box_field),
+        "median_depth",
+        "lower_centile",
+        "upper_centile",
+    ]
+    if centres:
+        fields += [CentroidX(box_field), CentroidY(box_field)]
+
+    return predictions.filter(date=forecast_time).values_list(*fields)
+
+
+def get_depth_queryset(aggregation_level, bounding_box):
+    """
+    Get the depth predictions at an aggregation level intersecting a bounding box, and
+    the name of the field with their bounding boxes.
+    """
     if aggregation_level > 0:
         predictions = AggregatedDepthPrediction.objects.filter(
-            date=today + timedelta(days=day, hours=hour),
             aggregation_level=aggregation_level,
             bounding_box__intersects=bounding_box,
         )
-    else:
-        predictions = DepthPrediction.objects.filter(
-            date=today + timedelta(days=day, hours=hour),
-            parameters__bounding_box__intersects=bounding_box,
-        )
+        return predictions, "bounding_box"
 
-    items = []
-    for p in predictions:
-        bounding_box = (
-            p.bounding_box if aggregation_level > 0 else p.parameters.bounding_box
-        )
-        bb_extent = bounding_box.extent
-        items.append(
+    predictions = DepthPrediction.objects.filter(
+        parameters__bounding_box__intersects=bounding_box,
+    )
+    return predictions, "parameters__bounding_box"
+
+
+def encode_depth_items(rows):
+    """Encode rows of corners and depths from get_depth_rows as JSON items"""
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    return ",".join(
+        encoder.encode(
             {
-                # Bounding box is (xmin, ymin, xmax, ymax) but leaflet expects [[lat, lon], [lat, lon]]
-                "bounds": [[bb_extent[1], bb_extent[0]], [bb_extent[3], bb_extent[2]]],
-                "depth": p.median_depth,
-                "lower_centile": p.lower_centile,
-                "upper_centile": p.upper_centile,
+                "bounds": [[row[0], row[1]], [row[2], row[3]]],
+                "depth": row[4],
+                "lower_centile": row[5],
+                "upper_centile": row[6],
             }
         )
-    return JsonResponse({"items": items, "max_depth": settings.MAX_FLOOD_DEPTH})
+        for row in rows
+    )
+
+
+def encode_depth_binary(rows, aggregation_level):
+    """
+    Encode rows of corners and depths from get_depth_rows in the binary format, which
+    gives the position of each cell by its indices on a grid:
+
+    - a header of "MFD1", the number of cells (uint32), the grid origin (x, y) and cell
+      size (width, height) as float64, MAX_FLOOD_DEPTH (float32) and the aggregation
+      level (int32);
+    - the indices of the cells, as column | row << 16 (uint32, with rows counted up from
+      the origin);
+    - the median, lower and upper centile depths of the cells in mm (uint16).
+
+    All values are little-endian.
+    """
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, 7)
+    if len(rows):
+        origin_x, origin_y = rows[:, 1].min(), rows[:, 0].min()
+        cell_width, cell_height = rows[0, 3] - rows[0, 1], rows[0, 2] - rows[0, 0]
+        columns = np.rint((rows[:, 1] - origin_x) / cell_width).astype(np.uint32)
+        row_indices = np.rint((rows[:, 0] - origin_y) / cell_height).astype(np.uint32)
+    else:
+        origin_x = origin_y = cell_width = cell_height = 0
+        columns = row_indices = np.zeros(0, dtype=np.uint32)
+
+    header = DEPTH_BINARY_HEADER.pack(
+        b"MFD1",
+        len(rows),
+        origin_x,
+        origin_y,
+        cell_width,
+        cell_height,
+        settings.MAX_FLOOD_DEPTH,
+        aggregation_level,
+    )
+    indices = (columns | (row_indices << 16)).astype("<u4")
+    depths = np.clip(np.rint(rows[:, 4:7] * 1000), 0, np.iinfo(np.uint16).max)
+    return header + indices.tobytes() + depths.astype("<u2").tobytes()
+
+
+def depth_rows_array(rows):
+    """Store rows of corners and depths as an array, for encode_depth_binary"""
+    return np.asarray(rows, dtype=np.float64).reshape(-1, 7)
+
+
+# Functions to encode the fragments of depth predictions for each format
+DEPTH_FRAGMENT_ENCODERS = {"json": encode_depth_items, "binary": depth_rows_array}
+
+
+@cache_control(public=True, max_age=settings.TILE_MAX_AGE)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
+def depth_tile(request, day, hour, z, x, y):
+    # Get a vector tile of the depth predictions for day days ahead
+    if x >= 2**z or y >= 2**z:
+        raise Http404(f"Invalid tile {z}/{x}/{y}")
+
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    tile = get_cached_depth_tile(today + timedelta(days=day, hours=hour), z, x, y)
+    return HttpResponse(tile, content_type="application/vnd.mapbox-vector-tile")
+
+
+def get_cached_depth_tile(forecast_time, z, x, y):
+    """Get a depth vector tile, which is cached until the next run is published"""
+    cache_key = f"depth_tile:{get_current_run()}:{forecast_time:%Y%m%d%H}:{z}:{x}:{y}"
+    tile = cache.get(cache_key)
+    if tile is None:
+        # Use the level the map would show with a few tiles across the viewport
+        tile_size = 360 / 2**z
+        aggregation_level = get_aggregation_level(tile_size * TILES_PER_VIEWPORT)
+        tile = get_depth_tile(forecast_time, aggregation_level, z, x, y)
+        cache.set(cache_key, tile, settings.DEPTH_CACHE_TIMEOUT)
+
+    return tile
+
+
+def get_byte_range(header, size):
+    """
+    Get the first and last bytes of a file of size bytes requested by a Range header.
+
+    :return: (first, last), or None to send the whole file, when there is no header or
+             it isn't a single byte range
+    :raises ValueError: if the range starts after the end of the file
+    """
+    match = BYTE_RANGE.fullmatch(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # The last bytes of the file
+        first, last = max(0, size - int(last)), size - 1
+    elif last and int(last) < int(first):
+        return None
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size:
+        raise ValueError(f"Range {header} is outside the file of {size} bytes")
+
+    return first, last
+
+
+def depth_raster(request, day, hour):
+    # Download the depth raster (Cloud-Optimized GeoTIFF) for day days ahead. Ranges of
+    # it can be requested, so clients can read a window of it from its internal tiles
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    forecast_time = today + timedelta(days=day, hours=hour)
+    path = find_depth_raster(forecast_time)
+    try:
+        raster = open(path, "rb") if path else None
+    except FileNotFoundError:
+        # Pruned after a later run wrote its raster
+        raster = None
+    if not raster:
+        raise Http404(f"No depth raster for {forecast_time}")
+
+    size = os.fstat(raster.fileno()).st_size
+    try:
+        byte_range = get_byte_range(request.headers.get("Range"), size)
+    except ValueError:
+        raster.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    if byte_range:
+        first, last = byte_range
+        with raster:
+            raster.seek(first)
+            response = HttpResponse(
+                raster.read(last - first + 1), status=206, content_type="image/tiff"
+            )
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+    else:
+        response = FileResponse(
+            raster, as_attachment=True, filename=path.name, content_type="image/tiff"
+        )
+    response["Accept-Ranges"] = "bytes"
+    return response
 
 
 @login_required